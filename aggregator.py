@@ -0,0 +1,176 @@
+#! /usr/bin/env python3
+#
+# Reference aggregator for the events boards ship with event_shipper.py
+#
+# Listens for event frames on UDP and/or TCP (one asyncio event loop, no threads), counts events per board and
+# type, notices lost UDP batches from gaps in each board's sequence numbers, and optionally appends every event as
+# a JSON line ({"board", ...event}) to an output file and/or inserts it into an event store (event_store.py) that the
+# query CLI reads. A summary with the event rate is logged every report_interval
+# seconds. Decoding is a zlib.decompress and one json.loads per batch, so a single core handles tens of thousands of
+# events per second.
+#
+# usage: python3 aggregator.py [--udp 9510] [--tcp 9510] [--host 127.0.0.1] [--output events.jsonl] [--store events.db]
+
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import argparse
+from collections import Counter
+
+from event_shipper import HEADER, MAGIC, decode_payload
+from event_store import open_store, insert
+
+
+
+MAX_FRAME = 16*1024*1024 #largest TCP payload accepted (a full batch compresses to well under 1 MB)
+
+
+
+class Aggregator:
+
+    #output: file events are appended to as JSON lines, store: event store file they are inserted into (None for
+    #neither to only count them)
+    def __init__(self, output=None, report_interval=10, store=None):
+        self.output = output
+        self.report_interval = report_interval
+        self.events = 0
+        self.frames = 0
+        self.bad_frames = 0
+        self.lost_batches = 0
+        self.counts = Counter() #(board, event type) -> events
+        self._last_seq = {} #board -> last sequence number seen
+        self._out = open(output, "a") if output else None
+        self._store = open_store(store) if store else None
+        self._reported = (time.monotonic(), 0)
+
+    #handles one encoded payload (the bytes after the header)
+    def handle_payload(self, payload):
+        try:
+            batch = decode_payload(payload)
+            board, seq, events = batch["board"], batch["seq"], batch["events"]
+            if not (isinstance(board, str) and isinstance(seq, int) and not isinstance(seq, bool)
+                    and isinstance(events, list) and all(isinstance(event, dict) for event in events)):
+                raise ValueError("expected a board name, an integer seq and a list of events")
+        except (ValueError, KeyError, TypeError) as e:
+            self.bad_frames += 1
+            logging.warning(f"dropping bad frame: {e}")
+            return
+        last = self._last_seq.get(board)
+        if last is not None and seq > last + 1:
+            self.lost_batches += seq - last - 1
+        elif last is not None and seq <= last and seq != 0: #0: the board restarted
+            logging.debug(f"duplicate or reordered batch {seq} from {board}")
+        self._last_seq[board] = seq
+
+        self.frames += 1
+        self.events += len(events)
+        for event in events:
+            self.counts[(board, event.get("type"))] += 1
+        if self._out is not None:
+            self._out.writelines(json.dumps({"board": board, **event}, separators=(",", ":")) + "\n" for event in events)
+        if self._store is not None:
+            try:
+                insert(self._store, board, events) #one transaction per batch
+            except (sqlite3.Error, KeyError, TypeError, AttributeError) as e:
+                logging.warning(f"failed to store a batch from {board}: {e!r}")
+
+    def report(self):
+        now = time.monotonic()
+        since, events = self._reported
+        rate = (self.events - events)/max(now - since, 1e-9)
+        self._reported = (now, self.events)
+        boards = len({board for board, _ in self.counts})
+        logging.info(f"{self.events} events from {boards} boards in {self.frames} frames, {rate:.0f} events/s, "
+                     f"{self.lost_batches} batches lost, {self.bad_frames} bad frames")
+        if self._out is not None:
+            self._out.flush()
+
+    async def report_loop(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.report()
+
+
+    #================================ transports ================================
+
+    #TCP: a stream of header + payload frames per connection
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        logging.info(f"board connected from {peer}")
+        try:
+            while True:
+                header = await reader.readexactly(HEADER.size)
+                magic, length = HEADER.unpack(header)
+                if magic != MAGIC:
+                    logging.warning(f"closing connection from {peer}: not an event stream")
+                    break
+                if length > MAX_FRAME:
+                    self.bad_frames += 1
+                    logging.warning(f"closing connection from {peer}: {length} byte frame exceeds {MAX_FRAME}")
+                    break
+                self.handle_payload(await reader.readexactly(length))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+        logging.info(f"board at {peer} disconnected")
+
+
+
+#UDP: one frame per datagram
+class _DatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+
+    def datagram_received(self, data, addr):
+        if len(data) < HEADER.size:
+            self.aggregator.bad_frames += 1
+            return
+        magic, length = HEADER.unpack_from(data)
+        if magic != MAGIC or length != len(data) - HEADER.size:
+            self.aggregator.bad_frames += 1
+            return
+        self.aggregator.handle_payload(data[HEADER.size:])
+
+
+
+async def serve(aggregator, host, udp_port=None, tcp_port=None):
+    loop = asyncio.get_running_loop()
+    if udp_port is not None:
+        await loop.create_datagram_endpoint(lambda: _DatagramProtocol(aggregator), local_addr=(host, udp_port))
+        logging.info(f"listening for UDP event frames on {host}:{udp_port}")
+    if tcp_port is not None:
+        await asyncio.start_server(aggregator.handle_connection, host, tcp_port) #serves until the loop stops
+        logging.info(f"listening for TCP event streams on {host}:{tcp_port}")
+    await aggregator.report_loop()
+
+
+
+
+
+##########################################################################################################
+#                           MAIN                                                                         #
+##########################################################################################################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Collect events shipped by motion detector boards")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (0.0.0.0 for all interfaces)")
+    parser.add_argument("--udp", type=int, help="UDP port")
+    parser.add_argument("--tcp", type=int, help="TCP port")
+    parser.add_argument("--output", help="append events to this JSON lines file")
+    parser.add_argument("--store", help="insert events into this event store (query it with event_store.py)")
+    parser.add_argument("--report-interval", type=float, default=10, help="seconds between summaries")
+    args = parser.parse_args()
+    if args.udp is None and args.tcp is None:
+        args.udp = args.tcp = 9510
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    aggregator = Aggregator(args.output, args.report_interval, args.store)
+    try:
+        asyncio.run(serve(aggregator, args.host, args.udp, args.tcp))
+    except KeyboardInterrupt:
+        aggregator.report()
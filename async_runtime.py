@@ -0,0 +1,307 @@
+#! /usr/bin/env python3
+#
+# Single-threaded asyncio runtime: alternative to running the button, LED, motion and audio threads plus the main
+# loop as five separate threads. Everything runs as coroutines on one event loop; GPIO edges arrive through
+# callbacks handed to the loop with call_soon_threadsafe, and blocking ranging/audio work runs in executors.
+#
+# The sensor, LED and audio objects are the same classes the threaded scripts use (they are just never started),
+# so detection, button and LED behaviour is unchanged.
+#
+# usage: python3 async_runtime.py [ultrasonic|pir]
+
+
+
+##########################################################################################################
+#                           GENERAL SETUP                                                                #
+##########################################################################################################
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from gpio_backend import GPIO
+from motion_detector import setup, cleanup, LED_Thread, AudioThread, MotionThread
+from motion_detector_IR import MotionThread_IR
+from latency import LatencyTracker
+from log_setup import setup_logging
+from boot_timing import log_armed
+from thread_stats import ThreadStats, count_iteration
+
+
+
+
+
+##########################################################################################################
+#                           ASYNCIO RUNTIME                                                              #
+##########################################################################################################
+
+class AsyncRuntime:
+
+    #sensor: MotionThread or MotionThread_IR (not started), led: LED_Thread (not started), audio: AudioThread (not started)
+    #pir_bouncetime: debounce (ms) for PIR edges
+    def __init__(self, sensor, buttonPin, led, audio, pir_bouncetime=200):
+        self.sensor = sensor
+        self.buttonPin = buttonPin
+        self.led = led
+        self.audio = audio
+        self.pir_bouncetime = pir_bouncetime
+
+        self.systemActive = True
+
+        #one worker each so a long ranging call never delays audio (and vice versa)
+        self._gpio_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpio")
+        self._audio_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audio")
+
+        GPIO.setup(self.buttonPin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+        except KeyboardInterrupt:
+            cleanup()
+
+
+    async def main(self):
+        self._loop = asyncio.get_running_loop()
+        self._led_changed = asyncio.Event()
+        self._play_requested = asyncio.Event()
+        self._playing = False
+        self._trace = None
+
+        self._set_led_mode(1) #pre-activation blinking
+
+        if isinstance(self.sensor, MotionThread_IR):
+            sensor_task = self.pir_task()
+        else:
+            sensor_task = self.ultrasonic_task()
+        log_armed()
+        await asyncio.gather(self.button_task(), self.led_task(), sensor_task, self.audio_task())
+
+
+    #runs fn(*args) from a GPIO callback thread on the event loop
+    def _edge_callback(self, fn):
+        def callback(channel):
+            self._loop.call_soon_threadsafe(fn, channel, time.monotonic())
+        return callback
+
+
+    #================================ control logic (same as run_main_loop) ================================
+
+    def _on_motion(self):
+        trace = self.sensor.last_trace
+        trace.mark("pickup")
+        if self.systemActive:
+            self.request_play_audio(trace)
+        self.sensor.deactivate()
+        self._update_led()
+
+    def _on_button(self, buttonStatus):
+        if buttonStatus == 3:
+            logging.info("Shutting down")
+            self._loop.create_task(self._shutdown())
+
+        elif buttonStatus == 2:
+            logging.info("Deactivating")
+            self.systemActive = False #deactivate motion sensor
+            self.sensor.set_standby(True)
+            self.audio.close_output()
+
+        elif buttonStatus == 1:
+            logging.info("Reactivating")
+            self.sensor.set_activation_time(0.25) #will wait 15 sec to activate
+            self.sensor.deactivate()
+            self.sensor.set_standby(False)
+            self.systemActive = True
+            self.audio.open_output()
+
+        self._update_led()
+
+    async def _shutdown(self):
+        await self.acknowledge_blink() #blink to acknowledge poweroff command
+        cmd = "sudo shutdown -h now" #power off Pi
+        await self._loop.run_in_executor(self._audio_executor, subprocess.run, cmd.split())
+
+    def _update_led(self):
+        if not self.systemActive:
+            desiredLEDmode = 0
+        else:
+            desiredLEDmode = self.sensor.delay_status
+        if desiredLEDmode != self.led.get_mode():
+            self._set_led_mode(desiredLEDmode)
+
+
+    #================================ button ================================
+
+    #same gesture timing as ButtonThread: press duration >= 0.3 s reactivates, >= 3 s deactivates, >= 6 s powers off
+    async def button_task(self):
+        logging.debug("starting button task")
+        edges = asyncio.Queue()
+        GPIO.add_event_detect(self.buttonPin, GPIO.BOTH, callback=self._edge_callback(lambda channel, t: edges.put_nowait(t)))
+
+        while True:
+            count_iteration()
+            await edges.get()
+            if GPIO.input(self.buttonPin) != GPIO.LOW: #only presses start a gesture
+                continue
+            start = time.monotonic()
+            await asyncio.sleep(0.2) #allowing voltage to drop
+
+            while GPIO.input(self.buttonPin) == GPIO.LOW: #waiting for button release (next edge)
+                await edges.get()
+            while not edges.empty(): #bounces from the release
+                edges.get_nowait()
+
+            buttonTime = time.monotonic() - start #getting button press duration
+
+            if buttonTime >= 6: #power off
+                logging.debug("button status 3 (poweroff)")
+                self._on_button(3)
+            elif buttonTime >= 3: #deactivate
+                logging.debug("button status 2 (deactivate)")
+                self._on_button(2)
+            elif buttonTime >= .3: #activate/reactivate
+                logging.debug("button status 1 (reactivate)")
+                self._on_button(1)
+
+
+    #================================ LED ================================
+
+    def _set_led_mode(self, mode):
+        self.led.set_mode(mode)
+        self._led_changed.set()
+
+    #toggles the LED every blinkrate seconds, sleeping until the next toggle or a mode change
+    async def led_task(self):
+        logging.debug("starting LED task")
+        while True:
+            count_iteration()
+            self._led_changed.clear()
+            if self.led.get_mode() == 0:
+                GPIO.output(self.led.ledPin, GPIO.LOW)
+                await self._led_changed.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._led_changed.wait(), self.led.blinkrate)
+            except asyncio.TimeoutError:
+                self.led.switch_light()
+
+    #unique blink pattern to acknowledge shutdown
+    async def acknowledge_blink(self):
+        cmode = self.led.get_mode()
+        self._set_led_mode(0) #deactivate LED
+        await asyncio.sleep(0.25)
+        for i in range(5):
+            if i != 3:
+                GPIO.output(self.led.ledPin, GPIO.HIGH)
+            await asyncio.sleep(0.2)
+            GPIO.output(self.led.ledPin, GPIO.LOW)
+            await asyncio.sleep(0.2)
+        self._set_led_mode(cmode)
+
+
+    #================================ motion sensors ================================
+
+    async def ultrasonic_task(self):
+        logging.debug("starting ultrasonic task")
+        while True:
+            count_iteration()
+            cycle_start = self._loop.time()
+
+            #ranging blocks (busy-waits in poll mode), so it runs in the GPIO executor
+            detected = await self._loop.run_in_executor(self._gpio_executor, self.sensor.check_range_diff)
+            if self.sensor.check_activation(detected):
+                self._on_motion()
+            self._update_led()
+
+            await asyncio.sleep(max(0, self.sensor.next_period() - (self._loop.time() - cycle_start)))
+
+    #sleeps until a PIR rising edge arrives or the activation delay expires
+    async def pir_task(self):
+        logging.debug("starting PIR task")
+        edges = asyncio.Queue()
+        GPIO.add_event_detect(self.sensor.pin, GPIO.RISING, callback=self._edge_callback(lambda channel, t: edges.put_nowait(t)),
+                              bouncetime=self.pir_bouncetime)
+
+        while True:
+            count_iteration()
+            self.sensor.check_edge() #updates delay_status before sleeping
+            self._update_led()
+            try:
+                edge = await asyncio.wait_for(edges.get(), self.sensor.time_to_refresh())
+            except asyncio.TimeoutError:
+                edge = None
+            if self.sensor.check_edge(edge):
+                self._on_motion()
+
+
+    #================================ audio ================================
+
+    def request_play_audio(self, trace=None):
+        logging.debug(f"requesting to play audio (playing = {self._playing})")
+        if not self._playing:
+            if trace is not None:
+                trace.mark("request")
+            self._trace = trace
+            self._playing = True
+            self._play_requested.set()
+
+    async def audio_task(self):
+        logging.debug("starting audio task")
+        while True:
+            count_iteration()
+            await self._play_requested.wait()
+            self._play_requested.clear()
+            trace, self._trace = self._trace, None
+            await self._loop.run_in_executor(self._audio_executor, self.audio.play_audio, trace)
+            self._playing = False
+            if trace is not None:
+                trace.mark("playback_end")
+                if self.audio.latency_tracker is not None:
+                    self.audio.latency_tracker.finish(trace)
+
+
+
+
+
+
+##########################################################################################################
+#                           MAIN                                                                         #
+##########################################################################################################
+
+if __name__ == "__main__":
+
+    sensorType = sys.argv[1] if len(sys.argv) > 1 else "ultrasonic"
+
+    setup_logging(f'motion_detector_{datetime.utcnow():%Y%m%d_%H%M}.log', level=logging.DEBUG) #writes from a background thread
+    setup() #using BOARD pin numbers (not BCM)
+
+    buttonPin = 10 #connect button gpio to 10 and button ground to 9
+
+    ledPin = 16
+    ledMonitor = LED_Thread(ledPin=ledPin)
+    ledMonitor.set_on() #initally just on while device starting up
+
+    if sensorType == "pir":
+        motionPin = 12
+        motionSensor = MotionThread_IR(pin=motionPin, initial_delay=0.5, refresh_activation_limit=10) #refresh = 10 minutes
+    else:
+        echoPin = 35 #returns echo time
+        trigPin = 36 #triggers range detector observation
+        distThresh = 10 #distance change in cm to trigger motion detector
+        motionSensor = MotionThread(echoPin=echoPin, trigPin=trigPin, distThresh=distThresh, Nobs=20, initial_delay=0.5, refresh_activation_limit=10,
+                                    ranging_mode=os.environ.get("MOTION_RANGING", "edge"))
+
+    audioFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "soundsource.wav")
+    latencyTracker = LatencyTracker(report_file=f'latency_{datetime.utcnow():%Y%m%d_%H%M}.jsonl')
+    latencyTracker.start()
+    threadStats = ThreadStats(report_file=f'threads_{datetime.utcnow():%Y%m%d_%H%M}.jsonl', profile_file=os.environ.get("MOTION_PROFILE"))
+    threadStats.start()
+    audioPlayer = AudioThread(audio_file = audioFile, latency_tracker=latencyTracker)
+
+    AsyncRuntime(motionSensor, buttonPin, ledMonitor, audioPlayer).run()
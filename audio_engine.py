@@ -0,0 +1,138 @@
+#
+# In-process audio playback: WAV files are decoded into memory once and written straight to an ALSA PCM device
+# that stays open while the system is armed, so a trigger doesn't pay for spawning aplay, parsing the file and
+# opening the device every time.
+#
+# Needs pyalsaaudio (pip install pyalsaaudio); AudioThread falls back to aplay when it isn't available.
+
+import time
+import wave
+import threading
+import logging
+
+
+#WAV sample width (bytes) -> ALSA sample format name
+ALSA_FORMATS = {1: "PCM_FORMAT_U8", 2: "PCM_FORMAT_S16_LE", 3: "PCM_FORMAT_S24_3LE", 4: "PCM_FORMAT_S32_LE"}
+
+
+
+#decoded WAV file held in memory
+class WavClip:
+
+    def __init__(self, filename, channels, sampwidth, framerate, frames):
+        self.filename = filename
+        self.channels = channels
+        self.sampwidth = sampwidth #bytes per sample
+        self.framerate = framerate
+        self.frames = frames #raw interleaved PCM bytes
+
+    @property
+    def frame_size(self):
+        return self.channels*self.sampwidth
+
+    @property
+    def duration(self):
+        return len(self.frames)/self.frame_size/self.framerate
+
+    #PCM data in chunks of period_frames frames (the last one zero padded, as ALSA expects whole periods)
+    def iter_chunks(self, period_frames):
+        chunk_bytes = period_frames*self.frame_size
+        for i in range(0, len(self.frames), chunk_bytes):
+            chunk = self.frames[i:i + chunk_bytes]
+            if len(chunk) < chunk_bytes:
+                chunk += (b"\x80" if self.sampwidth == 1 else b"\x00")*(chunk_bytes - len(chunk))
+            yield chunk
+
+
+def load_wav(filename):
+    with wave.open(filename, "rb") as w:
+        return WavClip(filename, w.getnchannels(), w.getsampwidth(), w.getframerate(), w.readframes(w.getnframes()))
+
+
+
+#persistent ALSA output device
+class PCMPlayer:
+
+    #device: ALSA device name (as for aplay -D), period_frames: frames written per call (smaller = lower latency)
+    def __init__(self, device="hw:0,0", period_frames=512):
+        import alsaaudio #optional dependency, raises ImportError if missing
+        self._alsaaudio = alsaaudio
+
+        self.device = device
+        self.period_frames = period_frames
+        self._pcm = None
+        self._format = None #(channels, sampwidth, framerate) the device is open with
+        self._lock = threading.Lock() #held while writing so close() can't pull the device out mid-write
+        self._stop = False
+
+    @property
+    def is_open(self):
+        return self._pcm is not None
+
+    #opens (or reopens, if the format changed) the output device for clips in the given format
+    def open(self, channels, sampwidth, framerate):
+        with self._lock:
+            if self._pcm is not None and self._format == (channels, sampwidth, framerate):
+                return
+            if self._pcm is not None:
+                self._pcm.close()
+            else:
+                self._stop = False #a stop() before the device was closed doesn't carry over to its next use
+            logging.debug(f"opening PCM device {self.device} ({channels} ch, {8*sampwidth} bit, {framerate} Hz)")
+            self._pcm = self._alsaaudio.PCM(type=self._alsaaudio.PCM_PLAYBACK, mode=self._alsaaudio.PCM_NORMAL, device=self.device,
+                                            channels=channels, rate=framerate, format=getattr(self._alsaaudio, ALSA_FORMATS[sampwidth]),
+                                            periodsize=self.period_frames)
+            self._format = (channels, sampwidth, framerate)
+
+    def close(self):
+        with self._lock:
+            if self._pcm is not None:
+                logging.debug(f"closing PCM device {self.device}")
+                self._pcm.close()
+                self._pcm = None
+                self._format = None
+
+    #plays the clip, blocking until it has been heard (not just queued), returns False if stopped or closed first
+    #(also by a stop() that came just before)
+    #on_start: called right after the first period has been handed to the device
+    def play(self, clip, on_start=None):
+        self.open(clip.channels, clip.sampwidth, clip.framerate)
+        try:
+            return self._play(clip, on_start)
+        finally:
+            self._stop = False #the stop applied to this clip
+
+    def _play(self, clip, on_start):
+        started = None
+        frames = 0
+        for chunk in clip.iter_chunks(self.period_frames):
+            with self._lock:
+                if self._stop or self._pcm is None:
+                    return False
+                self._pcm.write(chunk)
+            frames += len(chunk)//(clip.channels*clip.sampwidth)
+            if started is None:
+                started = time.monotonic() #the device starts playing the first period right away
+                if on_start is not None:
+                    on_start()
+
+        #the last periods are still in the device buffer: waits until they have played (stop() still interrupts)
+        end = (started or time.monotonic()) + frames/clip.framerate
+        while not self._stop and self._pcm is not None:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return True
+            time.sleep(min(remaining, 0.05))
+        return False
+
+    #writes raw PCM in the format the device is open with (blocking while its buffer is full), False if it is closed
+    def write(self, data):
+        with self._lock:
+            if self._pcm is None:
+                return False
+            self._pcm.write(data)
+            return True
+
+    #stops the clip currently playing (from another thread)
+    def stop(self):
+        self._stop = True
@@ -0,0 +1,203 @@
+#
+# In-process software mixer: several clips playing at once over one persistent output stream
+#
+# Each playing clip is a Voice with its own gain, which can be faded (linear ramps, per sample) and cancelled. The
+# mixer thread sums the voices in NumPy one block of block_frames frames at a time, applies the master gain (for
+# ducking everything at once), clips to full scale and writes 16-bit PCM to the output device, which stays open.
+# Voices read their clip through iter_chunks, so memory-mapped clips from the ClipLibrary are streamed rather than
+# decoded up front. While nothing is playing the thread sleeps and writes nothing.
+#
+# Small blocks keep the trigger-to-sound latency down (512 frames = 11.6 ms at 44.1 kHz); mixing a block takes a
+# small fraction of its duration, so the device buffer stays full while voices play.
+#
+# Needs NumPy (imported when a Mixer is created, so it stays off the startup path of the other engines).
+
+import logging
+import threading
+
+
+#WAV sample width (bytes) -> NumPy sample type, offset and scale to [-1, 1)
+SAMPLE_TYPES = {1: ("u1", 128, 128), 2: ("<i2", 0, 32768), 4: ("<i4", 0, 2147483648)}
+
+
+
+class Voice:
+
+    def __init__(self, mixer, clip, gain, loop, fade_in, on_start, on_end):
+        if clip.sampwidth not in SAMPLE_TYPES:
+            raise ValueError(f"{clip.filename}: {8*clip.sampwidth} bit samples are not supported by the mixer")
+        if clip.framerate != mixer.framerate:
+            raise ValueError(f"{clip.filename}: {clip.framerate} Hz doesn't match the mixer's {mixer.framerate} Hz")
+        self.clip = clip
+        self.loop = loop
+        self.on_start = on_start #called from the mixer thread once the voice's first block is written
+        self.on_end = on_end #called from the mixer thread when it finishes (argument: True if it played to the end)
+        self.done = threading.Event()
+        self._mixer = mixer
+        self._chunks = clip.iter_chunks(mixer.block_frames)
+        self.gain = 0.0 if fade_in > 0 else gain
+        self._target = gain
+        self._step = 0.0 #gain change per frame while fading
+        self._stop_when_silent = False
+        self.cancelled = False
+        if fade_in > 0:
+            self.set_gain(gain, fade_in)
+
+    #ramps the gain to gain over fade seconds (0 = at once)
+    def set_gain(self, gain, fade=0.0):
+        with self._mixer._lock:
+            self._target = gain
+            frames = fade*self._mixer.framerate
+            self._step = (gain - self.gain)/frames if frames >= 1 else gain - self.gain
+
+    #fades out over fade seconds, then stops
+    def fade_out(self, fade):
+        self.set_gain(0.0, fade)
+        self._stop_when_silent = True
+
+    #stops at the next block (cut without a fade)
+    def cancel(self):
+        self.cancelled = True
+
+    #next block as float32 (frames, mixer channels) scaled by the gain ramp, None once the clip has ended
+    def _next_block(self, np):
+        mixer = self._mixer
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            if not self.loop:
+                return None
+            self._chunks = self.clip.iter_chunks(mixer.block_frames)
+            chunk = next(self._chunks)
+
+        dtype, offset, scale = SAMPLE_TYPES[self.clip.sampwidth]
+        samples = np.frombuffer(chunk, dtype=dtype).astype(np.float32).reshape(-1, self.clip.channels)
+        if offset:
+            samples -= offset
+        samples *= 1/scale
+        if self.clip.channels != mixer.channels:
+            samples = samples.mean(axis=1, keepdims=True) if mixer.channels == 1 else np.repeat(samples[:, :1], mixer.channels, axis=1)
+
+        if self.gain == self._target:
+            return samples*self.gain if self.gain != 1.0 else samples
+        ramp = self.gain + self._step*np.arange(1, len(samples) + 1) #float64, so it ends exactly on the target
+        ramp = np.minimum(ramp, self._target) if self._step > 0 else np.maximum(ramp, self._target)
+        self.gain = float(ramp[-1])
+        return samples*ramp[:, None]
+
+    @property
+    def finished(self):
+        return self.cancelled or (self._stop_when_silent and self.gain == 0.0 == self._target)
+
+
+
+class Mixer(threading.Thread):
+
+    #output: opened PCMPlayer-like device with open(channels, sampwidth, framerate) and write(data)
+    #channels, framerate: output format (16-bit samples), block_frames: frames mixed and written at a time
+    #max_voices: voices playing at once (the oldest is faded out to make room)
+    def __init__(self, output, channels, framerate, block_frames=512, max_voices=4):
+        super().__init__(name="mixer", daemon=True)
+        import numpy #optional dependency, raises ImportError if missing
+        self._np = numpy
+
+        self.output = output
+        self.channels = channels
+        self.framerate = framerate
+        self.block_frames = block_frames
+        self.max_voices = max_voices
+        self._voices = [] #oldest first
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self.master_gain = 1.0
+        self._master_target = 1.0
+        self._master_step = 0.0
+
+        self.output.open(channels, 2, framerate)
+
+    #starts playing clip (WavClip or MappedClip), returns its Voice
+    #gain: linear gain, loop: start over at the end until cancelled, fade_in: seconds to ramp up from silence
+    def play(self, clip, gain=1.0, loop=False, fade_in=0.0, on_start=None, on_end=None):
+        voice = Voice(self, clip, gain, loop, fade_in, on_start, on_end)
+        with self._lock:
+            playing = [v for v in self._voices if not v._stop_when_silent]
+            self._voices.append(voice)
+            self._wake.notify()
+        if len(playing) >= self.max_voices:
+            logging.debug(f"mixer full, fading out {playing[0].clip.filename}")
+            playing[0].fade_out(0.05)
+        return voice
+
+    #ramps the master gain (all voices) to gain over fade seconds, e.g. to duck everything under an announcement
+    def set_master_gain(self, gain, fade=0.0):
+        with self._lock:
+            self._master_target = gain
+            frames = fade*self.framerate
+            self._master_step = (gain - self.master_gain)/frames if frames >= 1 else gain - self.master_gain
+
+    #fades every voice out over fade seconds (0 cuts them at the next block)
+    def stop_all(self, fade=0.0):
+        with self._lock:
+            voices = list(self._voices)
+        for voice in voices:
+            if fade > 0:
+                voice.fade_out(fade)
+            else:
+                voice.cancel()
+
+    @property
+    def active(self):
+        with self._lock:
+            return len(self._voices)
+
+    def run(self):
+        np = self._np
+        logging.debug(f"starting mixer ({self.channels} ch, {self.framerate} Hz, {self.block_frames} frame blocks)")
+        out = np.empty((self.block_frames, self.channels), dtype=np.float32)
+        while True:
+            with self._lock:
+                while not self._voices:
+                    self._wake.wait() #nothing to play, nothing written
+                voices = list(self._voices)
+                master = self.master_gain
+                if master != self._master_target:
+                    ramp = master + self._master_step*np.arange(1, self.block_frames + 1)
+                    ramp = np.minimum(ramp, self._master_target) if self._master_step > 0 else np.maximum(ramp, self._master_target)
+                    self.master_gain = float(ramp[-1])
+                    master = ramp[:, None]
+
+            out.fill(0)
+            ended = []
+            started = []
+            for voice in voices:
+                if voice.finished:
+                    ended.append((voice, False))
+                    continue
+                block = voice._next_block(np)
+                if block is None:
+                    ended.append((voice, True)) #played to the end
+                    continue
+                out[:len(block)] += block
+                if voice.on_start is not None:
+                    started.append(voice)
+
+            if ended:
+                with self._lock:
+                    for voice, _ in ended:
+                        self._voices.remove(voice)
+
+            pcm = np.clip(out*master, -1.0, 32767/32768)
+            if not self.output.write((pcm*32768).astype("<i2").tobytes()):
+                logging.warning("mixer output closed, cancelling all voices")
+                self.stop_all()
+
+            for voice in started:
+                voice.on_start()
+                voice.on_start = None
+            for voice, completed in ended:
+                if voice.on_end is not None:
+                    try:
+                        voice.on_end(completed)
+                    except Exception:
+                        logging.exception("mixer voice callback failed")
+                voice.done.set()
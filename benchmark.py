@@ -0,0 +1,264 @@
+#! /usr/bin/env python3
+#
+# Offline benchmark of the detection pipeline: replays recorded range and PIR traces through the real
+# MotionThread.step (check_range_diff + check_activation) and MotionThread_IR.check_edge logic on the simulated GPIO
+# backend, with a virtual clock instead of wall-clock sleeps. Reports throughput, CPU cost per sample, detection
+# latency against labelled ground truth, and false positive/negative counts as JSON so speed and accuracy can be
+# compared between versions.
+#
+# Trace files are CSV, one sample per line ('#' comments ignored):
+#   ultrasonic: seconds,range_cm,label   (range_cm empty or nan = no echo)
+#   PIR:        seconds,level,label      (level 0/1, one line per sample or per change)
+# label is 1 while a real motion event is happening (optional, 0 if missing). Detections while an event is
+# happening (or within --tolerance seconds after it) count towards it, any others are false positives.
+# Binary .trc recordings from trace_recorder.py can be replayed too (without labels).
+#
+# usage: python3 benchmark.py [--ultrasonic FILE ...] [--pir FILE ...] [--synthetic MINUTES] [--output FILE]
+
+import sys
+import json
+import time
+import platform
+import argparse
+
+import numpy as np
+
+import trace_recorder
+import gpio_backend
+gpio_backend.set_backend(gpio_backend.SimulatedBackend()) #before the sensor modules touch GPIO
+
+from motion_detector import MotionThread, NO_ECHO
+from motion_detector_IR import MotionThread_IR
+
+
+
+
+
+##########################################################################################################
+#                           TRACES                                                                       #
+##########################################################################################################
+
+#returns (seconds, values, labels) arrays from a CSV trace, or from a binary TraceRecorder file (no labels;
+#range for ultrasonic recordings, the detected flag for PIR ones)
+def load_trace(filename, kind="ultrasonic"):
+    if filename.endswith(trace_recorder.EXTENSION):
+        samples = trace_recorder.read_trace(filename)
+        values = samples["range"] if kind == "ultrasonic" else samples["detected"]
+        return samples["time"] - samples["time"][0], values.astype(float), np.zeros(len(samples), dtype=bool)
+    
+    t, values, labels = [], [], []
+    with open(filename) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            fields = line.split(",")
+            t.append(float(fields[0]))
+            values.append(float(fields[1]) if fields[1].strip() else np.nan)
+            labels.append(int(fields[2]) if len(fields) > 2 and fields[2].strip() else 0)
+    return np.asarray(t), np.asarray(values), np.asarray(labels, dtype=bool)
+
+def save_trace(filename, t, values, labels):
+    with open(filename, "w") as f:
+        for ti, v, label in zip(t, values, labels):
+            f.write(f"{ti:.3f},{'' if np.isnan(v) else f'{v:.1f}'},{int(label)}\n")
+
+
+#ultrasonic trace at rate Hz: empty scene at ~150 cm with noise and dropped echoes, plus people stepping in front
+def synthetic_range_trace(minutes, rate=5, event_every=60, seed=0):
+    rng = np.random.default_rng(seed)
+    n = int(minutes*60*rate)
+    t = np.arange(n)/rate
+    ranges = 150 + rng.normal(0, 1.5, n)
+    labels = np.zeros(n, dtype=bool)
+    for start in np.arange(event_every/2, t[-1], event_every):
+        start += rng.uniform(-10, 10)
+        duration = rng.uniform(2, 8)
+        inside = (t >= start) & (t < start + duration)
+        ranges[inside] = rng.uniform(40, 90) + rng.normal(0, 2, inside.sum())
+        labels[inside] = True
+    ranges[rng.random(n) < 0.01] = np.nan #dropped echoes
+    ranges[rng.random(n) < 0.002] = 200 #spurious out of range readings
+    return t, np.round(ranges, 1), labels
+
+
+#PIR trace sampled at rate Hz: output HIGH for a few seconds per motion event, plus occasional glitches
+def synthetic_pir_trace(minutes, rate=20, event_every=60, seed=0):
+    rng = np.random.default_rng(seed)
+    n = int(minutes*60*rate)
+    t = np.arange(n)/rate
+    levels = np.zeros(n)
+    labels = np.zeros(n, dtype=bool)
+    for start in np.arange(event_every/2, t[-1], event_every):
+        start += rng.uniform(-10, 10)
+        duration = rng.uniform(2, 6)
+        inside = (t >= start) & (t < start + duration)
+        levels[inside] = 1
+        labels[inside] = True
+    levels[rng.random(n) < 0.0005] = 1 #single-sample glitches
+    return t, levels, labels
+
+
+#contiguous labelled runs as (start, end) seconds
+def label_events(t, labels):
+    events = []
+    start = None
+    for ti, label in zip(t, labels):
+        if label and start is None:
+            start = ti
+        elif not label and start is not None:
+            events.append((start, ti))
+            start = None
+    if start is not None:
+        events.append((start, t[-1]))
+    return events
+
+
+
+
+
+##########################################################################################################
+#                           REPLAY                                                                       #
+##########################################################################################################
+
+#MotionThread whose range measurements come from a recorded trace instead of the echo pin
+class ReplayMotionThread(MotionThread):
+
+    def __init__(self, ranges, **params):
+        super().__init__(echoPin=1, trigPin=2, **params)
+        self._ranges = ranges.tolist()
+        self.position = 0 #index of the trace sample the next ping reads
+
+    def get_range(self):
+        distance_cm = self._ranges[self.position]
+        return NO_ECHO if distance_cm != distance_cm else distance_cm
+
+
+#matches detection times against labelled events
+def score(detections, events, tolerance):
+    latencies = []
+    matched = [False]*len(events)
+    false_positives = 0
+    for d in detections:
+        for i, (start, end) in enumerate(events):
+            if start <= d <= end + tolerance:
+                if not matched[i]:
+                    matched[i] = True
+                    latencies.append(d - start)
+                break
+        else:
+            false_positives += 1
+    latencies = np.asarray(latencies)*1000
+    return {"events": len(events), "detections": len(detections), "true_positives": int(sum(matched)),
+            "false_positives": false_positives, "false_negatives": len(events) - int(sum(matched)),
+            "latency_ms": {"mean": float(latencies.mean()) if len(latencies) else None,
+                           "p50": float(np.median(latencies)) if len(latencies) else None,
+                           "max": float(latencies.max()) if len(latencies) else None}}
+
+
+def timing(samples, cpu, wall):
+    return {"samples": samples, "cpu_s": cpu, "wall_s": wall, "samples_per_s": samples/cpu if cpu > 0 else None,
+            "cpu_us_per_sample": 1e6*cpu/samples if samples else None}
+
+
+#runs an ultrasonic trace through MotionThread.step; the main loop's acknowledgement (deactivate) is immediate
+#(adaptive: trace samples that fall before the sensor's next_period are skipped, as if they were never measured)
+def bench_ultrasonic(t, ranges, labels, distThresh=10, Nobs=20, refresh_activation_limit=0, tolerance=1.0, **params):
+    sensor = ReplayMotionThread(ranges, distThresh=distThresh, Nobs=Nobs, initial_delay=0,
+                                refresh_activation_limit=refresh_activation_limit, **params)
+    nows = t.tolist() #virtual time.monotonic() values, built outside the timed loop
+    sensor.set_activation_time(0, now=nows[0])
+
+    detections = []
+    pings = 0
+    next_due = t[0]
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    for i, now in enumerate(nows):
+        if sensor.adaptive:
+            if t[i] < next_due - 1e-6:
+                continue
+            next_due = t[i] + sensor.next_period(now)
+        sensor.position = i
+        pings += 1
+        if sensor.step(now):
+            detections.append(t[i])
+            sensor.deactivate()
+    cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+
+    result = dict(timing(pings, cpu, wall), **score(detections, label_events(t, labels), tolerance))
+    result["trace_samples"] = len(t)
+    return result
+
+
+#runs the rising edges of a PIR trace through MotionThread_IR.check_edge (the edge-triggered run loop's logic)
+def bench_pir(t, levels, labels, refresh_activation_limit=0, tolerance=1.0):
+    sensor = MotionThread_IR(pin=3, initial_delay=0, refresh_activation_limit=refresh_activation_limit)
+    rising = np.flatnonzero((levels[1:] > 0.5) & (levels[:-1] <= 0.5)) + 1
+    nows = t[rising].tolist()
+    sensor.set_activation_time(0, now=float(t[0]))
+
+    detections = []
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    for i, now in zip(rising, nows):
+        if sensor.check_edge(now, now=now):
+            detections.append(t[i])
+            sensor.deactivate()
+    cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+
+    #only edges reach the detection logic, so throughput is per edge
+    result = dict(timing(len(rising), cpu, wall), **score(detections, label_events(t, labels), tolerance))
+    result["trace_samples"] = len(t)
+    return result
+
+
+
+
+
+##########################################################################################################
+#                           MAIN                                                                         #
+##########################################################################################################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Replay sensor traces through the detection pipeline")
+    parser.add_argument("--ultrasonic", nargs="*", default=[], help="ultrasonic range traces (CSV)")
+    parser.add_argument("--pir", nargs="*", default=[], help="PIR traces (CSV)")
+    parser.add_argument("--synthetic", type=float, default=0, help="also run synthetic traces of this many minutes")
+    parser.add_argument("--dist-thresh", type=float, default=10, help="distThresh (cm)")
+    parser.add_argument("--nobs", type=int, default=20, help="Nobs")
+    parser.add_argument("--refresh", type=float, default=0, help="refresh_activation_limit (minutes)")
+    parser.add_argument("--robust", action="store_true", help="use the median baseline")
+    parser.add_argument("--adaptive", action="store_true", help="adaptive sampling (skips trace samples while idle)")
+    parser.add_argument("--detector", default="mean", choices=["mean", "ewma", "cusum"], help="detection rule")
+    parser.add_argument("--tolerance", type=float, default=1.0, help="seconds after an event a detection still counts")
+    parser.add_argument("--output", help="write results JSON here (default stdout)")
+    args = parser.parse_args()
+
+    params = {"distThresh": args.dist_thresh, "Nobs": args.nobs, "refresh_activation_limit": args.refresh,
+              "robust_baseline": args.robust, "adaptive": args.adaptive, "detector": args.detector}
+
+    traces = [("ultrasonic", f, load_trace(f)) for f in args.ultrasonic] + [("pir", f, load_trace(f, "pir")) for f in args.pir]
+    if args.synthetic:
+        traces.append(("ultrasonic", "synthetic", synthetic_range_trace(args.synthetic)))
+        traces.append(("pir", "synthetic", synthetic_pir_trace(args.synthetic)))
+    if not traces:
+        parser.error("no traces given (use --ultrasonic, --pir or --synthetic)")
+
+    results = []
+    for kind, name, (t, values, labels) in traces:
+        if kind == "ultrasonic":
+            result = bench_ultrasonic(t, values, labels, tolerance=args.tolerance, **params)
+        else:
+            result = bench_pir(t, values, labels, refresh_activation_limit=args.refresh, tolerance=args.tolerance)
+        results.append(dict({"sensor": kind, "trace": name}, **result))
+        print(f"{kind:10s} {name}: {result['samples_per_s']:.0f} samples/s, {result['cpu_us_per_sample']:.1f} us/sample, "
+              f"TP {result['true_positives']}/{result['events']}, FP {result['false_positives']}, FN {result['false_negatives']}",
+              file=sys.stderr)
+
+    report = {"time": time.time(), "python": platform.python_version(), "machine": platform.machine(),
+              "params": params, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
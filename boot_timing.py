@@ -0,0 +1,34 @@
+#
+# Startup cost reporting: time from process start until the system is armed, and peak memory use, logged once at
+# startup so regressions (e.g. a heavy import creeping back into the runtime path) show up in the log.
+
+import os
+import sys
+import time
+import logging
+import resource
+
+
+_imported = time.monotonic() #fallback start time where /proc isn't available
+
+
+#seconds since the process was started (including interpreter startup and imports)
+def process_uptime():
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19]) #field 22, after the parenthesised command name
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks/os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _imported
+
+
+#peak resident set size of this process in kB (ru_maxrss is kB on Linux)
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def log_armed():
+    logging.info(f"boot-to-armed {process_uptime():.2f} s, peak RSS {peak_rss_kb()/1024:.1f} MB"
+                 f"{' (numpy loaded)' if 'numpy' in sys.modules else ''}")
@@ -0,0 +1,153 @@
+#
+# Library of sound clips to choose from (at random or in rotation) on each trigger
+#
+# Short clips are kept as decoded PCM in an LRU cache limited to memory_budget bytes. Clips whose audio data is
+# larger than stream_threshold bytes are never decoded into RAM: they are memory-mapped and streamed to the
+# output device in chunks straight from the page cache. Hit/miss/eviction counters help size the budget.
+
+import os
+import mmap
+import random
+import struct
+import logging
+import threading
+from collections import OrderedDict
+
+from audio_engine import load_wav
+
+
+
+#WAV file memory-mapped from disk, played in chunks without decoding the whole file
+class MappedClip:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.channels, self.sampwidth, self.framerate, self._offset, self._length = parse_wav_header(self._mm, filename)
+
+    @property
+    def frame_size(self):
+        return self.channels*self.sampwidth
+
+    @property
+    def duration(self):
+        return self._length/self.frame_size/self.framerate
+
+    #PCM data in chunks of period_frames frames (the last one zero padded, as ALSA expects whole periods)
+    def iter_chunks(self, period_frames):
+        chunk_bytes = period_frames*self.frame_size
+        end = self._offset + self._length
+        for i in range(self._offset, end, chunk_bytes):
+            chunk = self._mm[i:min(i + chunk_bytes, end)]
+            if len(chunk) < chunk_bytes:
+                chunk += (b"\x80" if self.sampwidth == 1 else b"\x00")*(chunk_bytes - len(chunk))
+            yield chunk
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+
+#walks the RIFF chunks of a WAV file, returns (channels, sampwidth, framerate, data offset, data length)
+def parse_wav_header(buf, filename=""):
+    if buf[0:4] != b"RIFF" or buf[8:12] != b"WAVE":
+        raise ValueError(f"{filename} is not a WAV file")
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(buf):
+        chunk_id = buf[pos:pos + 4]
+        chunk_size, = struct.unpack("<I", buf[pos + 4:pos + 8])
+        if chunk_id == b"fmt ":
+            audio_format, channels, framerate, _, _, bits = struct.unpack("<HHIIHH", buf[pos + 8:pos + 24])
+            if audio_format not in (1, 0xFFFE): #PCM or WAVE_FORMAT_EXTENSIBLE
+                raise ValueError(f"{filename} is not PCM encoded (format {audio_format})")
+            fmt = (channels, bits//8, framerate)
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise ValueError(f"{filename} has no fmt chunk before its data")
+            return fmt + (pos + 8, min(chunk_size, len(buf) - pos - 8))
+        pos += 8 + chunk_size + (chunk_size & 1) #chunks are word aligned
+    raise ValueError(f"{filename} has no data chunk")
+
+
+
+class ClipLibrary:
+
+    #files: WAV files to choose from, order: "random" or "rotate"
+    #memory_budget: max bytes of decoded PCM kept in the cache, stream_threshold: files larger than this are streamed
+    def __init__(self, files, memory_budget=32*1024*1024, stream_threshold=4*1024*1024, order="random"):
+        if not files:
+            raise ValueError("clip library needs at least one file")
+        if order not in ("random", "rotate"):
+            raise ValueError(f"unknown clip order {order!r} (expected 'random' or 'rotate')")
+        self.files = list(files)
+        self.memory_budget = memory_budget
+        self.stream_threshold = stream_threshold
+        self.order = order
+
+        self._lock = threading.Lock()
+        self._next = 0
+        self._cache = OrderedDict() #filename -> WavClip, least recently used first
+        self._cached_bytes = 0
+        self._mapped = {} #filename -> MappedClip (the mapping costs page cache, not process memory)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.streamed = 0
+
+    #filename of the clip to play next
+    def next_filename(self):
+        with self._lock:
+            if self.order == "random":
+                return random.choice(self.files)
+            filename = self.files[self._next]
+            self._next = (self._next + 1) % len(self.files)
+            return filename
+
+    def next_clip(self):
+        return self.get(self.next_filename())
+
+    #clip for filename: decoded from the cache (loading it on a miss) or memory-mapped if it is large
+    def get(self, filename):
+        with self._lock:
+            if filename in self._mapped:
+                self.streamed += 1
+                return self._mapped[filename]
+            clip = self._cache.get(filename)
+            if clip is not None:
+                self.hits += 1
+                self._cache.move_to_end(filename)
+                return clip
+
+            if os.path.getsize(filename) > self.stream_threshold:
+                clip = self._mapped[filename] = MappedClip(filename)
+                self.streamed += 1
+                return clip
+
+            self.misses += 1
+            clip = load_wav(filename)
+            self._cache[filename] = clip
+            self._cached_bytes += len(clip.frames)
+
+            #evict least recently used clips until within budget (keeping the one just loaded)
+            while self._cached_bytes > self.memory_budget and len(self._cache) > 1:
+                old_filename, old_clip = self._cache.popitem(last=False)
+                self._cached_bytes -= len(old_clip.frames)
+                self.evictions += 1
+                logging.debug(f"evicted {old_filename} from clip cache")
+            return clip
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "streamed": self.streamed,
+                    "cached_clips": len(self._cache), "cached_bytes": self._cached_bytes, "memory_budget": self.memory_budget}
+
+    def close(self):
+        with self._lock:
+            for clip in self._mapped.values():
+                clip.close()
+            self._mapped.clear()
+            self._cache.clear()
+            self._cached_bytes = 0
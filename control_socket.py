@@ -0,0 +1,195 @@
+#! /usr/bin/env python3
+#
+# Local control socket: live status and parameter changes without restarting (and losing the learned baseline)
+#
+# ControlServer listens on a Unix-domain socket and answers one-line commands with one line of JSON
+# ({"ok": true, ...} or {"ok": false, "error": ...}):
+#   status                          mode, sensor state (range, baseline, last activation, ...), volume, thread health
+#   set <name> <value> [...]        distThresh, Nobs, initial_delay, refresh_activation_limit (minutes) and volume (%);
+#                                   every value is checked first and the sensor ones are applied together between two samples
+#   arm / disarm                    same as the button's reactivate / deactivate gestures
+#   test                            plays the audio once
+#   help
+#
+# usage: python3 control_socket.py [--socket PATH] <command> [args ...]
+#   e.g. python3 control_socket.py set distThresh 12 Nobs 30
+
+import os
+import sys
+import json
+import math
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+
+from event_bus import BUTTON_GESTURE
+
+
+DEFAULT_SOCKET = os.environ.get("MOTION_CONTROL_SOCKET", "/tmp/motion_detector.sock")
+
+SENSOR_PARAMS = {"distThresh": float, "Nobs": int, "initial_delay": float, "refresh_activation_limit": float}
+COMMANDS = ["status", "set <name> <value> ...", "arm", "disarm", "test", "help"]
+
+
+
+##########################################################################################################
+#                           SERVER                                                                       #
+##########################################################################################################
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode("utf-8", "replace").strip()
+            if not line:
+                continue
+            try:
+                reply = self.server.control.handle_command(line)
+                reply = {"ok": True, **reply}
+            except (ValueError, TypeError) as e:
+                reply = {"ok": False, "error": str(e)}
+            except Exception as e:
+                logging.exception(f"control command {line!r} failed")
+                reply = {"ok": False, "error": repr(e)}
+            self.wfile.write((json.dumps(_json_safe(reply), allow_nan=False) + "\n").encode())
+
+
+
+#reply -> strictly valid JSON values: NaN/inf (e.g. the range before the first reading) become None, other objects
+#their str
+def _json_safe(value):
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {str(k): _json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(v) for v in value]
+    if value is None or isinstance(value, (str, int, bool)):
+        return value
+    return str(value)
+
+
+
+class ControlServer(threading.Thread):
+
+    #sensor: MotionThread, MotionThread_IR or SensorScheduler, audio: AudioThread
+    #event_bus: arm/disarm are published on it as button gestures, so the main loop handles them as usual
+    #threads: {name: thread} reported as alive or not by status (defaults to sensor and audio)
+    def __init__(self, sensor, audio, event_bus, path=DEFAULT_SOCKET, threads=None):
+        super().__init__(name="control-socket", daemon=True)
+        self.sensor = sensor
+        self.audio = audio
+        self.event_bus = event_bus
+        self.path = path
+        self.threads = threads if threads is not None else {"sensor": sensor, "audio": audio}
+
+        if os.path.exists(path):
+            _remove_stale_socket(path)
+        old_umask = os.umask(0o117) #the socket is created rw for owner and group only, never world-writable
+        try:
+            self._server = socketserver.ThreadingUnixStreamServer(path, _Handler)
+        finally:
+            os.umask(old_umask)
+        self._server.daemon_threads = True
+        self._server.control = self
+
+    def run(self):
+        logging.info(f"control socket listening on {self.path}")
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+    #one command line -> reply dict (raises ValueError for bad commands)
+    def handle_command(self, line):
+        command, *args = line.split()
+        if command == "status":
+            return self.status()
+        if command == "set":
+            return self.set(args)
+        if command in ("arm", "disarm"):
+            logging.info(f"control socket: {command}")
+            self.event_bus.publish(BUTTON_GESTURE, status=1 if command == "arm" else 2, source="control")
+            return {}
+        if command == "test":
+            logging.info("control socket: test playback")
+            self.audio.request_play_audio()
+            return {}
+        if command == "help":
+            return {"commands": COMMANDS, "params": list(SENSOR_PARAMS) + ["volume"]}
+        raise ValueError(f"unknown command {command!r}")
+
+    def status(self):
+        return {"mode": "disarmed" if self.sensor.standby else "armed", "sensor": self.sensor.get_state(),
+                "audio": self.audio.get_state(), "threads": {name: thread.is_alive() for name, thread in self.threads.items()}}
+
+    #"set name value ..." -> every value is parsed before anything changes
+    def set(self, args):
+        if not args or len(args) % 2:
+            raise ValueError("usage: set <name> <value> [<name> <value> ...]")
+        params = {}
+        volume = None
+        for name, value in zip(args[::2], args[1::2]):
+            if name == "volume":
+                volume = float(value)
+                if not 0 <= volume <= 100:
+                    raise ValueError(f"invalid volume {volume!r} (must be 0-100)")
+            elif name in SENSOR_PARAMS:
+                params[name] = SENSOR_PARAMS[name](value)
+            else:
+                raise ValueError(f"unknown parameter {name!r} (expected one of {', '.join(list(SENSOR_PARAMS) + ['volume'])})")
+
+        if params:
+            self.sensor.set_params(**params)
+        if volume is not None:
+            self.audio.set_volume(volume)
+        return {"applied": {**params, **({} if volume is None else {"volume": volume})}}
+
+
+
+
+
+#removes a socket file left over from a previous run, raises OSError if another instance is still listening on it
+def _remove_stale_socket(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            os.unlink(path) #nobody listening
+            return
+    raise OSError(f"control socket {path} is in use by another running instance")
+
+
+
+
+
+##########################################################################################################
+#                           CLIENT                                                                       #
+##########################################################################################################
+
+#sends one command line, returns the decoded reply
+def send_command(line, path=DEFAULT_SOCKET, timeout=5):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(line.encode() + b"\n")
+        reply = sock.makefile("rb").readline()
+    return json.loads(reply)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Query or adjust a running motion detector")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help=f"control socket (default {DEFAULT_SOCKET})")
+    parser.add_argument("command", nargs="+", help=" | ".join(COMMANDS))
+    args = parser.parse_args()
+
+    reply = send_command(" ".join(args.command), args.socket)
+    print(json.dumps(reply, indent=2))
+    sys.exit(0 if reply.get("ok") else 1)
@@ -0,0 +1,89 @@
+#
+# Shared deadline scheduler on time.monotonic()
+#
+# One thread sleeps until the earliest pending deadline and runs its callback, so activation delays ending
+# ("armed", "cooldown expired") and LED blinks happen on time without every loop waking up to check the clock.
+# Deadlines are monotonic, so NTP adjusting the wall clock never moves them. Pending timers sit in a heap (there
+# are only ever a handful); cancelled ones are dropped when they come up. Callbacks run on the scheduler thread
+# and must return quickly.
+
+import time
+import heapq
+import logging
+import itertools
+import threading
+from thread_stats import count_iteration
+from datetime import datetime, timedelta
+
+
+#UTC datetime of an earlier time.monotonic() reading (for logs and status reports)
+def wall_time(monotonic_time):
+    return datetime.utcnow() - timedelta(seconds=time.monotonic() - monotonic_time)
+
+
+
+class Timer:
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline #time.monotonic() it is due at
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+
+class DeadlineScheduler(threading.Thread):
+
+    def __init__(self):
+        super().__init__(name="deadlines", daemon=True)
+        self._cond = threading.Condition()
+        self._heap = [] #(deadline, seq, Timer)
+        self._seq = itertools.count() #keeps timers with the same deadline in order
+        self._stopping = False
+
+    #runs callback() on the scheduler thread at the monotonic time deadline (right away if it has passed)
+    def call_at(self, deadline, callback):
+        timer = Timer(deadline, callback)
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, next(self._seq), timer))
+            if self._heap[0][2] is timer:
+                self._cond.notify() #new earliest deadline
+        return timer
+
+    def call_later(self, delay, callback):
+        return self.call_at(time.monotonic() + delay, callback)
+
+    def pending(self):
+        with self._cond:
+            return sum(not timer.cancelled for _, _, timer in self._heap)
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+
+    def run(self):
+        logging.debug("starting deadline scheduler")
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    while self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    remaining = self._heap[0][0] - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._stopping:
+                    return
+                timer = heapq.heappop(self._heap)[2]
+
+            count_iteration()
+            try:
+                timer.callback()
+            except Exception:
+                logging.exception("deadline callback failed")
@@ -0,0 +1,203 @@
+#
+# Streaming motion detectors for the ultrasonic range readings
+#
+# A detector sees one range (cm, NaN for no echo) at a time through update(), which returns whether that sample
+# counts as motion, and costs O(1) per sample. baseline is the range it currently expects and snapshot() returns
+# its internal state for logging. make_detector() builds one by name:
+#   mean   the original rule: |range - mean (or median) of the last Nobs ranges| >= distThresh
+#   ewma   |range - exponentially weighted mean| >= max(distThresh, k*EW standard deviation); adapts smoothly
+#          and ignores noise bursts that a short window would follow
+#   cusum  two-sided cumulative sum of deviations from an EW mean beyond a drift allowance; large jumps are
+#          caught on the first sample and a gradual approach adds up over a few samples instead of being absorbed
+#          into the baseline
+# NaN samples never detect and leave the EWMA/CUSUM state unchanged.
+
+import math
+
+from rolling_stats import RollingStats
+
+
+class Detector:
+
+    name = None
+    window = None #RollingStats of recent ranges if the detector keeps one
+
+    #returns True if value counts as motion, then folds it into the baseline
+    def update(self, value):
+        raise NotImplementedError
+
+    @property
+    def baseline(self):
+        raise NotImplementedError
+
+    def snapshot(self):
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+    #applies a new distThresh/Nobs keeping the learned baseline (parameters derived from them are derived again,
+    #parameters given explicitly to the constructor are kept)
+    def configure(self, distThresh, Nobs):
+        raise NotImplementedError
+
+
+
+class MeanThresholdDetector(Detector):
+
+    name = "mean"
+
+    def __init__(self, distThresh, Nobs, robust=False):
+        self.distThresh = distThresh
+        self.window = RollingStats(Nobs, robust=robust)
+
+    def update(self, value):
+        detected = abs(value - self.window.center()) >= self.distThresh #False for NaN value or empty window
+        self.window.push(value)
+        return detected
+
+    @property
+    def baseline(self):
+        return self.window.center()
+
+    def snapshot(self):
+        return {"detector": self.name, "baseline": self.baseline, "std": self.window.std(), "count": self.window.count,
+                "distThresh": self.distThresh}
+
+    def reset(self):
+        self.window.clear()
+
+    def configure(self, distThresh, Nobs):
+        self.distThresh = distThresh
+        if Nobs != self.window.capacity:
+            self.window.resize(Nobs)
+
+
+
+class EWMADetector(Detector):
+
+    name = "ewma"
+
+    #alpha: weight of each new sample (default 2/(Nobs + 1), the same span as the Nobs window)
+    #k: deviation threshold in EW standard deviations (the threshold is never below distThresh)
+    #warmup: samples before detections start
+    def __init__(self, distThresh, Nobs=20, alpha=None, k=4.0, warmup=None):
+        self.distThresh = distThresh
+        self._given = set() if alpha is None else {"alpha"} #kept by configure()
+        self.alpha = 2/(Nobs + 1) if alpha is None else alpha
+        self.k = k
+        self.warmup = Nobs if warmup is None else warmup
+        self.reset()
+
+    def reset(self):
+        self.mean = math.nan
+        self.var = 0.0
+        self.count = 0
+
+    def configure(self, distThresh, Nobs):
+        self.distThresh = distThresh
+        if "alpha" not in self._given:
+            self.alpha = 2/(Nobs + 1)
+
+    def update(self, value):
+        if value != value: #NaN
+            return False
+        if self.count == 0:
+            self.mean = value
+            self.count = 1
+            return False
+
+        diff = value - self.mean
+        detected = self.count >= self.warmup and abs(diff) >= max(self.distThresh, self.k*math.sqrt(self.var))
+        #West's incremental EW mean/variance
+        incr = self.alpha*diff
+        self.mean += incr
+        self.var = (1 - self.alpha)*(self.var + diff*incr)
+        self.count += 1
+        return detected
+
+    @property
+    def baseline(self):
+        return self.mean
+
+    def snapshot(self):
+        return {"detector": self.name, "mean": self.mean, "std": math.sqrt(self.var), "count": self.count,
+                "threshold": max(self.distThresh, self.k*math.sqrt(self.var))}
+
+
+
+class CUSUMDetector(Detector):
+
+    name = "cusum"
+
+    #drift: deviation (cm) per sample tolerated as noise (default distThresh/4)
+    #threshold: cumulative deviation (cm) that signals motion (default distThresh)
+    #alpha: weight of each new sample in the reference mean (default 2/(Nobs + 1))
+    #warmup: samples before detections start
+    def __init__(self, distThresh, Nobs=20, drift=None, threshold=None, alpha=None, warmup=None):
+        self._given = {name for name, value in (("drift", drift), ("threshold", threshold), ("alpha", alpha))
+                       if value is not None} #kept by configure()
+        self.drift = distThresh/4 if drift is None else drift
+        self.threshold = distThresh if threshold is None else threshold
+        self.alpha = 2/(Nobs + 1) if alpha is None else alpha
+        self.warmup = Nobs if warmup is None else warmup
+        self.reset()
+
+    def reset(self):
+        self.mean = math.nan
+        self.high = 0.0 #accumulated evidence the range went up
+        self.low = 0.0 #... or down
+        self.count = 0
+
+    def configure(self, distThresh, Nobs):
+        if "drift" not in self._given:
+            self.drift = distThresh/4
+        if "threshold" not in self._given:
+            self.threshold = distThresh
+        if "alpha" not in self._given:
+            self.alpha = 2/(Nobs + 1)
+
+    def update(self, value):
+        if value != value: #NaN
+            return False
+        if self.count == 0:
+            self.mean = value
+            self.count = 1
+            return False
+
+        diff = value - self.mean
+        self.high = max(0.0, self.high + diff - self.drift)
+        self.low = max(0.0, self.low - diff - self.drift)
+        detected = False
+        if self.high >= self.threshold or self.low >= self.threshold:
+            detected = self.count >= self.warmup
+            self.high = self.low = 0.0 #restart accumulating from the new level
+        self.mean += self.alpha*diff
+        self.count += 1
+        return detected
+
+    @property
+    def baseline(self):
+        return self.mean
+
+    def snapshot(self):
+        return {"detector": self.name, "mean": self.mean, "high": self.high, "low": self.low, "count": self.count,
+                "threshold": self.threshold}
+
+
+
+DETECTORS = {"mean": MeanThresholdDetector, "ewma": EWMADetector, "cusum": CUSUMDetector}
+
+
+#detector by name ("mean", "ewma" or "cusum"), extra params go to its constructor
+#robust (median baseline) only applies to "mean", which takes no other params
+def make_detector(name, distThresh, Nobs, robust=False, **params):
+    if name not in DETECTORS:
+        raise ValueError(f"unknown detector {name!r} (expected one of {', '.join(DETECTORS)})")
+    if name == "mean":
+        if params:
+            raise ValueError(f"the mean detector takes no detector params (got {', '.join(params)})")
+        return MeanThresholdDetector(distThresh, Nobs, robust=robust)
+    if robust:
+        raise ValueError(f"robust only applies to the mean detector, not {name!r}")
+    return DETECTORS[name](distThresh, Nobs, **params)
@@ -0,0 +1,101 @@
+#
+# Thread-safe event bus connecting the sensor, button, audio and main loop threads
+#
+# Publishers call publish() from any thread; each subscriber has its own queue and blocks in get() until an
+# event arrives, so consumers wake as soon as something happens instead of polling flags on a fixed period.
+
+import math
+import time
+import queue
+import threading
+import logging
+from collections import namedtuple
+
+
+#event types
+MOTION_DETECTED = "motion_detected" #sensor activation (data: source)
+BUTTON_GESTURE = "button_gesture" #button released (data: status = 1 reactivate, 2 deactivate, 3 power off; duration)
+PLAYBACK_STARTED = "playback_started"
+PLAYBACK_FINISHED = "playback_finished" #data: returncode
+MODE_CHANGE = "mode_change" #sensor delay_status or system mode changed (data: source and new value)
+
+#time is time.monotonic() when the event was published, data is a dict of event-specific fields
+Event = namedtuple("Event", ["type", "time", "data"])
+
+
+#JSON-ready dict of an event for storing or shipping: wall-clock time, objects such as latency traces reduced to
+#their id/str, and NaN/inf (not valid JSON) to None
+def to_record(event):
+    data = {}
+    for key, value in event.data.items():
+        if key == "trace":
+            value = None if value is None else value.id
+        elif isinstance(value, float) and not math.isfinite(value):
+            value = None
+        elif not isinstance(value, (str, int, float, bool, type(None))):
+            value = str(value)
+        data[key] = value
+    return {"type": event.type, "time": time.time() - (time.monotonic() - event.time), "data": data}
+
+
+
+class Subscription:
+
+    def __init__(self, bus, types, maxsize):
+        self._bus = bus
+        self.types = types #set of event types to receive (None for all)
+        self._queue = queue.Queue(maxsize)
+        self.dropped = 0 #events dropped because the queue was full
+
+    #blocks until the next event (or returns None after timeout seconds)
+    def get(self, timeout=None):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    #queues item for this subscriber only, waiting up to timeout seconds for room (for a stop sentinel that mustn't
+    #be dropped like a published event), returns whether it was queued
+    def put(self, item, timeout=1.0):
+        try:
+            self._queue.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            return False
+
+    def _deliver(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self._bus.unsubscribe(self)
+
+
+
+class EventBus:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = ()
+
+    #types: iterable of event types to receive (all if None), maxsize: 0 for an unbounded queue
+    def subscribe(self, types=None, maxsize=0):
+        subscription = Subscription(self, None if types is None else set(types), maxsize)
+        with self._lock:
+            self._subscriptions = self._subscriptions + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions = tuple(s for s in self._subscriptions if s is not subscription)
+
+    #never blocks: subscriptions are an immutable tuple (no lock to read) and full queues drop the event
+    def publish(self, event_type, **data):
+        event = Event(event_type, time.monotonic(), data)
+        for subscription in self._subscriptions:
+            if subscription.types is None or event_type in subscription.types:
+                subscription._deliver(event)
+        logging.debug(f"event {event_type} {data}")
+        return event
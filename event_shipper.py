@@ -0,0 +1,231 @@
+#! /usr/bin/env python3
+#
+# Ships activation, button and health events from a board to a central aggregator (aggregator.py)
+#
+# EventShipper subscribes to the event bus with a bounded queue, so publishing never blocks the sensor, button or
+# audio threads: when the queue is full new events are dropped and counted. Its own thread collects events into
+# batches (up to batch_size events, or whatever arrived within batch_interval seconds), and sends each batch as one
+# zlib-compressed JSON frame:
+#   b"MDEV" + uint32 payload length (big endian) + zlib(JSON {"board", "seq", "events": [...]})
+# over UDP (one datagram per frame, batches split to stay under max_datagram bytes) or a persistent TCP connection.
+# Failed sends are retried with exponential backoff (doubling from retry_delay up to max_retry_delay, with jitter);
+# at most max_pending frames wait for a retry, the oldest is dropped beyond that. A health event (uptime, memory,
+# queue drops, send failures) is added every health_interval seconds.
+#
+# usage (load test): python3 event_shipper.py tcp://127.0.0.1:9510 --bench 100000
+
+import sys
+import json
+import time
+import zlib
+import random
+import socket
+import struct
+import logging
+import argparse
+import threading
+from collections import deque
+
+from event_bus import MOTION_DETECTED, BUTTON_GESTURE, MODE_CHANGE, PLAYBACK_FINISHED, to_record
+from boot_timing import process_uptime, peak_rss_kb
+
+
+MAGIC = b"MDEV"
+HEADER = struct.Struct("!4sI") #magic, payload length
+MAX_DECODED = 64*1024*1024 #largest decompressed payload accepted (guards the aggregator against zlib bombs)
+HEALTH = "health"
+SHIPPED_TYPES = (MOTION_DETECTED, BUTTON_GESTURE, MODE_CHANGE, PLAYBACK_FINISHED)
+
+
+#"udp://host:port" or "tcp://host:port" -> (protocol, (host, port))
+def parse_target(target):
+    protocol, _, address = target.partition("://")
+    host, _, port = address.rpartition(":")
+    if protocol not in ("udp", "tcp") or not host or not port.isdigit():
+        raise ValueError(f"bad aggregator address {target!r} (expected udp://host:port or tcp://host:port)")
+    return protocol, (host, int(port))
+
+
+def encode_frame(board, seq, events):
+    payload = zlib.compress(json.dumps({"board": board, "seq": seq, "events": events}, separators=(",", ":"),
+                                       default=str).encode())
+    return HEADER.pack(MAGIC, len(payload)) + payload
+
+
+#-> {"board", "seq", "events"}, raises ValueError for anything that isn't a frame
+def decode_payload(payload):
+    try:
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(payload, MAX_DECODED)
+        if decompressor.unconsumed_tail:
+            raise ValueError(f"payload decompresses to more than {MAX_DECODED} bytes")
+        return json.loads(data)
+    except (zlib.error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"bad event frame ({e})")
+
+
+
+class EventShipper(threading.Thread):
+
+    #target: "udp://host:port" or "tcp://host:port", board: name of this board (default: host name)
+    #types: event types shipped, queue_size: events buffered before new ones are dropped
+    def __init__(self, event_bus, target, board=None, types=SHIPPED_TYPES, queue_size=10000, batch_size=500,
+                 batch_interval=1.0, health_interval=60, retry_delay=0.5, max_retry_delay=60, max_pending=100,
+                 max_datagram=60000):
+        super().__init__(name="event-shipper", daemon=True)
+        self.protocol, self.address = parse_target(target)
+        self.board = board or socket.gethostname()
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.health_interval = health_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_datagram = max_datagram
+
+        self._events = event_bus.subscribe(types, maxsize=queue_size)
+        self._pending = deque(maxlen=max_pending) #encoded frames waiting to be (re)sent
+        self._seq = 0
+        self._sock = None
+        self._backoff = 0 #current retry delay (0 = last send worked)
+        self._next_try = 0.0 #monotonic time of the next send attempt after a failure
+        self._stopping = threading.Event()
+
+        self.sent_events = 0
+        self.sent_frames = 0
+        self.failed_sends = 0
+        self.dropped_frames = 0
+
+
+    def _health(self):
+        return {"type": HEALTH, "time": time.time(), "data": {
+            "uptime": process_uptime(), "max_rss_kb": peak_rss_kb(), "dropped_events": self._events.dropped,
+            "dropped_frames": self.dropped_frames, "failed_sends": self.failed_sends, "sent_events": self.sent_events}}
+
+    #encoded frames for a batch (UDP batches are split until each frame fits in a datagram)
+    def _frames(self, events):
+        frame = encode_frame(self.board, self._seq, events)
+        if self.protocol == "udp" and len(frame) > self.max_datagram and len(events) > 1:
+            half = len(events)//2
+            return self._frames(events[:half]) + self._frames(events[half:])
+        self._seq += 1
+        return [(frame, len(events))]
+
+    def _queue(self, events):
+        for frame in self._frames(events):
+            if self.protocol == "udp" and len(frame[0]) > self.max_datagram:
+                logging.warning(f"dropping an event too large for a datagram ({len(frame[0])} bytes)")
+                self.dropped_frames += 1
+                continue
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped_frames += 1 #the deque drops the oldest
+            self._pending.append(frame)
+
+
+    #================================ sending ================================
+
+    def _connect(self):
+        if self.protocol == "udp":
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sock.connect(self.address)
+        else:
+            self._sock = socket.create_connection(self.address, timeout=5)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    #sends pending frames oldest first until one fails (it is kept for the next attempt)
+    def _flush(self):
+        if not self._pending or time.monotonic() < self._next_try:
+            return
+        try:
+            if self._sock is None:
+                self._connect()
+            while self._pending:
+                frame, count = self._pending[0]
+                if self.protocol == "udp":
+                    self._sock.send(frame)
+                else:
+                    self._sock.sendall(frame)
+                self._pending.popleft()
+                self.sent_frames += 1
+                self.sent_events += count
+            if self._backoff:
+                logging.info(f"event shipping to {self.protocol}://{self.address[0]}:{self.address[1]} recovered")
+            self._backoff = 0
+        except OSError as e:
+            self.failed_sends += 1
+            self._close()
+            self._backoff = min(self.max_retry_delay, 2*self._backoff if self._backoff else self.retry_delay)
+            self._next_try = time.monotonic() + self._backoff*random.uniform(0.5, 1.0) #jitter so boards don't retry in step
+            if self.failed_sends == 1 or self._backoff == self.max_retry_delay:
+                logging.warning(f"event shipping failed ({e!r}), {len(self._pending)} batches pending, retrying in {self._backoff:.1f} s")
+
+    def stop(self):
+        self._stopping.set()
+
+
+    #================================ loop ================================
+
+    def run(self):
+        logging.debug(f"starting event shipper to {self.protocol}://{self.address[0]}:{self.address[1]} as {self.board}")
+        next_health = time.monotonic()
+        while not self._stopping.is_set():
+            #waits for the first event (or the next health report / retry), then collects whatever else arrives
+            #within batch_interval
+            now = time.monotonic()
+            wake = next_health if not self._pending else min(next_health, max(self._next_try, now))
+            batch = []
+            event = self._events.get(timeout=max(0, wake - now))
+            if event is not None:
+                batch.append(to_record(event))
+                deadline = time.monotonic() + self.batch_interval
+                while len(batch) < self.batch_size:
+                    event = self._events.get(timeout=max(0, deadline - time.monotonic()))
+                    if event is None:
+                        break
+                    batch.append(to_record(event))
+
+            if time.monotonic() >= next_health:
+                batch.append(self._health())
+                next_health = time.monotonic() + self.health_interval
+            if batch:
+                self._queue(batch)
+            self._flush()
+        self._close()
+
+
+
+
+
+##########################################################################################################
+#                           LOAD TEST                                                                    #
+##########################################################################################################
+
+if __name__ == "__main__":
+
+    from event_bus import EventBus
+
+    parser = argparse.ArgumentParser(description="Send synthetic events to an aggregator as fast as possible")
+    parser.add_argument("target", help="udp://host:port or tcp://host:port")
+    parser.add_argument("--bench", type=int, default=100000, help="events to send")
+    parser.add_argument("--board", default="bench", help="board name")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    bus = EventBus()
+    shipper = EventShipper(bus, args.target, board=args.board, queue_size=args.bench, batch_interval=0.05, health_interval=3600)
+    start = time.perf_counter()
+    for i in range(args.bench):
+        bus.publish(MOTION_DETECTED, source="bench", range=100.0 + i % 50)
+    shipper.start()
+    while shipper.sent_events < args.bench + 1 and time.perf_counter() - start < 60: #+1 for the first health event
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    print(f"{shipper.sent_events} events in {shipper.sent_frames} frames, {elapsed:.2f} s ({shipper.sent_events/elapsed:.0f} events/s), "
+          f"dropped {shipper._events.dropped}", file=sys.stderr)
@@ -0,0 +1,282 @@
+#! /usr/bin/env python3
+#
+# Local event history: an append-only SQLite store of activations, button gestures, mode changes and playback results
+#
+# EventRecorder subscribes to the event bus with a bounded queue (publishing never blocks, overflow is counted) and
+# writes from its own thread in batches: everything that arrived within batch_interval seconds (or batch_size events)
+# goes in with one executemany and one commit, so the SD card sees a write every few seconds at most. The database
+# runs in write-ahead (WAL) mode with synchronous=NORMAL, so a query from the CLI never blocks the recorder and a
+# commit doesn't wait for an fsync. Rows are (time, type, board, source, data) with time in Unix seconds and the
+# other event fields as JSON in data; indexes on (slot, time) and (type, slot, time), slot being the 15 minute
+# interval of the time, let a time-range aggregation read only the index entries in its range, already in slot order (6 months at one event every 10 s: ~0.1 s, a week: ~10 ms).
+#
+# usage: python3 event_store.py [--db events.db] [--since 7d] [--until ...] [--type motion_detected]
+#                               [--source ultrasonic] [--board ...] [--hours 19-7] [--by hour] [--avg range] [--json]
+#   e.g. activations per hour last week:   --since 7d --type motion_detected --by hour
+#        activations between 19:00 and 7:00 by source over the last month:   --since 30d --hours 19-7 --by source
+
+import sys
+import json
+import time
+import socket
+import sqlite3
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+from event_bus import MOTION_DETECTED, BUTTON_GESTURE, MODE_CHANGE, PLAYBACK_FINISHED, to_record
+
+
+DEFAULT_DB = "events.db"
+STORED_TYPES = (MOTION_DETECTED, BUTTON_GESTURE, MODE_CHANGE, PLAYBACK_FINISHED)
+_STOP = object() #queued by EventRecorder.stop() to wake the recorder thread
+
+#--by value -> local time format of the group (calendar groups) or column (the others)
+TIME_GROUPS = {"hour": "%Y-%m-%d %H:00", "day": "%Y-%m-%d", "week": "%Y-W%W", "month": "%Y-%m", "hour-of-day": "%H",
+               "weekday": "%w"} #weekday 0 = Sunday
+COLUMN_GROUPS = ("type", "source", "board")
+GROUPS = tuple(TIME_GROUPS) + COLUMN_GROUPS
+
+#Queries count events per 15 minute slot of Unix time, in the order of the indexes, which start with the slot; Python
+#then turns each slot into local time once instead of SQLite converting every event (a localtime() call each). Every
+#time zone offset is a multiple of 15 minutes, so slots never straddle a local hour.
+SLOT = 900
+SLOT_KEY = f"CAST(time/{SLOT} AS INTEGER)"
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    type TEXT NOT NULL,
+    board TEXT NOT NULL,
+    source TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS events_time ON events ({SLOT_KEY}, time);
+CREATE INDEX IF NOT EXISTS events_type_time ON events (type, {SLOT_KEY}, time);
+"""
+
+
+#opens (and creates if needed) a store, in WAL mode
+def open_store(path=DEFAULT_DB):
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL") #durable at checkpoints; a power cut loses at most the last commits
+    db.executescript(SCHEMA)
+    return db
+
+
+#appends records ({"type", "time", "data"} as made by event_bus.to_record) in one transaction
+def insert(db, board, records):
+    with db:
+        db.executemany("INSERT INTO events (time, type, board, source, data) VALUES (?, ?, ?, ?, ?)",
+                       [(r["time"], r["type"], board, r["data"].get("source"), json.dumps(r["data"], separators=(",", ":")))
+                        for r in records])
+
+
+
+class EventRecorder(threading.Thread):
+
+    #path: SQLite file, board: name stored with each event (default: host name), types: event types recorded
+    #queue_size: events buffered before new ones are dropped
+    #batch_size, batch_interval: events written per transaction at most, and seconds collected into one
+    def __init__(self, event_bus, path=DEFAULT_DB, board=None, types=STORED_TYPES, queue_size=10000, batch_size=500,
+                 batch_interval=5.0):
+        super().__init__(name="event-store", daemon=True)
+        self.path = path
+        self.board = board or socket.gethostname()
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._events = event_bus.subscribe(types, maxsize=queue_size)
+        self.written = 0
+        self.failed_writes = 0
+
+    @property
+    def dropped(self):
+        return self._events.dropped
+
+    #writes what is queued and ends the thread (join() to wait for it)
+    def stop(self):
+        self._events.put(_STOP)
+
+    def _write(self, db, batch):
+        try:
+            insert(db, self.board, batch)
+            self.written += len(batch)
+        except sqlite3.Error as e:
+            self.failed_writes += 1
+            logging.warning(f"failed to store {len(batch)} events: {e}")
+
+    def run(self):
+        logging.debug(f"recording events to {self.path}")
+        db = open_store(self.path) #sqlite connections stay in the thread that opened them
+        stopping = False
+        while not stopping:
+            #sleeps until the first event, then collects whatever else arrives within batch_interval
+            event = self._events.get()
+            if event is _STOP:
+                break
+            batch = [to_record(event)]
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < self.batch_size:
+                event = self._events.get(timeout=max(0, deadline - time.monotonic()))
+                if event is None: #batch_interval is over
+                    break
+                if event is _STOP:
+                    stopping = True
+                    break
+                batch.append(to_record(event))
+            self._write(db, batch)
+
+        batch = [] #events published before stop() but queued after the sentinel
+        event = self._events.get(timeout=0)
+        while event is not None:
+            if event is not _STOP:
+                batch.append(to_record(event))
+            event = self._events.get(timeout=0)
+        if batch:
+            self._write(db, batch)
+        db.close()
+
+
+
+##########################################################################################################
+#                           QUERIES                                                                      #
+##########################################################################################################
+
+#"7d", "12h", "30m" (before now), a Unix time, or an ISO date/time (local) -> Unix time
+def parse_time(text, now=None):
+    now = time.time() if now is None else now
+    units = {"m": 60, "h": 3600, "d": 86400, "w": 604800}
+    if text[-1:] in units and text[:-1].replace(".", "", 1).isdigit():
+        return now - float(text[:-1])*units[text[-1]]
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise ValueError(f"bad time {text!r} (expected e.g. 7d, 12h, 2026-10-01 or 2026-10-01T18:00)")
+
+
+#aggregates events -> (column names, rows)
+#since, until: Unix times (None for unbounded), types: event types (None for all), hours: (first, last) local hour
+#of day, may wrap past midnight (19, 7), by: one of GROUPS (None for one total), avg: data field averaged per group
+def aggregate(db, since=None, until=None, types=None, source=None, board=None, hours=None, by=None, avg=None):
+    groups = {} #group -> [count, sum, values]
+    local = {} #slot -> local datetime
+    for event_type in dict.fromkeys(types or [None]): #one query per distinct type, so each reads the index in slot order
+        for slot, column, count, total, values in _query(db, since, until, event_type, source, board,
+                                                         hours is not None or by in TIME_GROUPS,
+                                                         by if by in COLUMN_GROUPS else None, avg):
+            if slot is not None:
+                t = local.get(slot)
+                if t is None:
+                    t = local[slot] = datetime.fromtimestamp(slot*SLOT)
+                if hours is not None and not _in_hours(t.hour, hours):
+                    continue
+            key = t.strftime(TIME_GROUPS[by]) if by in TIME_GROUPS else column
+            group = groups.setdefault(key, [0, 0.0, 0])
+            group[0] += count
+            group[1] += total or 0.0
+            group[2] += values
+
+    columns = ["count"] if avg is None else ["count", f"avg {avg}"]
+    rows = []
+    for key, (count, total, values) in sorted(groups.items(), key=lambda item: (item[0] is None, item[0] or "")):
+        row = (count,) if avg is None else (count, total/values if values else None)
+        rows.append(row if by is None else (key,) + row)
+    if by is None and not rows:
+        rows.append((0,) if avg is None else (0, None))
+    return ([by] if by is not None else []) + columns, rows
+
+
+#rows of (slot or None, column value or None, count, sum and count of the averaged field)
+def _query(db, since, until, event_type, source, board, by_slot, column, avg):
+    where = []
+    params = []
+    if event_type is not None:
+        where.append("type = ?")
+        params.append(event_type)
+    if since is not None:
+        where.append(f"{SLOT_KEY} >= ? AND time >= ?") #the slot bound lets the index seek
+        params.extend((int(since//SLOT), since))
+    if until is not None:
+        where.append(f"{SLOT_KEY} <= ? AND time < ?")
+        params.extend((int(until//SLOT), until))
+    if source is not None:
+        where.append("source = ?")
+        params.append(source)
+    if board is not None:
+        where.append("board = ?")
+        params.append(board)
+
+    select = [SLOT_KEY if by_slot else "NULL", column or "NULL", "COUNT(*)"]
+    if avg is not None:
+        select += ["SUM(json_extract(data, ?))", "COUNT(json_extract(data, ?))"]
+        params[:0] = [f"$.{avg}"]*2
+    else:
+        select += ["0", "0"]
+    sql = f"SELECT {', '.join(select)} FROM events"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    keys = [key for key in (SLOT_KEY if by_slot else None, column) if key is not None]
+    if keys:
+        sql += f" GROUP BY {', '.join(keys)}"
+    return db.execute(sql, params)
+
+
+def _in_hours(hour, hours):
+    first, last = hours
+    return first <= hour <= last if first <= last else hour >= first or hour <= last
+
+
+
+
+
+##########################################################################################################
+#                           MAIN                                                                         #
+##########################################################################################################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Count stored motion detector events over a time range")
+    parser.add_argument("--db", default=DEFAULT_DB, help="event store file")
+    parser.add_argument("--since", help="start: 7d, 12h, 30m ago, or a local date/time such as 2026-10-01")
+    parser.add_argument("--until", help="end, same formats as --since")
+    parser.add_argument("--type", action="append", help=f"event type ({', '.join(STORED_TYPES)}), repeatable")
+    parser.add_argument("--source", help="event source (ultrasonic, pir, system, control, ...)")
+    parser.add_argument("--board", help="board name")
+    parser.add_argument("--hours", help="local hours of the day, e.g. 19-7 for 19:00 to 7:59")
+    parser.add_argument("--by", choices=GROUPS, help="group counts by")
+    parser.add_argument("--avg", help="also average this data field, e.g. range")
+    parser.add_argument("--json", action="store_true", help="print JSON lines")
+    args = parser.parse_args()
+
+    try:
+        since = parse_time(args.since) if args.since else None
+        until = parse_time(args.until) if args.until else None
+        hours = tuple(int(h) for h in args.hours.split("-")) if args.hours else None
+        if hours is not None and (len(hours) != 2 or not all(0 <= h <= 23 for h in hours)):
+            raise ValueError(f"bad hours {args.hours!r} (expected first-last, e.g. 19-7)")
+    except ValueError as e:
+        parser.error(str(e))
+
+    db = open_store(args.db)
+    start = time.perf_counter()
+    try:
+        columns, rows = aggregate(db, since, until, args.type, args.source, args.board, hours, args.by, args.avg)
+    except sqlite3.OperationalError as e:
+        parser.error(f"query failed: {e}" + (f" (is --avg {args.avg!r} a data field name?)" if args.avg else ""))
+    elapsed = time.perf_counter() - start
+
+    if args.json:
+        for row in rows:
+            print(json.dumps(dict(zip(columns, row))))
+    else:
+        print("\t".join(columns))
+        for row in rows:
+            print("\t".join("-" if v is None else f"{v:.1f}" if isinstance(v, float) else str(v) for v in row))
+    print(f"{len(rows)} rows in {1000*elapsed:.1f} ms", file=sys.stderr)
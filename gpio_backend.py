@@ -0,0 +1,476 @@
+#
+# GPIO backends for the motion detector: the real RPi.GPIO library, or a simulated board whose pins can be
+# driven from scripts or recorded traces (for profiling and load testing off the Pi)
+#
+# The scripts use the module-level GPIO proxy exactly like they used RPi.GPIO. The backend behind it is picked
+# the first time it is used, from the MOTION_GPIO_BACKEND environment variable ("rpi" by default, or "sim"),
+# or explicitly with set_backend(). With the simulated backend, MOTION_GPIO_TRACE can point to a recorded trace
+# that is replayed as soon as the backend is created.
+
+
+
+##########################################################################################################
+#                           GENERAL SETUP                                                                #
+##########################################################################################################
+
+import os
+import time
+import heapq
+import threading
+import logging
+
+
+#same values as RPi.GPIO so pin modes/edges can be passed between backends unchanged
+BOARD = 10
+BCM = 11
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+
+
+##########################################################################################################
+#                           BACKEND INTERFACE                                                            #
+##########################################################################################################
+
+class GPIOBackend:
+
+    BOARD = BOARD
+    BCM = BCM
+    OUT = OUT
+    IN = IN
+    LOW = LOW
+    HIGH = HIGH
+    PUD_OFF = PUD_OFF
+    PUD_DOWN = PUD_DOWN
+    PUD_UP = PUD_UP
+    RISING = RISING
+    FALLING = FALLING
+    BOTH = BOTH
+
+    def setmode(self, mode):
+        raise NotImplementedError
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=None):
+        raise NotImplementedError
+
+    def output(self, channel, value):
+        raise NotImplementedError
+
+    def input(self, channel):
+        raise NotImplementedError
+
+    #blocks until the edge occurs (returns channel) or timeout (ms) passes (returns None)
+    def wait_for_edge(self, channel, edge, bouncetime=None, timeout=None):
+        raise NotImplementedError
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        raise NotImplementedError
+
+    def add_event_callback(self, channel, callback):
+        raise NotImplementedError
+
+    def remove_event_detect(self, channel):
+        raise NotImplementedError
+
+    def event_detected(self, channel):
+        raise NotImplementedError
+
+    def cleanup(self, channel=None):
+        raise NotImplementedError
+
+    #returns a PWM object with start(dutycycle), ChangeFrequency(hz), ChangeDutyCycle(dutycycle) and stop()
+    def PWM(self, channel, frequency):
+        raise NotImplementedError
+
+
+
+
+
+##########################################################################################################
+#                           RASPBERRY PI BACKEND                                                         #
+##########################################################################################################
+
+class RPiBackend(GPIOBackend):
+
+    def __init__(self):
+        import RPi.GPIO #only importable on the Pi itself
+        self._gpio = RPi.GPIO
+
+    def setmode(self, mode):
+        self._gpio.setmode(mode)
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=None):
+        if initial is None:
+            self._gpio.setup(channel, direction, pull_up_down=pull_up_down)
+        else:
+            self._gpio.setup(channel, direction, pull_up_down=pull_up_down, initial=initial)
+
+    def output(self, channel, value):
+        self._gpio.output(channel, value)
+
+    def input(self, channel):
+        return self._gpio.input(channel)
+
+    def wait_for_edge(self, channel, edge, bouncetime=None, timeout=None):
+        kwargs = {}
+        if bouncetime is not None:
+            kwargs["bouncetime"] = bouncetime
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        return self._gpio.wait_for_edge(channel, edge, **kwargs)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        kwargs = {}
+        if callback is not None:
+            kwargs["callback"] = callback
+        if bouncetime is not None:
+            kwargs["bouncetime"] = bouncetime
+        self._gpio.add_event_detect(channel, edge, **kwargs)
+
+    def add_event_callback(self, channel, callback):
+        self._gpio.add_event_callback(channel, callback)
+
+    def remove_event_detect(self, channel):
+        self._gpio.remove_event_detect(channel)
+
+    def event_detected(self, channel):
+        return self._gpio.event_detected(channel)
+
+    def cleanup(self, channel=None):
+        if channel is None:
+            self._gpio.cleanup()
+        else:
+            self._gpio.cleanup(channel)
+
+    def PWM(self, channel, frequency):
+        return self._gpio.PWM(channel, frequency)
+
+
+
+
+
+##########################################################################################################
+#                           SIMULATED BACKEND                                                            #
+##########################################################################################################
+
+class SimulatedBackend(GPIOBackend):
+
+    def __init__(self, echo_latency=0.0005):
+
+        self.echo_latency = echo_latency #delay (sec) between end of trigger pulse and start of echo pulse
+
+        self._cond = threading.Condition()
+        self._mode = None
+        self._directions = {}
+        self._levels = {}
+        self._edge_counts = {} #(pin, RISING/FALLING) -> number of edges seen, so waiters can detect new edges
+        self._detectors = {} #pin -> [edge, bouncetime (sec), callbacks, time of last accepted edge, detected flag]
+        self._echoes = {} #trigger pin -> (echo pin, source of ranges in cm)
+
+        #scheduled pin changes (time.monotonic() deadline, sequence, pin, level), applied by a daemon thread
+        self._schedule = []
+        self._seq = 0
+        self._scheduler = None
+        self._local = threading.local() #marks threads currently running edge callbacks
+
+    def setmode(self, mode):
+        self._mode = mode
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=None):
+        with self._cond:
+            self._directions[channel] = direction
+            if direction == OUT:
+                self._levels[channel] = LOW if initial is None else initial
+            elif channel not in self._levels:
+                self._levels[channel] = HIGH if pull_up_down == PUD_UP else LOW
+
+    def output(self, channel, value):
+        value = HIGH if value else LOW
+        old = self._levels.get(channel, LOW)
+        self._set_level(channel, value)
+
+        #end of a trigger pulse on a pin with a simulated ultrasonic sensor attached fires the echo
+        if channel in self._echoes and old == HIGH and value == LOW:
+            self._fire_echo(channel)
+
+    def input(self, channel):
+        #polling sees scheduled changes on time even if the scheduler thread is waiting for the GIL (but a callback
+        #reading its own pin sees the level of the edge that fired it, as on real hardware)
+        if not getattr(self._local, "in_callback", False):
+            self._apply_due()
+        return self._levels.get(channel, LOW)
+
+    def wait_for_edge(self, channel, edge, bouncetime=None, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout/1000
+        keys = self._edge_keys(channel, edge)
+        with self._cond:
+            start_counts = [self._edge_counts.get(k, 0) for k in keys]
+            while [self._edge_counts.get(k, 0) for k in keys] == start_counts:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+        return channel
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        with self._cond:
+            if channel in self._detectors:
+                raise RuntimeError(f"Conflicting edge detection already enabled for channel {channel}")
+            callbacks = [callback] if callback is not None else []
+            self._detectors[channel] = [edge, (bouncetime or 0)/1000, callbacks, None, False]
+
+    def add_event_callback(self, channel, callback):
+        with self._cond:
+            if channel not in self._detectors:
+                raise RuntimeError("Add event detection using add_event_detect first before adding a callback")
+            self._detectors[channel][2].append(callback)
+
+    def remove_event_detect(self, channel):
+        with self._cond:
+            self._detectors.pop(channel, None)
+
+    def event_detected(self, channel):
+        with self._cond:
+            detector = self._detectors.get(channel)
+            if detector is None or not detector[4]:
+                return False
+            detector[4] = False
+            return True
+
+    def cleanup(self, channel=None):
+        with self._cond:
+            if channel is None:
+                self._directions.clear()
+                self._detectors.clear()
+                self._echoes.clear()
+                self._schedule.clear()
+            else:
+                self._directions.pop(channel, None)
+                self._detectors.pop(channel, None)
+            self._cond.notify_all()
+
+    def PWM(self, channel, frequency):
+        return SimulatedPWM(self, channel, frequency)
+
+
+    #================================ driving the simulated pins ================================
+
+    #immediately drive an input pin (as the connected sensor/button would), firing edge detection
+    def set_level(self, channel, level):
+        self._set_level(channel, HIGH if level else LOW)
+
+    #drive a pin after delay seconds (non-blocking)
+    def schedule(self, delay, channel, level):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._schedule, (time.monotonic() + delay, self._seq, channel, HIGH if level else LOW))
+            self._start_scheduler()
+            self._cond.notify_all()
+
+    #attach a simulated HC-SR04: each trigger pulse on trigPin produces an echo pulse on echoPin whose length
+    #corresponds to the next range (cm) from ranges (callable or iterable), or no echo at all for None/NaN
+    def attach_echo(self, trigPin, echoPin, ranges):
+        if not callable(ranges):
+            ranges = iter(ranges).__next__
+        with self._cond:
+            self._echoes[trigPin] = (echoPin, ranges)
+            self._levels.setdefault(echoPin, LOW)
+
+    #press a pull-up button (pin LOW) for duration seconds, starting after delay seconds
+    def press_button(self, channel, duration, delay=0):
+        self.schedule(delay, channel, LOW)
+        self.schedule(delay + duration, channel, HIGH)
+
+    #single HIGH pulse (e.g. PIR sensor output) of the given width, starting after delay seconds
+    def pulse(self, channel, width, delay=0):
+        self.schedule(delay, channel, HIGH)
+        self.schedule(delay + width, channel, LOW)
+
+    #replay a recorded trace: iterable of (seconds from start, pin, level)
+    def play_trace(self, events):
+        for t, channel, level in events:
+            self.schedule(t, channel, level)
+
+    #blocks until every scheduled pin change has been applied
+    def wait_idle(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._schedule:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+
+    #================================ internals ================================
+
+    def _edge_keys(self, channel, edge):
+        if edge == BOTH:
+            return [(channel, RISING), (channel, FALLING)]
+        return [(channel, edge)]
+
+    def _set_level(self, channel, level):
+        callbacks = []
+        with self._cond:
+            old = self._levels.get(channel, LOW)
+            self._levels[channel] = level
+            if old == level:
+                return
+
+            edge = RISING if level == HIGH else FALLING
+            key = (channel, edge)
+            self._edge_counts[key] = self._edge_counts.get(key, 0) + 1
+
+            detector = self._detectors.get(channel)
+            if detector is not None and detector[0] in (edge, BOTH):
+                now = time.monotonic()
+                if detector[3] is None or now - detector[3] >= detector[1]: #software bounce filter
+                    detector[3] = now
+                    detector[4] = True
+                    callbacks = list(detector[2])
+            self._cond.notify_all()
+
+        #callbacks run outside the lock, as RPi.GPIO runs them outside the main thread
+        self._local.in_callback = True
+        try:
+            for callback in callbacks:
+                try:
+                    callback(channel)
+                except Exception:
+                    logging.exception(f"exception in simulated GPIO callback for channel {channel}")
+        finally:
+            self._local.in_callback = False
+
+    def _fire_echo(self, trigPin):
+        echoPin, ranges = self._echoes[trigPin]
+        try:
+            distance_cm = ranges()
+        except StopIteration:
+            return
+        if distance_cm is None or distance_cm != distance_cm: #no echo
+            return
+        self.schedule(self.echo_latency, echoPin, HIGH)
+        self.schedule(self.echo_latency + distance_cm/17150.0, echoPin, LOW)
+
+    def _start_scheduler(self):
+        if self._scheduler is None or not self._scheduler.is_alive():
+            self._scheduler = threading.Thread(target=self._run_schedule, daemon=True)
+            self._scheduler.start()
+
+    #applies every scheduled change whose deadline has passed, in order
+    def _apply_due(self):
+        while True:
+            with self._cond:
+                if not self._schedule or self._schedule[0][0] > time.monotonic():
+                    return
+                _, _, channel, level = heapq.heappop(self._schedule)
+                if not self._schedule:
+                    self._cond.notify_all() #wakes wait_idle
+            self._set_level(channel, level)
+
+    def _run_schedule(self):
+        while True:
+            with self._cond:
+                while not self._schedule:
+                    self._cond.wait()
+                remaining = self._schedule[0][0] - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+            self._apply_due()
+
+
+
+#PWM output on a simulated pin: records its settings and holds the pin HIGH while running with a non-zero duty cycle
+class SimulatedPWM:
+
+    def __init__(self, backend, channel, frequency):
+        self._backend = backend
+        self.channel = channel
+        self.frequency = frequency
+        self.dutycycle = 0
+        self.running = False
+
+    def start(self, dutycycle):
+        self.running = True
+        self.ChangeDutyCycle(dutycycle)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def ChangeDutyCycle(self, dutycycle):
+        self.dutycycle = dutycycle
+        if self.running:
+            self._backend.set_level(self.channel, dutycycle > 0)
+
+    def stop(self):
+        self.running = False
+        self._backend.set_level(self.channel, LOW)
+
+
+
+#reads a recorded trace file: one "seconds,pin,level" line per pin change ('#' comments and blank lines ignored)
+def load_trace(filename):
+    events = []
+    with open(filename) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            t, channel, level = line.split(",")
+            events.append((float(t), int(channel), int(level)))
+    return events
+
+
+
+
+
+##########################################################################################################
+#                           BACKEND SELECTION                                                            #
+##########################################################################################################
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def set_backend(backend):
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+def get_backend():
+    global _backend
+    backend = _backend
+    if backend is not None:
+        return backend #lock-free once selected (every proxied GPIO call comes through here)
+    with _backend_lock:
+        if _backend is None:
+            name = os.environ.get("MOTION_GPIO_BACKEND", "rpi").lower()
+            if name == "sim":
+                _backend = SimulatedBackend()
+                trace = os.environ.get("MOTION_GPIO_TRACE")
+                if trace:
+                    _backend.play_trace(load_trace(trace))
+            elif name == "rpi":
+                _backend = RPiBackend()
+            else:
+                raise ValueError(f"unknown GPIO backend {name!r} (expected 'rpi' or 'sim')")
+            logging.info(f"using {type(_backend).__name__} GPIO backend")
+        return _backend
+
+
+#drop-in replacement for the RPi.GPIO module that forwards to the selected backend
+class _BackendProxy:
+
+    def __getattr__(self, name):
+        return getattr(get_backend(), name)
+
+GPIO = _BackendProxy()
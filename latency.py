@@ -0,0 +1,122 @@
+#
+# End-to-end trigger-to-sound latency instrumentation
+#
+# Every activation gets a Trace with a unique ID that travels with it from the sensor to the audio thread. Each
+# stage stamps it with time.monotonic():
+#   sample          sensor reading that caused the activation (echo measured / PIR edge seen)
+#   detect          activation decision in the sensor thread
+#   pickup          main loop received the activation
+#   request         AudioThread.request_play_audio accepted it
+#   playback_start  first audio written to the device (aplay: process launched)
+#   playback_end    playback finished
+# LatencyTracker keeps rolling windows of the time spent in each stage (from the previous stage) and of the
+# total, and periodically logs their p50/p95/p99 and appends them as a JSON line to a report file.
+
+import json
+import time
+import logging
+import itertools
+import threading
+from collections import deque
+
+
+STAGES = ("sample", "detect", "pickup", "request", "playback_start", "playback_end")
+
+_trace_ids = itertools.count(1)
+
+
+
+class Trace:
+
+    __slots__ = ("id", "times")
+
+    def __init__(self):
+        self.id = next(_trace_ids)
+        self.times = {} #stage -> time.monotonic()
+
+    def mark(self, stage, t=None):
+        self.times[stage] = time.monotonic() if t is None else t
+
+    #seconds spent reaching each recorded stage from the previous recorded one
+    def stage_latencies(self):
+        latencies = {}
+        previous = None
+        for stage in STAGES:
+            t = self.times.get(stage)
+            if t is None:
+                continue
+            if previous is not None:
+                latencies[stage] = t - previous
+            previous = t
+        return latencies
+
+    def __repr__(self):
+        first = self.times.get("sample", min(self.times.values(), default=0))
+        stamps = ", ".join(f"{stage}=+{1000*(self.times[stage] - first):.1f}ms" for stage in STAGES if stage in self.times)
+        return f"Trace({self.id}: {stamps})"
+
+
+
+#nearest-rank percentile of an already sorted list
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(p/100*len(sorted_values)))]
+
+
+
+class LatencyTracker:
+
+    #window: number of recent traces kept per stage, report_interval: seconds between reports
+    #report_file: JSON lines file the reports are appended to (only logged if None)
+    def __init__(self, window=500, report_interval=300, report_file=None):
+        self.report_interval = report_interval
+        self.report_file = report_file
+        self._lock = threading.Lock()
+        self._latencies = {stage: deque(maxlen=window) for stage in STAGES[1:] + ("total",)}
+        self.completed = 0
+        self._reporter = None
+        self._stop = threading.Event()
+
+    #records a finished (or abandoned) trace
+    def finish(self, trace):
+        latencies = trace.stage_latencies()
+        times = trace.times
+        with self._lock:
+            for stage, latency in latencies.items():
+                self._latencies[stage].append(latency)
+            if "sample" in times and "playback_start" in times:
+                self._latencies["total"].append(times["playback_start"] - times["sample"]) #trigger to sound
+            self.completed += 1
+        logging.debug(f"latency {trace!r}")
+
+    #{stage: {"n", "p50", "p95", "p99"}} in milliseconds
+    def summary(self):
+        with self._lock:
+            snapshot = {stage: sorted(values) for stage, values in self._latencies.items()}
+        return {stage: {"n": len(values), "p50": 1000*percentile(values, 50), "p95": 1000*percentile(values, 95),
+                        "p99": 1000*percentile(values, 99)} for stage, values in snapshot.items()}
+
+    def report(self):
+        summary = self.summary()
+        logging.info("latency (ms) " + " ".join(f"{stage}: p50={s['p50']:.1f} p95={s['p95']:.1f} p99={s['p99']:.1f} (n={s['n']})"
+                                                 for stage, s in summary.items() if s["n"]))
+        if self.report_file is not None:
+            with open(self.report_file, "a") as f:
+                f.write(json.dumps({"time": time.time(), "completed": self.completed, "stages": summary}) + "\n")
+
+
+    #writes a report every report_interval seconds from a daemon thread
+    def start(self):
+        self._reporter = threading.Thread(target=self._run, name="latency-report", daemon=True)
+        self._reporter.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.report_interval):
+            try:
+                self.report()
+            except Exception:
+                logging.exception("failed to write latency report")
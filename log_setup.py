@@ -0,0 +1,94 @@
+#
+# Non-blocking logging: threads that log (motion, button, audio, ...) only put the record on a bounded queue, and a
+# background listener thread formats it and writes it to a rotating log file. A slow SD card write therefore never
+# delays ranging or audio start. If the listener falls behind and the queue fills up, new records are dropped (and
+# the number dropped is logged once there is room again) rather than blocking the caller.
+
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(threadName)s: %(message)s"
+
+
+
+#QueueHandler that never blocks: records that don't fit in the queue are counted and dropped
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._reported = 0 #drops already reported in the log
+        self._lock = threading.Lock()
+
+    #formatting is left to the listener thread, only the message arguments are merged now (they may change later)
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return
+
+        if self.dropped != self._reported:
+            with self._lock:
+                missed, self._reported = self.dropped - self._reported, self.dropped
+            warning = logging.makeLogRecord({"name": "log_setup", "levelno": logging.WARNING, "levelname": "WARNING",
+                                             "msg": f"log queue full, dropped {missed} records", "threadName": record.threadName})
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                with self._lock:
+                    self._reported -= missed #try again next time
+
+
+
+#QueueListener whose stop() can be called more than once (by the caller and again at exit); before Python 3.12 the
+#stdlib one fails when stopped twice
+class _Listener(logging.handlers.QueueListener):
+
+    running = False
+
+    def start(self):
+        super().start()
+        self.running = True
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            super().stop()
+
+
+
+#replaces logging.basicConfig(filename=..., level=...): logs to filename through a background listener thread
+#max_bytes/backup_count: size-based rotation (max_bytes=0 disables it)
+#rotate_when: time-based rotation instead ("midnight", "H", ... as for TimedRotatingFileHandler)
+#queue_size: records buffered before new ones are dropped
+#returns the QueueListener (stopped and flushed automatically at exit)
+def setup_logging(filename, level=logging.DEBUG, max_bytes=5*1024*1024, backup_count=5, rotate_when=None, queue_size=10000):
+    if rotate_when is not None:
+        file_handler = logging.handlers.TimedRotatingFileHandler(filename, when=rotate_when, backupCount=backup_count)
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    listener = _Listener(log_queue, file_handler)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DroppingQueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop) #drains the queue before the file is closed
+    return listener
@@ -8,13 +8,33 @@
 #                           GENERAL SETUP                                                                #
 ##########################################################################################################
 
-import RPi.GPIO as GPIO
-from datetime import datetime, timedelta
+from gpio_backend import GPIO, get_backend
+from datetime import datetime
+import os
 import time
 import subprocess
 import threading
 import logging
-import numpy as np
+import math
+from statistics import median
+from rolling_stats import RollingStats
+from detectors import make_detector
+from audio_engine import PCMPlayer, load_wav
+from audio_mixer import Mixer
+from clip_library import ClipLibrary
+from latency import Trace, LatencyTracker
+from trace_recorder import TraceRecorder
+from log_setup import setup_logging
+from boot_timing import log_armed
+from control_socket import ControlServer
+from deadlines import DeadlineScheduler, wall_time
+from thread_stats import ThreadStats, count_iteration
+from event_shipper import EventShipper
+from event_store import EventRecorder
+from event_bus import EventBus, MOTION_DETECTED, BUTTON_GESTURE, PLAYBACK_STARTED, PLAYBACK_FINISHED, MODE_CHANGE
+
+
+NO_ECHO = math.nan #range returned when no echo is received before the timeout (ignored by the nan-aware mean)
 
 def setup():
     GPIO.setmode(GPIO.BOARD)
@@ -31,12 +51,13 @@ def cleanup():
 
 class ButtonThread(threading.Thread):
     
-    def __init__(self, button_num):
-        super().__init__()
+    def __init__(self, button_num, event_bus=None):
+        super().__init__(name="button")
         
         logging.info("initializing button thread")
         
         self.button_num = button_num
+        self.event_bus = event_bus #publishes BUTTON_GESTURE events if set
         self._status = 0
         self._locked = False
         
@@ -55,6 +76,7 @@ class ButtonThread(threading.Thread):
         
         try:
             while True:
+                count_iteration()
                 if not self._locked:
                     GPIO.wait_for_edge(self.button_num, GPIO.FALLING)
                     
@@ -67,16 +89,22 @@ class ButtonThread(threading.Thread):
                     buttonTime = time.time() - start #getting button press duration
                     
                     
+                    status = 0 #a press shorter than .3 s is ignored
                     if buttonTime >= 6: #power off
-                        self._status = 3
+                        status = 3
                         logging.debug("button status 3 (poweroff)")
                     elif buttonTime >= 3: #deactivate
-                        self._status = 2
+                        status = 2
                         logging.debug("button status 2 (deactivate)")
                     elif buttonTime >= .3: #activate/reactivate
-                        self._status = 1
+                        status = 1
                         logging.debug("button status 1 (reactivate)")
                         
+                    if status:
+                        self._status = status
+                        if self.event_bus is not None:
+                            self.event_bus.publish(BUTTON_GESTURE, status=status, duration=buttonTime)
+                        
                         
         except KeyboardInterrupt:    
             cleanup()
@@ -95,52 +123,71 @@ class ButtonThread(threading.Thread):
 
 class LED_Thread(threading.Thread):
     
-    def __init__(self, ledPin):
-        super().__init__()
+    #use_pwm: hand blinking to the GPIO library's PWM (runs outside Python) instead of toggling the pin from this thread
+    #deadlines: DeadlineScheduler that toggles the LED at each blink deadline (this thread then only plays patterns)
+    def __init__(self, ledPin, use_pwm=False, deadlines=None):
+        super().__init__(name="led")
         
         logging.info("initializing LED thread")
         
         self.ledPin = ledPin
-        self.set_mode(1) #initializes blinking as in pre-activation period
+        self.deadlines = deadlines
+        self._blink_timer = None
+        self._playing = False #a pattern owns the LED
+        self._cond = threading.Condition() #wakes the thread on mode changes and new patterns
+        self._patterns = [] #queued one-shot patterns: ([(level, seconds), ...], threading.Event set when done)
         
         # GPIO.setmode(GPIO.BOARD)
         GPIO.setup(self.ledPin, GPIO.OUT)
         
         self.current_status = 0 #0 for low, 1 for high
         GPIO.output(self.ledPin, GPIO.LOW)
-        self.last_switch = datetime.utcnow()
+        self.last_switch = time.monotonic()
+        
+        self._pwm = GPIO.PWM(self.ledPin, 1) if use_pwm else None
+        self._pwm_running = False
+        
+        self.set_mode(1) #initializes blinking as in pre-activation period
         
     def get_mode(self):
         return self._mode
         
     def set_mode(self,mode):
         logging.debug(f"setting LED mode to {mode}")
-        self._mode = mode
-        if mode == 0: #deactivated - system doesn't blink (blinkrate var not used)
-            self.blinkrate == 1E12
-        elif mode == 1: #mode 1 = waiting for initial activation
-            self.blinkrate = 0.1 #blink at 5 Hz (change status every 0.1 sec)
-        elif mode == 2: #mode 2 = active system
-            self.blinkrate = 0.5 #blink at 1 Hz (change status every 0.5 sec)
-        elif mode == 3: #mode 3 = in delay between activations
-            self.blinkrate = 1 #blink at 0.5 Hz (change status every 1 sec)
+        with self._cond:
+            self._mode = mode
+            if mode == 0: #deactivated - system doesn't blink (blinkrate var not used)
+                self.blinkrate = 1E12
+            elif mode == 1: #mode 1 = waiting for initial activation
+                self.blinkrate = 0.1 #blink at 5 Hz (change status every 0.1 sec)
+            elif mode == 2: #mode 2 = active system
+                self.blinkrate = 0.5 #blink at 1 Hz (change status every 0.5 sec)
+            elif mode == 3: #mode 3 = in delay between activations
+                self.blinkrate = 1 #blink at 0.5 Hz (change status every 1 sec)
+            if not self._patterns and not self._playing:
+                self._apply_pwm()
+                self._schedule_blink()
+            self._cond.notify()
             
             
     def set_on(self):
         GPIO.output(self.ledPin,GPIO.HIGH)
             
-    #unique blink pattern to acknowledge shutdown
+    #unique blink pattern to acknowledge shutdown, played by the LED thread (returns an Event set once it is done)
     def acknowledge_blink(self):
-        cmode = self._mode
-        self.set_mode(0) #deactivate LED
-        time.sleep(0.25)
+        pattern = [(GPIO.LOW, 0.25)]
         for i in range(5):
-            if i != 3:
-                GPIO.output(self.ledPin,GPIO.HIGH)
-            time.sleep(0.2)
-            GPIO.output(self.ledPin,GPIO.LOW)
-            time.sleep(0.2)
-        self.set_mode(cmode)
+            pattern.append((GPIO.HIGH if i != 3 else GPIO.LOW, 0.2))
+            pattern.append((GPIO.LOW, 0.2))
+        return self.play_pattern(pattern)
+        
+    #queues a one-shot pattern of (level, seconds) steps, after which the current mode's blinking resumes
+    def play_pattern(self, pattern):
+        done = threading.Event()
+        with self._cond:
+            self._patterns.append((pattern, done))
+            self._cond.notify()
+        return done
         
     def switch_light(self):
         # logging.info("switching LED")
@@ -150,19 +197,83 @@ class LED_Thread(threading.Thread):
         else:
             GPIO.output(self.ledPin, GPIO.LOW)
             self.current_status = 0
-        self.last_switch = datetime.utcnow()
+        self.last_switch = time.monotonic()
+        
+    #next toggle on the deadline scheduler, if blinking is up to it (call with _cond held)
+    def _schedule_blink(self):
+        if self._blink_timer is not None:
+            self._blink_timer.cancel()
+            self._blink_timer = None
+        if self.deadlines is not None and self._mode != 0 and self._pwm is None:
+            self._blink_timer = self.deadlines.call_at(self.last_switch + self.blinkrate, self._blink)
+            
+    def _blink(self):
+        with self._cond:
+            if self._playing or self._mode == 0:
+                return #rescheduled once the pattern is over / the mode changes
+            self.switch_light()
+            self._schedule_blink()
+            
+    #PWM blinks at 1/(2*blinkrate) Hz with a 50% duty cycle (call with _cond held)
+    def _apply_pwm(self):
+        if self._pwm is None:
+            return
+        if self._mode == 0:
+            if self._pwm_running:
+                self._pwm.stop()
+                self._pwm_running = False
+            GPIO.output(self.ledPin, GPIO.LOW)
+        else:
+            self._pwm.ChangeFrequency(1/(2*self.blinkrate))
+            if not self._pwm_running:
+                self._pwm.start(50)
+                self._pwm_running = True
+            
+    #plays a pattern step by step at its deadlines (call with _cond held)
+    def _play(self, pattern):
+        self._playing = True
+        if self._pwm_running:
+            self._pwm.stop()
+            self._pwm_running = False
+        deadline = time.monotonic()
+        for level, seconds in pattern:
+            GPIO.output(self.ledPin, level)
+            deadline += seconds
+            while time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+        GPIO.output(self.ledPin, GPIO.LOW)
+        self.current_status = 0
+        self.last_switch = time.monotonic()
+        self._playing = False
+        self._apply_pwm()
+        self._schedule_blink()
             
         
+    #sleeps until the next toggle is due (or indefinitely while the LED is off / driven by PWM or the deadline scheduler)
     def run(self):
         logging.debug("starting LED thread")
         try:
-            while True:
-                if self._mode == 0:
-                    GPIO.output(self.ledPin, GPIO.LOW)
-                elif (datetime.utcnow() - self.last_switch).total_seconds() >= self.blinkrate:
-                    self.switch_light()
-                        
-                time.sleep(0.05) 
+            with self._cond:
+                while True:
+                    count_iteration()
+                    if self._patterns:
+                        pattern, done = self._patterns.pop(0)
+                        self._play(pattern)
+                        done.set()
+                        continue
+                    
+                    if self._mode == 0 or self._pwm is not None or self.deadlines is not None:
+                        if self._mode == 0:
+                            GPIO.output(self.ledPin, GPIO.LOW)
+                            self.current_status = 0
+                        self._cond.wait() #no wakeups until the mode changes or a pattern is queued
+                        continue
+                    
+                    remaining = self.last_switch + self.blinkrate - time.monotonic()
+                    if remaining > 0:
+                        self._cond.wait(remaining)
+                    else:
+                        self.switch_light()
                 
         except KeyboardInterrupt:    
             cleanup()
@@ -181,11 +292,30 @@ class LED_Thread(threading.Thread):
     
 class MotionThread(threading.Thread):
     
-    def __init__(self, echoPin, trigPin, distThresh, Nobs, initial_delay, refresh_activation_limit):
+    #ranging_mode: "poll" busy-waits on the echo pin, "edge" timestamps the echo edges from GPIO callbacks
+    #echo_timeout: max time (sec) to wait for a full echo pulse before returning NO_ECHO
+    #burst_size: pings per cycle (the median of the valid ones is used), burst_gap: min time (sec) between ping starts
+    #cycle_period: time (sec) between the start of consecutive measurement cycles
+    #robust_baseline: compare ranges against the median of the last Nobs values instead of the mean
+    #event_bus: publishes MOTION_DETECTED and MODE_CHANGE (delay_status) events if set
+    #recorder: TraceRecorder that every sample is written to
+    #adaptive: sample every idle_period (sec) instead of cycle_period while the scene is stable or the sensor can't
+    #activate, switching back to cycle_period when the ranges start to vary or wake_ahead sec before the delay expires
+    #(stable = window std below stable_std cm, default distThresh/4, and the last range within distThresh/2 of the baseline)
+    #detector: detection rule, "mean" (range vs the last Nobs ranges), "ewma" or "cusum" (see detectors.py), with
+    #detector_params passed to its constructor
+    #deadlines: DeadlineScheduler that switches delay_status to 2 the moment a delay ends (otherwise that happens at the next sample)
+    def __init__(self, echoPin, trigPin, distThresh, Nobs, initial_delay, refresh_activation_limit, ranging_mode="poll", echo_timeout=0.04,
+                 burst_size=1, burst_gap=0.06, cycle_period=0.2, robust_baseline=False, event_bus=None, recorder=None,
+                 adaptive=False, idle_period=1.0, wake_ahead=5, stable_std=None, detector="mean", detector_params=None, deadlines=None):
         
         logging.info("initializing motion thread")
         
-        super().__init__()
+        super().__init__(name="motion")
+        self.event_bus = event_bus
+        self.recorder = recorder
+        self.deadlines = deadlines
+        self._ready_timer = None
         # GPIO.setmode(GPIO.BOARD)
         self.echoPin = echoPin
         self.trigPin = trigPin
@@ -195,110 +325,369 @@ class MotionThread(threading.Thread):
         
         GPIO.output(self.trigPin, GPIO.LOW) #set trigger pin LOW
         
-        self._range_values = []
+        self.echo_timeout = echo_timeout
+        self.ranging_mode = ranging_mode
+        if ranging_mode == "edge":
+            self._echo_rise = None
+            self._echo_fall = None
+            self._echo_armed = False #a ping is waiting for its edges
+            self._echo_done = threading.Event()
+            GPIO.add_event_detect(self.echoPin, GPIO.BOTH, callback=self._echo_edge)
+        elif ranging_mode != "poll":
+            raise ValueError(f"unknown ranging mode {ranging_mode!r} (expected 'poll' or 'edge')")
+        
         self.Nobs = Nobs #number of obs to determine mean in list
         
         self.distThresh = distThresh #distance change threshold (cm) to detect motion
         
+        #robust_baseline sets the detector's baseline for "mean"; the others only keep it for the range window below
+        self.detector = make_detector(detector, distThresh, Nobs, robust=robust_baseline and detector == "mean",
+                                      **(detector_params or {}))
+        self._range_values = self.detector.window #ring buffer of the last Nobs ranges (shared with the mean detector)
+        if self._range_values is None:
+            self._range_values = RollingStats(Nobs, robust=robust_baseline)
+        
         self.refresh_activation_limit = refresh_activation_limit*60 #time (minutes) required between sensor triggers 
         
+        self._step_lock = threading.Lock() #held while sampling so set_params changes apply between samples
+        self._state_lock = threading.Lock() #delay transitions (sensor thread and deadline scheduler)
         self._activated = False
+        self.last_activation = None #time.monotonic() of the last real activation
         self.set_activation_time(initial_delay)
         
-        self._range = np.NaN
+        self.burst_size = burst_size
+        self.burst_gap = burst_gap
+        self.cycle_period = cycle_period
+        
+        self.adaptive = adaptive
+        self.idle_period = idle_period
+        self.wake_ahead = wake_ahead
+        self.stable_std = distThresh/4 if stable_std is None else stable_std
+        self._stable_std_derived = stable_std is None #follows distThresh changes in set_params
+        self.standby = False #system deactivated, activations are ignored
+        self._idle = False
+        
+        self.last_trace = None #latency trace of the most recent activation
+        self._sample_time = None #time.monotonic() of the last range measurement
+        self._range = math.nan
+        self._pulse_len = math.nan #echo pulse length (sec) of the last ping
+        self._baseline = math.nan #baseline the last range was compared against
+        self._range_spread = math.nan #median absolute deviation (cm) of the pings in the last burst (NaN without bursts)
     
         
         
-    #adjusts when the motion sensor thinks it last activated so it can't activate the first time until the specified initial delay (minutes) has passed
-    def set_activation_time(self,initial_delay):
-        self._last_activated = datetime.utcnow() - timedelta(seconds = (self.refresh_activation_limit - initial_delay*60)) 
-        self.delay_status = 1 #changes to 1 when activated and 2 when in post-activation delay
+    #the motion sensor can't activate the first time until the specified initial delay (minutes) has passed
+    #(now: time.monotonic(), only passed in when replaying recorded data, in trace seconds)
+    def set_activation_time(self,initial_delay, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._state_lock:
+            self.initial_delay = initial_delay
+            self._delay_started = now
+            self.delay_status = 1 #changes to 2 when the delay is over and 3 when in post-activation delay
+            self._set_ready_at(now + initial_delay*60)
+            
+    #moves the end of the current delay to deadline (monotonic), where the deadline scheduler (if any) fires
+    #_on_ready (call with _state_lock held)
+    def _set_ready_at(self, deadline):
+        self._ready_at = deadline
+        if self.deadlines is not None:
+            if self._ready_timer is not None:
+                self._ready_timer.cancel()
+            self._ready_timer = self.deadlines.call_at(deadline, self._on_ready)
+            
+    def _on_ready(self):
+        with self._state_lock:
+            self._update_ready(time.monotonic())
+            
+    #switches to delay_status 2 once the current delay is over ("armed" after the initial delay, "cooldown expired"
+    #after an activation), returns whether the sensor can activate (call with _state_lock held)
+    def _update_ready(self, now):
+        if self._activated or now < self._ready_at:
+            return False
+        if self._delay_status != 2:
+            logging.debug("motion sensor armed" if self._delay_status == 1 else "motion sensor cooldown expired")
+            self.delay_status = 2
+        return True
+        
+    #1 = initial delay, 2 = ready to activate, 3 = in delay after an activation (published as MODE_CHANGE on change)
+    @property
+    def delay_status(self):
+        return self._delay_status
+        
+    @delay_status.setter
+    def delay_status(self, status):
+        changed = status != getattr(self, "_delay_status", None)
+        self._delay_status = status
+        if changed and self.event_bus is not None:
+            self.event_bus.publish(MODE_CHANGE, source="sensor", delay_status=status)
         
     def get_status(self):
         return self._activated
         
         
     def deactivate(self): #for parent thread to deactivate motion trigger after acknowledging it
-        self._activated = False
+        if self._activated:
+            self._activated = False
+            if self.deadlines is not None:
+                self._on_ready() #the delay may have run out before the activation was acknowledged
+        
+        
+    #changes detection parameters while running, all at once between two samples (None leaves a value as it is)
+    #the baseline is kept: a new Nobs keeps the newest ranges, and a new initial_delay or refresh_activation_limit
+    #(minutes) moves the end of a running delay instead of restarting it
+    def set_params(self, distThresh=None, Nobs=None, initial_delay=None, refresh_activation_limit=None):
+        for name, value, minimum in (("distThresh", distThresh, 0), ("Nobs", Nobs, 1), ("initial_delay", initial_delay, 0),
+                                     ("refresh_activation_limit", refresh_activation_limit, 0)):
+            if value is not None and not (math.isfinite(value) and value >= minimum): #rejects NaN, which compares False
+                raise ValueError(f"invalid {name} {value!r} (must be a finite number of at least {minimum})")
+            
+        with self._step_lock:
+            distThresh = self.distThresh if distThresh is None else distThresh
+            Nobs = self.Nobs if Nobs is None else int(Nobs)
+            self.detector.configure(distThresh, Nobs)
+            if self._range_values is not self.detector.window and Nobs != self.Nobs:
+                self._range_values.resize(Nobs)
+            self.distThresh = distThresh
+            self.Nobs = Nobs
+            if self._stable_std_derived:
+                self.stable_std = distThresh/4
+            
+            with self._state_lock:
+                if refresh_activation_limit is not None:
+                    self.refresh_activation_limit = refresh_activation_limit*60
+                    if self.delay_status == 3:
+                        self._set_ready_at(self._last_activated + self.refresh_activation_limit)
+                if initial_delay is not None:
+                    self.initial_delay = initial_delay
+                    if self.delay_status == 1:
+                        self._set_ready_at(self._delay_started + self.initial_delay*60)
+        logging.info(f"motion thread parameters: distThresh={self.distThresh} Nobs={self.Nobs} initial_delay={self.initial_delay} "
+                     f"refresh_activation_limit={self.refresh_activation_limit/60}")
+        
+    #snapshot of the sensor's state for status reports
+    def get_state(self):
+        return {"sensor": "ultrasonic", "delay_status": self.delay_status, "activated": self._activated, "standby": self.standby,
+                "range": self._range, "range_spread": self._range_spread, "baseline": self._baseline,
+                "last_activation": None if self.last_activation is None else wall_time(self.last_activation).isoformat(),
+                "distThresh": self.distThresh, "Nobs": self.Nobs, "initial_delay": self.initial_delay,
+                "refresh_activation_limit": self.refresh_activation_limit/60, "detector": self.detector.snapshot()}
+        
+    #starts the post-activation delay without activating (another sensor covering the same area just activated)
+    def hold_off(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._state_lock:
+            self._last_activated = now
+            self.delay_status = 3
+            self._set_ready_at(now + self.refresh_activation_limit)
         
     
-    def return_current_range(self): #callable method to retrieve last measured range
-        return self._range, self._range_values
+    #tells the sensor whether the system is deactivated (it then samples at the idle rate, if adaptive)
+    def set_standby(self, standby):
+        self.standby = standby
+        
+        
+    def return_current_range(self): #callable method to retrieve last measured range and (zero-copy) recent ranges
+        return self._range, self._range_values.view()
         
         
-    #retrieve a single range measurement from ultrasonic sensor
+    #retrieve a single range measurement from ultrasonic sensor (NO_ECHO if the echo times out)
     def get_range(self):
+        if self.ranging_mode == "edge":
+            pulselen = self._get_pulse_edge()
+        else:
+            pulselen = self._get_pulse_poll()
+        self._pulse_len = math.nan if pulselen is None else pulselen
+            
+        if pulselen is None:
+            logging.debug("no echo received")
+            return NO_ECHO
+        
+        #speed of sound = 343 m/s
+        #distance (m) = time (s) * sound speed
+        #distance (cm) = time (s) / 2 (two way trip) * 100 (m -> cm); 343*100/2
+        distance_cm = round(17150.0 * pulselen, 1) #round to nearest mm (error is 3 mm anyways)
+        
+        if distance_cm > 100: #setting max range to 1 m
+            distance_cm = 200
+        
+        return distance_cm
+        
+        
+    #fires burst_size pings (burst_gap apart) and returns the median and median absolute deviation of the valid
+    #ranges, or (NO_ECHO, NaN) when every ping timed out
+    def get_burst_range(self):
+        ranges = []
+        for i in range(self.burst_size):
+            if i > 0:
+                time.sleep(max(0, self.burst_gap - (time.perf_counter() - ping_start))) #let previous echoes die out
+            ping_start = time.perf_counter()
+            distance_cm = self.get_range()
+            if not math.isnan(distance_cm): #reject timed out pings
+                ranges.append(distance_cm)
+                
+        if not ranges:
+            return NO_ECHO, math.nan
+        
+        center = median(ranges)
+        return center, median([abs(r - center) for r in ranges])
+        
         
-        #send signal through trigger pin for 10 microseconds
+    #send signal through trigger pin for 10 microseconds
+    def _trigger(self):
         GPIO.output(self.trigPin, GPIO.HIGH)
         time.sleep(0.00001)
         GPIO.output(self.trigPin, GPIO.LOW)
         
+        
+    #busy-waits on the echo pin, returns pulse length (sec) or None on timeout
+    def _get_pulse_poll(self):
+        backend = get_backend()
+        read, pin, low, high = backend.input, self.echoPin, backend.LOW, backend.HIGH #looked up once, not per read
+        self._trigger()
+        deadline = time.perf_counter() + self.echo_timeout
+        
         #wait for echo signal to start
-        while GPIO.input(self.echoPin) == GPIO.LOW:
-            start = time.time() #constantly update start time, last value right before echoPin goes high
+        start = time.perf_counter()
+        while read(pin) == low:
+            start = time.perf_counter() #constantly update start time, last value right before echoPin goes high
+            if start > deadline:
+                return None
             
         #wait for echo signal to finish
-        while GPIO.input(self.echoPin) == GPIO.HIGH:
-            finish = time.time() #constantly update finish time, last value right before echoPin goes low
+        finish = time.perf_counter()
+        while read(pin) == high:
+            finish = time.perf_counter() #constantly update finish time, last value right before echoPin goes low
+            if finish > deadline:
+                return None
         
-        pulselen = finish - start #total pulse length (corresponds to round trip time for sound)
+        return finish - start #total pulse length (corresponds to round trip time for sound)
         
-        #speed of sound = 343 m/s
-        #distance (m) = time (s) * sound speed
-        #distance (cm) = time (s) / 2 (two way trip) * 100 (m -> cm); 343*100/2
-        distance_cm = np.round(17150.0 * pulselen, 1) #round to nearest mm (error is 3 mm anyways)
         
-        if distance_cm > 100: #setting max range to 1 m
-            distance_cm = 200
+    #sleeps until the echo callbacks have timestamped both edges, returns pulse length (sec) or None on timeout
+    def _get_pulse_edge(self):
+        self._echo_rise = None
+        self._echo_fall = None
+        self._echo_done.clear()
+        self._echo_armed = True
         
-        return distance_cm
+        self._trigger()
+        if not self._echo_done.wait(self.echo_timeout):
+            self._echo_armed = False
+            return None
+        return self._echo_fall - self._echo_rise
+        
+        
+    #GPIO callback for both echo edges, timestamps them with a monotonic high-resolution clock
+    #the first edge after the trigger is the rise and the next one the fall: the pin isn't read again, since a short
+    #echo (~100 us at a few cm) has often ended by the time the callback runs
+    def _echo_edge(self, channel):
+        now = time.perf_counter()
+        if not self._echo_armed:
+            return #an edge left over from a previous (timed out) ping
+        if self._echo_rise is None:
+            self._echo_rise = now
+        else:
+            self._echo_fall = now
+            self._echo_armed = False
+            self._echo_done.set()
         
         
     def check_range_diff(self):
-        detected = False
-        self._range = self.get_range()
+        if self.burst_size > 1:
+            self._range, self._range_spread = self.get_burst_range()
+        else:
+            self._range = self.get_range()
+        self._sample_time = time.monotonic()
         
-        #triggers motion detector when range on sensor differs from observed range by measured amount
-        if np.abs(self._range - np.nanmean(np.asarray(self._range_values))) >= self.distThresh:
-            detected = True
-            
-        self._range_values.append(self._range) #adding new ob to range calculations for future iterations
+        #triggers motion detector when range on sensor differs from the expected range (see detectors.py)
+        self._baseline = self.detector.baseline
+        detected = self.detector.update(self._range)
         
-        #keeping list to specified length if necessary
-        if len(self._range_values) > self.Nobs:
-            self._range_values.pop(0) #drop the first (oldest) observation
+        if self._range_values is not self.detector.window:
+            self._range_values.push(self._range) #(the mean detector pushes to this window itself)
         
         return detected
         
         
             
+    #applies the activation rules to the latest detection result, returns True if the sensor just activated
+    #(now: time.monotonic(), only passed in when replaying recorded data, in trace seconds)
+    def check_activation(self, detected, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self._activated or now < self._ready_at or (not detected and self._delay_status == 2):
+            return False #nothing to change (checked again under the lock before anything is)
+
+        with self._state_lock:
+            #checking if activation delay is passed
+            if self._update_ready(now) and detected:
+                logging.debug(f"motion detected (range {self._range}, spread {self._range_spread}, {self.detector.snapshot()})")
+                self.last_trace = Trace() #follows this activation through to playback
+                self.last_trace.mark("sample", self._sample_time)
+                self.last_trace.mark("detect")
+                self._activated = True
+                self._last_activated = now
+                self.last_activation = now
+                self.delay_status = 3
+                self._set_ready_at(now + self.refresh_activation_limit)
+                if self.event_bus is not None:
+                    self.event_bus.publish(MOTION_DETECTED, source="ultrasonic", range=self._range,
+                                           range_spread=self._range_spread, trace=self.last_trace)
+                return True
+        return False
+        
+        
+    #one measurement cycle, returns True if the sensor just activated
+    def step(self, now=None):
+        
+        #to set self.activated = True (which triggers audio in the main thread):
+        # the distance must differ from mean 5 previous values by greater than the threshold
+        # the previous activation must be outside the time limit assigned when initializing the thread
+        
+        #this function is called regardless of whether the system is "active" because it needs to 
+        #keep getting observations to create an accurate mean distance
+        with self._step_lock:
+            detected = self.check_range_diff()
+            activated = self.check_activation(detected, now)
+            if self.recorder is not None:
+                self.recorder.record(self._sample_time, self._pulse_len, self._range, self._baseline, detected, self._activated, self.delay_status)
+        return activated
+        
+        
+    #time (sec) from the start of this cycle to the start of the next: cycle_period, or idle_period if adaptive and
+    #sampling fast can't make a difference right now (the baseline keeps being updated either way)
+    def next_period(self, now=None):
+        if not self.adaptive:
+            return self.cycle_period
+        
+        if self.standby or self._activated:
+            idle = True
+        else:
+            if now is None:
+                now = time.monotonic()
+            if self._ready_at - now > self.wake_ahead:
+                idle = True #in a delay that won't expire before the next few idle samples
+            else:
+                #ready (or about to be): only idle while the scene is stable
+                idle = self._range_values.std() < self.stable_std and not abs(self._range - self._baseline) >= self.distThresh/2
+        
+        if idle != self._idle:
+            logging.debug(f"motion thread sampling {'idle' if idle else 'fast'}")
+            self._idle = idle
+        return self.idle_period if idle else self.cycle_period
+        
+        
     def run(self):
         logging.debug("starting motion thread")
         try:
             
             while True:
-                
-                #to set self.activated = True (which triggers audio in the main thread):
-                # the distance must differ from mean 5 previous values by greater than the threshold
-                # the previous activation must be outside the time limit assigned when initializing the thread
-                
-                #this function is called regardless of whether the system is "active" because it needs to 
-                #keep getting observations to create an accurate mean distance
-                detected = self.check_range_diff()
-                
-                #checking if activation delay is passed
-                if not self._activated and (datetime.utcnow() - self._last_activated).total_seconds() >= self.refresh_activation_limit:
-                    self.delay_status = 2
-                    
-                    #checking 
-                    if detected:
-                        logging.debug("motion detected")
-                        self._activated = True
-                        self._last_activated = datetime.utcnow()
-                        self.delay_status = 3
-                                    
-                time.sleep(0.2) # would be 5 Hz if not for time to calculate range
+                count_iteration()
+                cycle_start = time.perf_counter()
+                self.step()
+                time.sleep(max(0, self.next_period() - (time.perf_counter() - cycle_start))) #5 Hz by default, including ranging time
                 
         except KeyboardInterrupt:
             cleanup()
@@ -316,49 +705,198 @@ class AudioThread(threading.Thread):
     
     # import pygame
     
-    def __init__(self,audio_file):
+    #audio_file: WAV file to play, or a list of files / ClipLibrary to pick a clip from on each trigger
+    #engine: "alsa" plays the preloaded WAV in-process on a persistent PCM device, "aplay" runs aplay for every
+    #trigger, "auto" uses alsa if pyalsaaudio and the device are available and falls back to aplay otherwise,
+    #"mixer" mixes overlapping clips in-process (see audio_mixer.py, needs NumPy and pyalsaaudio): every trigger
+    #starts a new voice instead of being dropped while a clip is playing
+    #latency_tracker: LatencyTracker that receives the trace of each activation once its playback ends
+    #block_frames: frames per PCM period for the alsa and mixer engines (smaller = lower latency)
+    def __init__(self,audio_file, event_bus=None, engine="auto", device="hw:0,0", latency_tracker=None, block_frames=512):
         logging.info("initializing audio thread")
-        super().__init__()
+        super().__init__(name="audio")
+        self._lock = threading.Lock() #guards _is_playing/request_play so requests can't be lost
+        self._play_requested = threading.Event() #wakes the thread as soon as audio is requested
         self._is_playing = False
         self.request_play = False
+        self.event_bus = event_bus #publishes PLAYBACK_STARTED/PLAYBACK_FINISHED events if set
+        self.latency_tracker = latency_tracker
+        self._trace = None #latency trace of the requested playback
         self.audio_file = audio_file
-        self.audio_command = "aplay -D hw:0,0 /home/pi/MotionDetector/soundsource.wav" #command to play audio file
+        self.device = device
         
-        #setting volume to 85%
-        cmd = "sudo amixer cset numid=1 85%" 
+        self.clip_library = None
+        if isinstance(audio_file, ClipLibrary):
+            self.clip_library = audio_file
+        elif isinstance(audio_file, (list, tuple)):
+            self.clip_library = ClipLibrary(audio_file)
+        else:
+            self.audio_command = ["aplay", "-D", device, audio_file] #command to play audio file (aplay engine)
+        
+        self._player = None
+        self._clip = None
+        self._mixer = None
+        self._output_closed = False #close_output() released the device on purpose (disarmed)
+        if engine == "mixer":
+            self._clip = self.clip_library.get(self.clip_library.files[0]) if self.clip_library is not None else load_wav(audio_file)
+            self._player = PCMPlayer(device=device, period_frames=block_frames)
+            self._mixer = Mixer(self._player, self._clip.channels, self._clip.framerate, block_frames=block_frames)
+            self._mixer.start()
+        elif engine in ("alsa", "auto"):
+            try:
+                if self.clip_library is not None:
+                    self._clip = self.clip_library.get(self.clip_library.files[0]) #output device format (and warms the cache)
+                else:
+                    self._clip = load_wav(audio_file) #decoded once, played from memory
+                self._player = PCMPlayer(device=device, period_frames=block_frames)
+                self._player.open(self._clip.channels, self._clip.sampwidth, self._clip.framerate)
+            except Exception as e:
+                if engine == "alsa":
+                    raise
+                logging.warning(f"in-process audio unavailable ({e!r}), falling back to aplay")
+                self._player = None
+        elif engine != "aplay":
+            raise ValueError(f"unknown audio engine {engine!r} (expected 'alsa', 'aplay', 'mixer' or 'auto')")
+        
+        self.volume = None
+        self.set_volume(85) #setting volume to 85%
+        
+        
+    #sets the output volume (percent), also while playing
+    def set_volume(self, percent):
+        if not 0 <= percent <= 100:
+            raise ValueError(f"invalid volume {percent!r} (must be 0-100)")
+        cmd = f"sudo amixer cset numid=1 {percent:g}%"
         subprocess.run(cmd.split())
+        self.volume = percent
+        
+    #snapshot of the player's state for status reports
+    def get_state(self):
+        if self._mixer is not None:
+            return {"playing": self._mixer.active > 0, "voices": self._mixer.active, "engine": "mixer", "volume": self.volume}
+        return {"playing": self._is_playing, "engine": "aplay" if self._player is None else "alsa", "volume": self.volume}
         
         
-    #call from parent thread when it is time to play the audio
-    def request_play_audio(self):
-        logging.debug(f"requesting to play audio (_is_playing = {self._is_playing}")
-        if not self._is_playing:
-            self._is_playing = True
-            self.request_play = True
+    #keeps the output device open while the system is armed (no-op for aplay; the mixer's stream is always open)
+    def open_output(self):
+        self._output_closed = False
+        if self._player is not None and self._mixer is None:
+            self._player.open(self._clip.channels, self._clip.sampwidth, self._clip.framerate)
+            
+    #releases the output device while disarmed, cutting off anything playing (the mixer fades its voices out instead)
+    def close_output(self):
+        self._output_closed = True
+        if self._mixer is not None:
+            self._mixer.stop_all(fade=0.05)
+        elif self._player is not None:
+            self._player.stop()
+            self._player.close()
+            
+    #ramps the gain of everything playing to gain (e.g. 0.2 to duck, 1 to restore) over fade seconds (mixer only)
+    def duck(self, gain, fade=0.2):
+        if self._mixer is None:
+            raise ValueError("ducking needs the mixer audio engine")
+        self._mixer.set_master_gain(gain, fade)
+        
+    #starts audio_file (default: the next trigger clip) as a new mixer voice, returns its Voice (mixer only)
+    #gain: linear gain, loop: repeat until cancelled (e.g. an ambient bed), fade_in: seconds to ramp up from silence
+    #trace: latency Trace of the activation, if any
+    def play_clip(self, audio_file=None, gain=1.0, loop=False, fade_in=0.0, trace=None):
+        if self._mixer is None:
+            raise ValueError("overlapping playback needs the mixer audio engine")
+        if audio_file is None:
+            clip = self._clip if self.clip_library is None else self.clip_library.next_clip()
+        else:
+            clip = self.clip_library.get(audio_file) if self.clip_library is not None else load_wav(audio_file)
+        
+        def on_start():
+            if trace is not None:
+                trace.mark("playback_start")
+            if self.event_bus is not None:
+                self.event_bus.publish(PLAYBACK_STARTED)
+                
+        def on_end(completed):
+            if trace is not None:
+                trace.mark("playback_end")
+                if self.latency_tracker is not None:
+                    self.latency_tracker.finish(trace)
+            if self.event_bus is not None:
+                self.event_bus.publish(PLAYBACK_FINISHED, returncode=0 if completed else 1)
+                
+        logging.debug(f"mixing in {clip.filename}")
+        return self._mixer.play(clip, gain=gain, loop=loop, fade_in=fade_in, on_start=on_start, on_end=on_end)
+        
+        
+    #call from parent thread when it is time to play the audio (trace: latency Trace of the activation, if any)
+    def request_play_audio(self, trace=None):
+        if self._mixer is not None:
+            if trace is not None:
+                trace.mark("request")
+            self.play_clip(trace=trace) #mixed over anything already playing
+            return
+        with self._lock:
+            logging.debug(f"requesting to play audio (_is_playing = {self._is_playing}")
+            if not self._is_playing:
+                if trace is not None:
+                    trace.mark("request")
+                self._trace = trace
+                self._is_playing = True
+                self.request_play = True
+                self._play_requested.set()
     
          
-    #constantly running loop monitoring to play audio   
+    #sleeps until audio is requested, then plays it
     def run(self):
         logging.debug("starting audio thread")
         while True:
-            if self.request_play:
-                self._is_playing = True
+            count_iteration()
+            self._play_requested.wait()
+            with self._lock:
+                self._play_requested.clear()
                 self.request_play = False
-                self.play_audio()
+                trace, self._trace = self._trace, None
+                
+            if self.event_bus is not None:
+                self.event_bus.publish(PLAYBACK_STARTED)
+            returncode = self.play_audio(trace)
+            with self._lock:
                 self._is_playing = False
-            
-            time.sleep(0.2) 
+            if trace is not None:
+                trace.mark("playback_end")
+                if self.latency_tracker is not None:
+                    self.latency_tracker.finish(trace)
+            if self.event_bus is not None:
+                self.event_bus.publish(PLAYBACK_FINISHED, returncode=returncode)
                 
             
-    #play audio (WAV file) with pygame
-    def play_audio(self):
+    #play audio (WAV file), stamping playback_start on the trace when the first audio goes out
+    def play_audio(self, trace=None):
         logging.debug("playing audio")
         # self.pygame.mixer.init()
         # self.pygame.mixer.music.load(self.audio_file)
         # self.pygame.mixer.music.play()
         # while self.pygame.mixer.music.get_busy() == True:
         #     time.sleep(0.1)
-        subprocess.run(self.audio_command.split())
+        if self._mixer is not None:
+            clip = self._clip if self.clip_library is None else self.clip_library.next_clip()
+            on_start = None if trace is None else (lambda: trace.mark("playback_start"))
+            completed = []
+            voice = self._mixer.play(clip, on_start=on_start, on_end=completed.append)
+            voice.done.wait()
+            return 0 if completed[0] else 1
+        if self._player is not None:
+            clip = self._clip if self.clip_library is None else self.clip_library.next_clip()
+            logging.debug(f"playing {clip.filename}")
+            on_start = None if trace is None else (lambda: trace.mark("playback_start"))
+            completed = self._player.play(clip, on_start=on_start)
+            if self._output_closed:
+                self._player.close() #played while disarmed (e.g. a control socket test): the device stays released
+            return 0 if completed else 1
+        if trace is not None:
+            trace.mark("playback_start") #aplay: process launch (its startup time is included in playback_end)
+        if self.clip_library is not None:
+            return subprocess.run(["aplay", "-D", self.device, self.clip_library.next_filename()]).returncode
+        return subprocess.run(self.audio_command).returncode
         
             
             
@@ -370,20 +908,107 @@ class AudioThread(threading.Thread):
 #                           MAIN EVENT LOOP                                                              #
 ##########################################################################################################
 
+#handles button gestures and motion events as soon as they are published (shared with motion_detector_IR.py)
+#events must be subscribed to the bus before the threads are started so no early events are missed
+#before_poweroff: called before the power off command, to write out buffered data (trace records, stored events)
+def run_main_loop(motionThread, buttonMonitor, ledMonitor, audioThread, event_bus, events, before_poweroff=None):
+    
+    systemActive = True #whether or not system is active
+    log_armed() #every thread is running now
+    
+    #main event loop, keeping track of button presses, motion sensing and triggering audio to play
+    try:
+    
+        while True:
+            count_iteration()
+            event = events.get() #sleeps until something happens
+            
+            if event.type == MOTION_DETECTED:
+                trace = event.data.get("trace")
+                if trace is not None:
+                    trace.mark("pickup")
+                if systemActive:
+                    audioThread.request_play_audio(trace)
+                motionThread.deactivate()
+                
+            elif event.type == BUTTON_GESTURE:
+                buttonStatus = event.data["status"]
+                if buttonStatus == 3:
+                    logging.info("Shutting down")
+                    ledMonitor.acknowledge_blink().wait(5) #blink to acknowledge poweroff command
+                    if before_poweroff is not None:
+                        before_poweroff()
+                    cmd = "sudo shutdown -h now" #power off Pi
+                    subprocess.run(cmd.split())
+                    
+                elif buttonStatus == 2:
+                    logging.info("Deactivating")
+                    systemActive = False #deactivate motion sensor
+                    motionThread.set_standby(True)
+                    audioThread.close_output()
+                    event_bus.publish(MODE_CHANGE, source="system", active=False)
+                    
+                elif buttonStatus == 1:
+                    logging.info("Reactivating")
+                    motionThread.set_activation_time(0.25) #will wait 15 sec to activate
+                    motionThread.deactivate()
+                    motionThread.set_standby(False)
+                    systemActive = True
+                    audioThread.open_output()
+                    event_bus.publish(MODE_CHANGE, source="system", active=True)
+                    
+                buttonMonitor.reset_status()
+                
+            if not systemActive:
+                desiredLEDmode = 0
+            else:
+                desiredLEDmode = motionThread.delay_status
+                
+            #switching LED mode if necessary
+            if desiredLEDmode != ledMonitor.get_mode():
+                ledMonitor.set_mode(desiredLEDmode)
+            
+        
+    except KeyboardInterrupt:
+        cleanup()
+        
+        
+        
 if __name__ == "__main__":
     
-    logging.basicConfig(filename=f'motion_detector_{datetime.utcnow():%Y%m%d_%H%M}.log', level=logging.DEBUG)
+    setup_logging(f'motion_detector_{datetime.utcnow():%Y%m%d_%H%M}.log', level=logging.DEBUG) #writes from a background thread
     setup() #using BOARD pin numbers (not BCM)
     
+    eventBus = EventBus()
+    events = eventBus.subscribe([MOTION_DETECTED, BUTTON_GESTURE, MODE_CHANGE])
+    
+    aggregator = os.environ.get("MOTION_AGGREGATOR") #ships events in batches to udp://host:port or tcp://host:port if set
+    if aggregator:
+        eventShipper = EventShipper(eventBus, aggregator)
+        eventShipper.start()
+    
+    eventRecorder = EventRecorder(eventBus, os.environ.get("MOTION_EVENT_STORE", "events.db")) #local history for event_store.py queries
+    eventRecorder.start()
+    
+    latencyTracker = LatencyTracker(report_file=f'latency_{datetime.utcnow():%Y%m%d_%H%M}.jsonl')
+    latencyTracker.start()
+    
+    profileFile = os.environ.get("MOTION_PROFILE") #sampling profiler writing collapsed stacks (flame graphs) there if set
+    threadStats = ThreadStats(report_file=f'threads_{datetime.utcnow():%Y%m%d_%H%M}.jsonl', profile_file=profileFile)
+    threadStats.start() #per-thread CPU, loop iterations and wakeups every 5 minutes
+    
+    deadlines = DeadlineScheduler() #fires delay ends and LED blinks on time.monotonic()
+    deadlines.start()
+    
     #initiating button monitor
     buttonPin = 10 #connect button gpio to 10 and button ground to 9
-    buttonMonitor = ButtonThread(button_num=buttonPin)
+    buttonMonitor = ButtonThread(button_num=buttonPin, event_bus=eventBus)
     buttonMonitor.start()
     #modes = 1: activated, 2: deactivated, 3: off, 0: no new info
     
     #initiating LED device thread
     ledPin = 16
-    ledMonitor = LED_Thread(ledPin=ledPin)
+    ledMonitor = LED_Thread(ledPin=ledPin, deadlines=deadlines)
     ledMonitor.set_on() #initally just on while device starting up
     #modes: 1=initial activation delay (5 Hz), 2 = activated (1 Hz), 3 = between activations (0.5Hz), 0 = deactivated (off)
         
@@ -394,63 +1019,32 @@ if __name__ == "__main__":
     echoPin = 35 #returns echo time
     trigPin = 36 #triggers range detector observation
     distThresh = 10 #distance change in cm to trigger motion detector
-    motionThread = MotionThread(echoPin=echoPin, trigPin=trigPin, distThresh=distThresh, Nobs=20, initial_delay=0.5, refresh_activation_limit=10)
+    recordDir = os.environ.get("MOTION_RECORD_DIR") #records every sample to binary trace files there if set
+    recorder = TraceRecorder(recordDir, prefix="ultrasonic", deadlines=deadlines) if recordDir else None
+    motionThread = MotionThread(echoPin=echoPin, trigPin=trigPin, distThresh=distThresh, Nobs=20, initial_delay=0.5, refresh_activation_limit=10,
+                                ranging_mode=os.environ.get("MOTION_RANGING", "edge"), #edge: sleeps until the echo edges instead of busy-waiting
+                                event_bus=eventBus, recorder=recorder, adaptive=True, #samples at 1 Hz when nothing can happen
+                                detector=os.environ.get("MOTION_DETECTOR", "mean"), #mean, ewma or cusum
+                                deadlines=deadlines)
     motionThread.start()
     
     #initiating audio thread
-    audioFile = "soundsource.wav" 
-    audioThread = AudioThread(audio_file = audioFile)
+    audioFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "soundsource.wav")
+    audioThread = AudioThread(audio_file = audioFile, event_bus=eventBus, latency_tracker=latencyTracker,
+                              engine=os.environ.get("MOTION_AUDIO_ENGINE", "auto")) #"mixer" lets triggers overlap
     audioThread.start()
     
+    #status and live parameter changes over a Unix socket (python3 control_socket.py status)
+    controlServer = ControlServer(motionThread, audioThread, eventBus, threads={"motion": motionThread, "audio": audioThread,
+                                  "button": buttonMonitor, "led": ledMonitor})
+    controlServer.start()
     
+    #writes out buffered trace records and events (before a power off, or on exit)
+    def closeRecorders():
+        if recorder is not None:
+            recorder.close()
+        eventRecorder.stop()
+        eventRecorder.join(10)
     
-    
-    systemActive = True #whether or not system is active
-    
-    #main event loop, keeping track of button presses, motion sensing and triggering audio to play
-    try:
-    
-        while True:
-            if systemActive and motionThread.get_status():
-                audioThread.request_play_audio()
-            motionThread.deactivate()
-            
-            buttonStatus = buttonMonitor.get_status()
-            if buttonStatus == 3:
-                logging.info("Shutting down")
-                ledMonitor.acknowledge_blink() #blink to acknowledge poweroff command
-                cmd = "sudo shutdown -h now" #power off Pi
-                subprocess.run(cmd.split())
-                
-            elif buttonStatus == 2:
-                logging.info("Deactivating")
-                systemActive = False #deactivate motion sensor
-                
-            elif buttonStatus == 1:
-                logging.info("Reactivating")
-                motionThread.set_activation_time(0.25) #will wait 15 sec to activate
-                motionThread.deactivate()
-                systemActive = True
-                
-            buttonMonitor.reset_status()
-                
-            if not systemActive:
-                desiredLEDmode = 0
-            else:
-                desiredLEDmode = motionThread.delay_status
-                
-            #switching LED mode if necessary
-            if desiredLEDmode != ledMonitor.get_mode():
-                ledMonitor.set_mode(desiredLEDmode)
-            time.sleep(0.1)
-            
-        
-    except KeyboardInterrupt:
-        cleanup()
-        
-        
-        
-        
-        
-        
-        
\ No newline at end of file
+    run_main_loop(motionThread, buttonMonitor, ledMonitor, audioThread, eventBus, events, before_poweroff=closeRecorders)
+    closeRecorders()
@@ -8,172 +8,29 @@
 #                           GENERAL SETUP                                                                #
 ##########################################################################################################
 
-import RPi.GPIO as GPIO
-from datetime import datetime, timedelta
+from gpio_backend import GPIO
+from datetime import datetime
+import os
 import time
-import subprocess
 import threading
+import queue
 import logging
+import math
 
+#button, LED and audio threads and the main event loop are shared with the ultrasonic version
+from motion_detector import setup, cleanup, ButtonThread, LED_Thread, AudioThread, run_main_loop
+from event_bus import EventBus, MOTION_DETECTED, BUTTON_GESTURE, MODE_CHANGE
+from latency import Trace, LatencyTracker
+from trace_recorder import TraceRecorder
+from log_setup import setup_logging
+from control_socket import ControlServer
+from deadlines import DeadlineScheduler, wall_time
+from thread_stats import ThreadStats, count_iteration
+from event_shipper import EventShipper
+from event_store import EventRecorder
 
-def setup():
-    GPIO.setmode(GPIO.BOARD)
     
-def cleanup():
-    GPIO.cleanup()
 
-    
-
-
-##########################################################################################################
-#                           BUTTON CONTROL  THREAD                                                       #
-##########################################################################################################
-
-class ButtonThread(threading.Thread):
-    
-    def __init__(self, button_num):
-        super().__init__()
-        
-        logging.info("initializing button thread")
-        
-        self.button_num = button_num
-        self._status = 0
-        self._locked = False
-        
-        # GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(self.button_num, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        
-    def reset_status(self):
-        self._status = 0
-        
-    def get_status(self):
-        return self._status
-        
-    def run(self):
-        
-        logging.debug("starting button thread")
-        
-        try:
-            while True:
-                if not self._locked:
-                    GPIO.wait_for_edge(self.button_num, GPIO.FALLING)
-                    
-                    start = time.time()
-                    time.sleep(0.2) #allowing voltage to drop
-                
-                    while GPIO.input(self.button_num) == GPIO.LOW: #waiting for button release
-                        time.sleep(0.01)
-                        
-                    buttonTime = time.time() - start #getting button press duration
-                    
-                    
-                    if buttonTime >= 6: #power off
-                        self._status = 3
-                        logging.debug("button status 3 (poweroff)")
-                    elif buttonTime >= 3: #deactivate
-                        self._status = 2
-                        logging.debug("button status 2 (deactivate)")
-                    elif buttonTime >= .3: #activate/reactivate
-                        self._status = 1
-                        logging.debug("button status 1 (reactivate)")
-                        
-                        
-        except KeyboardInterrupt:    
-            cleanup()
-
-            
-            
-            
-            
-            
-##########################################################################################################
-#                               LED CONTROL THREAD                                                       #
-##########################################################################################################
-
-
-
-
-class LED_Thread(threading.Thread):
-    
-    def __init__(self, ledPin):
-        super().__init__()
-        
-        logging.info("initializing LED thread")
-        
-        self.ledPin = ledPin
-        self.set_mode(1) #initializes blinking as in pre-activation period
-        
-        # GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(self.ledPin, GPIO.OUT)
-        
-        self.current_status = 0 #0 for low, 1 for high
-        GPIO.output(self.ledPin, GPIO.LOW)
-        self.last_switch = datetime.utcnow()
-        
-    def get_mode(self):
-        return self._mode
-        
-    def set_mode(self,mode):
-        logging.debug(f"setting LED mode to {mode}")
-        self._mode = mode
-        if mode == 0: #deactivated - system doesn't blink (blinkrate var not used)
-            self.blinkrate == 1E12
-        elif mode == 1: #mode 1 = waiting for initial activation
-            self.blinkrate = 0.1 #blink at 5 Hz (change status every 0.1 sec)
-        elif mode == 2: #mode 2 = active system
-            self.blinkrate = 0.5 #blink at 1 Hz (change status every 0.5 sec)
-        elif mode == 3: #mode 3 = in delay between activations
-            self.blinkrate = 1 #blink at 0.5 Hz (change status every 1 sec)
-            
-            
-    def set_on(self):
-        GPIO.output(self.ledPin,GPIO.HIGH)
-            
-    #unique blink pattern to acknowledge shutdown
-    def acknowledge_blink(self):
-        cmode = self._mode
-        self.set_mode(0) #deactivate LED
-        time.sleep(0.25)
-        for i in range(5):
-            if i != 3:
-                GPIO.output(self.ledPin,GPIO.HIGH)
-            time.sleep(0.2)
-            GPIO.output(self.ledPin,GPIO.LOW)
-            time.sleep(0.2)
-        self.set_mode(cmode)
-        
-    def switch_light(self):
-        # logging.info("switching LED")
-        if self.current_status == 0:
-            GPIO.output(self.ledPin, GPIO.HIGH)
-            self.current_status = 1
-        else:
-            GPIO.output(self.ledPin, GPIO.LOW)
-            self.current_status = 0
-        self.last_switch = datetime.utcnow()
-            
-        
-    def run(self):
-        logging.debug("starting LED thread")
-        try:
-            while True:
-                if self._mode == 0:
-                    GPIO.output(self.ledPin, GPIO.LOW)
-                elif (datetime.utcnow() - self.last_switch).total_seconds() >= self.blinkrate:
-                    self.switch_light()
-                        
-                time.sleep(0.05) 
-                
-        except KeyboardInterrupt:    
-            cleanup()
-            
-
-
-
-
-
-    
-    
 
 ##########################################################################################################
 #                           MOTION DETECTOR THREAD                                                       #
@@ -181,60 +38,233 @@ class LED_Thread(threading.Thread):
     
 class MotionThread_IR(threading.Thread):
     
-    def __init__(self, pin, initial_delay, refresh_activation_limit):
+    #edge_triggered: sleep until the PIR output rises (GPIO interrupt) instead of polling the pin every 0.5 sec
+    #bouncetime: edges closer together than this (ms) are ignored in edge-triggered mode
+    #event_bus: publishes MOTION_DETECTED and MODE_CHANGE (delay_status) events if set
+    #recorder: TraceRecorder that every edge (edge-triggered) or poll is written to
+    #deadlines: DeadlineScheduler that switches delay_status to 2 the moment a delay ends (the edge-triggered thread
+    #then sleeps until the next edge)
+    def __init__(self, pin, initial_delay, refresh_activation_limit, edge_triggered=False, bouncetime=200, event_bus=None, recorder=None,
+                 deadlines=None):
         
         logging.info("initializing motion thread")
         
-        super().__init__()
+        super().__init__(name="motion-pir")
+        self.event_bus = event_bus
+        self.recorder = recorder
+        self.deadlines = deadlines
+        self._ready_timer = None
         # GPIO.setmode(GPIO.BOARD)
         self.pin = pin
         GPIO.setup(self.pin, GPIO.IN)
         
         self.refresh_activation_limit = refresh_activation_limit*60 #time (minutes) required between sensor triggers 
         
+        self.edge_triggered = edge_triggered
+        self._edges = queue.Queue() #time.monotonic() of rising edges from the GPIO callback (None just wakes the thread)
+        self.last_trace = None #latency trace of the most recent activation
+        
+        self._lock = threading.Lock() #delay transitions and set_params (sensor thread, deadline scheduler, control socket)
         self._activated = False
+        self.standby = False
+        self.last_activation = None #time.monotonic() of the last real activation
         self.set_activation_time(initial_delay)
         
+        if edge_triggered:
+            GPIO.add_event_detect(self.pin, GPIO.RISING, callback=self._on_rising, bouncetime=bouncetime)
+        
     
         
         
-    #adjusts when the motion sensor thinks it last activated so it can't activate the first time until the specified initial delay (minutes) has passed
-    def set_activation_time(self,initial_delay):
-        self._last_activated = datetime.utcnow() - timedelta(seconds = (self.refresh_activation_limit - initial_delay*60)) 
-        self.delay_status = 1 #changes to 1 when activated and 2 when in post-activation delay
+    #the motion sensor can't activate the first time until the specified initial delay (minutes) has passed
+    #(now: time.monotonic(), only passed in when replaying recorded data, in trace seconds)
+    def set_activation_time(self,initial_delay, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self.initial_delay = initial_delay
+            self._delay_started = now
+            self.delay_status = 1 #changes to 2 when the delay is over and 3 when in post-activation delay
+            self._set_ready_at(now + initial_delay*60)
+            
+    #moves the end of the current delay to deadline (monotonic), where the deadline scheduler (if any) fires
+    #_on_ready (call with _lock held)
+    def _set_ready_at(self, deadline):
+        self._ready_at = deadline
+        if self.deadlines is not None:
+            if self._ready_timer is not None:
+                self._ready_timer.cancel()
+            self._ready_timer = self.deadlines.call_at(deadline, self._on_ready)
+        elif self.edge_triggered:
+            self._edges.put(None) #edge-triggered thread recomputes when the delay expires
+            
+    def _on_ready(self):
+        with self._lock:
+            self._update_ready(time.monotonic())
+            
+    #switches to delay_status 2 once the current delay is over ("armed" after the initial delay, "cooldown expired"
+    #after an activation), returns whether the sensor can activate (call with _lock held)
+    def _update_ready(self, now):
+        if self._activated or now < self._ready_at:
+            return False
+        if self._delay_status != 2:
+            logging.debug("PIR sensor armed" if self._delay_status == 1 else "PIR sensor cooldown expired")
+            self.delay_status = 2
+        return True
+        
+    #1 = initial delay, 2 = ready to activate, 3 = in delay after an activation (published as MODE_CHANGE on change)
+    @property
+    def delay_status(self):
+        return self._delay_status
+        
+    @delay_status.setter
+    def delay_status(self, status):
+        changed = status != getattr(self, "_delay_status", None)
+        self._delay_status = status
+        if changed and self.event_bus is not None:
+            self.event_bus.publish(MODE_CHANGE, source="sensor", delay_status=status)
         
     def get_status(self):
         return self._activated
         
         
     def deactivate(self): #for parent thread to deactivate motion trigger after acknowledging it
-        self._activated = False
+        if self._activated:
+            self._activated = False
+            if self.deadlines is not None:
+                self._on_ready() #the delay may have run out before the activation was acknowledged
+            elif self.edge_triggered:
+                self._edges.put(None)
+                
+    #changes the activation delays (minutes) while running (None leaves a value as it is); a running delay is moved
+    #rather than restarted
+    def set_params(self, initial_delay=None, refresh_activation_limit=None):
+        for name, value in (("initial_delay", initial_delay), ("refresh_activation_limit", refresh_activation_limit)):
+            if value is not None and not (math.isfinite(value) and value >= 0): #rejects NaN, which compares False
+                raise ValueError(f"invalid {name} {value!r} (must be a finite number of at least 0)")
+        with self._lock:
+            if refresh_activation_limit is not None:
+                self.refresh_activation_limit = refresh_activation_limit*60
+                if self.delay_status == 3:
+                    self._set_ready_at(self._last_activated + self.refresh_activation_limit)
+            if initial_delay is not None:
+                self.initial_delay = initial_delay
+                if self.delay_status == 1:
+                    self._set_ready_at(self._delay_started + self.initial_delay*60)
+        logging.info(f"PIR motion thread parameters: initial_delay={self.initial_delay} refresh_activation_limit={self.refresh_activation_limit/60}")
+        
+    #snapshot of the sensor's state for status reports
+    def get_state(self):
+        return {"sensor": "pir", "delay_status": self.delay_status, "activated": self._activated, "standby": self.standby,
+                "last_activation": None if self.last_activation is None else wall_time(self.last_activation).isoformat(),
+                "initial_delay": self.initial_delay, "refresh_activation_limit": self.refresh_activation_limit/60}
+        
+    #PIR edges cost nothing while nothing moves, so deactivation doesn't change how the sensor runs
+    def set_standby(self, standby):
+        self.standby = standby
+        
+    #starts the post-activation delay without activating (another sensor covering the same area just activated)
+    def hold_off(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self._last_activated = now
+            self.delay_status = 3
+            self._set_ready_at(now + self.refresh_activation_limit)
+        
+        
+    #hands edges (and wakeups, None) to sink.put() instead of this thread's own queue, for a scheduler that calls
+    #check_edge itself and doesn't start this thread
+    def set_edge_sink(self, sink):
+        self._edges = sink
+        
+    #GPIO callback (already debounced), timestamps the edge as soon as it happens
+    def _on_rising(self, channel):
+        self._edges.put(time.monotonic())
+        
+        
+    #applies the activation rules to a rising edge at edge_time (time.monotonic(), or just updates delay_status if
+    #None), returns True if the sensor just activated
+    #(now: time.monotonic(), only passed in when replaying recorded data, in trace seconds)
+    def check_edge(self, edge_time=None, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            activated = self._check_edge(edge_time, now)
+        if self.recorder is not None and edge_time is not None:
+            self.recorder.record(edge_time, math.nan, math.nan, math.nan, True, self._activated, self.delay_status)
+        return activated
+        
+    def _check_edge(self, edge_time, now):
+        #edges that happened during the delay don't count, even if they are processed after it
+        if self._update_ready(now) and edge_time is not None and edge_time >= self._ready_at:
+            logging.debug("motion detected")
+            self.last_trace = Trace() #follows this activation through to playback
+            self.last_trace.mark("sample", edge_time)
+            self.last_trace.mark("detect")
+            self._activated = True
+            self._last_activated = edge_time
+            self.last_activation = edge_time
+            self.delay_status = 3
+            self._set_ready_at(edge_time + self.refresh_activation_limit)
+            if self.event_bus is not None:
+                self.event_bus.publish(MOTION_DETECTED, source="pir", trace=self.last_trace)
+            return True
+        return False
+                
+                
+    #seconds until the current activation delay expires (None if it already has, or activation isn't acknowledged yet)
+    def time_to_refresh(self):
+        if self._activated:
+            return None
+        remaining = self._ready_at - time.monotonic()
+        if remaining <= 0:
+            return None
+        return remaining
+        
         
-            
     def run(self):
         logging.debug("starting motion thread")
+        if self.edge_triggered:
+            self.run_edge_triggered()
+        else:
+            self.run_polling()
+            
+            
+    #sleeps until a rising edge arrives (or the activation delay expires, without a deadline scheduler), no fixed polling rate
+    def run_edge_triggered(self):
+        try:
+            while True:
+                count_iteration()
+                self.check_edge() #updates delay_status before sleeping
+                try:
+                    edge = self._edges.get(timeout=None if self.deadlines is not None else self.time_to_refresh())
+                except queue.Empty:
+                    edge = None
+                self.check_edge(edge)
+                
+        except KeyboardInterrupt:
+            cleanup()
+            
+            
+    def run_polling(self):
         try:
             oldPinStatus = True
             
             while True:
+                count_iteration()
                 newPinStatus = GPIO.input(self.pin) == GPIO.HIGH
                 
                 #to set self.activated = True (which triggers audio in the main thread):
                 # the pin must switch from LOW to HIGH (we don't care about HIGH to LOW)
                 # activated must have not already been set
                 # the previous activation must be outside the time limit assigned when initializing the thread
-                
-                #checking if activation delay is passed
-                if not self._activated and (datetime.utcnow() - self._last_activated).total_seconds() >= self.refresh_activation_limit:
-                    self.delay_status = 2
-                    
-                    #checking 
-                    if not oldPinStatus and newPinStatus:
-                        logging.debug("motion detected")
-                        self._activated = True
-                        self._last_activated = datetime.utcnow()
-                        self.delay_status = 3
+                now = time.monotonic()
+                with self._lock:
+                    self._check_edge(now if not oldPinStatus and newPinStatus else None, now)
                     
+                if self.recorder is not None:
+                    self.recorder.record(time.monotonic(), math.nan, math.nan, math.nan, newPinStatus, self._activated, self.delay_status)
                 oldPinStatus = newPinStatus
                     
                 time.sleep(0.5) #2 Hz refresh rate
@@ -247,61 +277,7 @@ class MotionThread_IR(threading.Thread):
             
             
             
-            
-##########################################################################################################
-#                           AUDIO PLAYER THREAD                                                          #
-##########################################################################################################
-class AudioThread(threading.Thread):
-    
-    # import pygame
-    
-    def __init__(self,audio_file):
-        logging.info("initializing audio thread")
-        super().__init__()
-        self._is_playing = False
-        self.request_play = False
-        self.audio_file = audio_file
-        self.audio_command = "aplay -D hw:0,0 /home/pi/MotionDetector/soundsource.wav" #command to play audio file
-        
-        #setting volume to 85%
-        cmd = "sudo amixer cset numid=1 85%" 
-        subprocess.run(cmd.split())
-        
-        
-    #call from parent thread when it is time to play the audio
-    def request_play_audio(self):
-        logging.debug(f"requesting to play audio (_is_playing = {self._is_playing}")
-        if not self._is_playing:
-            self._is_playing = True
-            self.request_play = True
-    
-         
-    #constantly running loop monitoring to play audio   
-    def run(self):
-        logging.debug("starting audio thread")
-        while True:
-            if self.request_play:
-                self._is_playing = True
-                self.request_play = False
-                self.play_audio()
-                self._is_playing = False
-            
-            time.sleep(0.2) 
-                
-            
-    #play audio (WAV file) with pygame
-    def play_audio(self):
-        logging.debug("playing audio")
-        # self.pygame.mixer.init()
-        # self.pygame.mixer.music.load(self.audio_file)
-        # self.pygame.mixer.music.play()
-        # while self.pygame.mixer.music.get_busy() == True:
-        #     time.sleep(0.1)
-        subprocess.run(self.audio_command.split())
-        
-            
-            
-            
+                        
             
             
             
@@ -311,18 +287,39 @@ class AudioThread(threading.Thread):
 
 if __name__ == "__main__":
     
-    logging.basicConfig(filename=f'motion_detector_{datetime.utcnow():%Y%m%d_%H%M}.log', level=logging.DEBUG)
+    setup_logging(f'motion_detector_{datetime.utcnow():%Y%m%d_%H%M}.log', level=logging.DEBUG) #writes from a background thread
     setup() #using BOARD pin numbers (not BCM)
     
+    eventBus = EventBus()
+    events = eventBus.subscribe([MOTION_DETECTED, BUTTON_GESTURE, MODE_CHANGE])
+    
+    aggregator = os.environ.get("MOTION_AGGREGATOR") #ships events in batches to udp://host:port or tcp://host:port if set
+    if aggregator:
+        eventShipper = EventShipper(eventBus, aggregator)
+        eventShipper.start()
+    
+    eventRecorder = EventRecorder(eventBus, os.environ.get("MOTION_EVENT_STORE", "events.db")) #local history for event_store.py queries
+    eventRecorder.start()
+    
+    latencyTracker = LatencyTracker(report_file=f'latency_{datetime.utcnow():%Y%m%d_%H%M}.jsonl')
+    latencyTracker.start()
+    
+    profileFile = os.environ.get("MOTION_PROFILE") #sampling profiler writing collapsed stacks (flame graphs) there if set
+    threadStats = ThreadStats(report_file=f'threads_{datetime.utcnow():%Y%m%d_%H%M}.jsonl', profile_file=profileFile)
+    threadStats.start() #per-thread CPU, loop iterations and wakeups every 5 minutes
+    
+    deadlines = DeadlineScheduler() #fires delay ends and LED blinks on time.monotonic()
+    deadlines.start()
+    
     #initiating button monitor
     buttonPin = 10 #connect button gpio to 10 and button ground to 9
-    buttonMonitor = ButtonThread(button_num=buttonPin)
+    buttonMonitor = ButtonThread(button_num=buttonPin, event_bus=eventBus)
     buttonMonitor.start()
     #modes = 1: activated, 2: deactivated, 3: off, 0: no new info
     
     #initiating LED device thread
     ledPin = 16
-    ledMonitor = LED_Thread(ledPin=ledPin)
+    ledMonitor = LED_Thread(ledPin=ledPin, deadlines=deadlines)
     ledMonitor.set_on() #initally just on while device starting up
     #modes: 1=initial activation delay (5 Hz), 2 = activated (1 Hz), 3 = between activations (0.5Hz), 0 = deactivated (off)
     
@@ -333,63 +330,29 @@ if __name__ == "__main__":
     
     #initiating motion sensor
     motionPin = 12
-    motionThread_IR = MotionThread_IR(pin=motionPin, initial_delay=0.5, refresh_activation_limit=10) #refresh = 10 minutes
+    recordDir = os.environ.get("MOTION_RECORD_DIR") #records every edge to binary trace files there if set
+    recorder = TraceRecorder(recordDir, prefix="pir", deadlines=deadlines) if recordDir else None
+    motionThread_IR = MotionThread_IR(pin=motionPin, initial_delay=0.5, refresh_activation_limit=10, edge_triggered=True, event_bus=eventBus,
+                                      recorder=recorder, deadlines=deadlines) #refresh = 10 minutes
     motionThread_IR.start()
     
     #initiating audio thread
-    audioFile = "soundsource.wav" 
-    audioThread = AudioThread(audio_file = audioFile)
+    audioFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "soundsource.wav")
+    audioThread = AudioThread(audio_file = audioFile, event_bus=eventBus, latency_tracker=latencyTracker,
+                              engine=os.environ.get("MOTION_AUDIO_ENGINE", "auto")) #"mixer" lets triggers overlap
     audioThread.start()
     
+    #status and live parameter changes over a Unix socket (python3 control_socket.py status)
+    controlServer = ControlServer(motionThread_IR, audioThread, eventBus, threads={"motion": motionThread_IR, "audio": audioThread,
+                                  "button": buttonMonitor, "led": ledMonitor})
+    controlServer.start()
     
+    #writes out buffered trace records and events (before a power off, or on exit)
+    def closeRecorders():
+        if recorder is not None:
+            recorder.close()
+        eventRecorder.stop()
+        eventRecorder.join(10)
     
-    
-    systemActive = True #whether or not system is active
-    
-    #main event loop, keeping track of button presses, motion sensing and triggering audio to play
-    try:
-    
-        while True:
-            if systemActive and motionThread_IR.get_status():
-                audioThread.request_play_audio()
-            motionThread_IR.deactivate()
-            
-            buttonStatus = buttonMonitor.get_status()
-            if buttonStatus == 3:
-                logging.info("Shutting down")
-                ledMonitor.acknowledge_blink() #blink to acknowledge poweroff command
-                cmd = "sudo shutdown -h now" #power off Pi
-                subprocess.run(cmd.split())
-                
-            elif buttonStatus == 2:
-                logging.info("Deactivating")
-                systemActive = False #deactivate motion sensor
-                
-            elif buttonStatus == 1:
-                logging.info("Reactivating")
-                motionThread_IR.set_activation_time(0.25) #will wait 15 sec to activate
-                motionThread_IR.deactivate()
-                systemActive = True
-                
-            buttonMonitor.reset_status()
-                
-            if not systemActive:
-                desiredLEDmode = 0
-            else:
-                desiredLEDmode = motionThread_IR.delay_status
-                
-            #switching LED mode if necessary
-            if desiredLEDmode != ledMonitor.get_mode():
-                ledMonitor.set_mode(desiredLEDmode)
-            time.sleep(0.1)
-            
-        
-    except KeyboardInterrupt:
-        cleanup()
-        
-        
-        
-        
-        
-        
-        
\ No newline at end of file
+    run_main_loop(motionThread_IR, buttonMonitor, ledMonitor, audioThread, eventBus, events, before_poweroff=closeRecorders)
+    closeRecorders()
@@ -0,0 +1,141 @@
+#
+# Fixed-capacity ring buffer with running statistics, used as the motion sensor's range baseline
+#
+# Pushing a sample is O(1) with no allocation: the buffer keeps a running sum, sum of squares and count of the
+# non-NaN samples in the window, so mean/variance never rescan it. NaN samples (e.g. timed out echoes) take up a
+# slot like any other sample but are left out of the statistics. The robust mode (median/MAD) is optional since
+# it has to scan the window.
+#
+# Samples are stored in a stdlib array of doubles so the sensor loop doesn't need NumPy; view() exposes it as a
+# buffer that np.asarray() wraps without copying.
+
+import math
+from array import array
+from statistics import median
+
+
+#non-NaN values of samples
+def _valid(samples):
+    return [value for value in samples if value == value]
+
+
+class RollingStats:
+
+    RESYNC_INTERVAL = 4096 #pushes between exact recomputations of the running sums (limits float drift)
+
+    def __init__(self, capacity, robust=False):
+        if capacity < 1:
+            raise ValueError(f"capacity must be at least 1 (got {capacity})")
+        self.robust = robust #center() returns the median instead of the mean
+        self._data = array("d", [math.nan])*capacity
+        self.clear()
+
+    def clear(self):
+        self._data[:] = array("d", [math.nan])*len(self._data)
+        self._index = 0 #next slot to write
+        self._filled = 0 #slots written so far (up to capacity)
+        self._count = 0 #non-NaN samples in the window
+        self._sum = 0.0
+        self._sumsq = 0.0
+        self._pushes = 0
+
+    @property
+    def capacity(self):
+        return len(self._data)
+
+    def __len__(self):
+        return self._filled
+
+    @property
+    def count(self):
+        return self._count
+
+
+    #adds a sample, overwriting the oldest one once the buffer is full
+    def push(self, value):
+        value = float(value)
+        old = self._data[self._index]
+        if old == old: #not NaN
+            self._count -= 1
+            self._sum -= old
+            self._sumsq -= old*old
+        if value == value:
+            self._count += 1
+            self._sum += value
+            self._sumsq += value*value
+
+        self._data[self._index] = value
+        self._index += 1
+        if self._index == len(self._data):
+            self._index = 0
+        if self._filled < len(self._data):
+            self._filled += 1
+
+        self._pushes += 1
+        if self._pushes >= self.RESYNC_INTERVAL:
+            self._resync()
+
+    #changes the capacity, keeping the newest samples
+    def resize(self, capacity):
+        if capacity < 1:
+            raise ValueError(f"capacity must be at least 1 (got {capacity})")
+        samples = self.ordered()[-capacity:]
+        self._data = array("d", [math.nan])*capacity
+        self.clear()
+        for value in samples:
+            self.push(value)
+
+
+    #================================ statistics ================================
+
+    def mean(self):
+        if self._count == 0:
+            return math.nan
+        return self._sum/self._count
+
+    def variance(self):
+        if self._count == 0:
+            return math.nan
+        mean = self._sum/self._count
+        return max(0.0, self._sumsq/self._count - mean*mean) #population variance
+
+    def std(self):
+        return self.variance()**0.5
+
+    def median(self):
+        if self._count == 0:
+            return math.nan
+        return median(_valid(self._data[:self._filled]))
+
+    #median absolute deviation from the median
+    def mad(self):
+        if self._count == 0:
+            return math.nan
+        values = _valid(self._data[:self._filled])
+        center = median(values)
+        return median([abs(value - center) for value in values])
+
+    #baseline used for detection: median in robust mode, mean otherwise
+    def center(self):
+        return self.median() if self.robust else self.mean()
+
+
+    #================================ access to samples ================================
+
+    #zero-copy, read-only view (memoryview of doubles) of the written slots in storage (not chronological) order
+    def view(self):
+        return memoryview(self._data)[:self._filled].toreadonly()
+
+    #copy of the samples from oldest to newest (array of doubles)
+    def ordered(self):
+        if self._filled < len(self._data):
+            return self._data[:self._filled]
+        return self._data[self._index:] + self._data[:self._index]
+
+
+    def _resync(self):
+        valid = _valid(self._data[:self._filled])
+        self._count = len(valid)
+        self._sum = math.fsum(valid)
+        self._sumsq = math.fsum(value*value for value in valid)
+        self._pushes = 0
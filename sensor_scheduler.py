@@ -0,0 +1,309 @@
+#! /usr/bin/env python3
+#
+# Several ultrasonic and PIR sensors on one board, driven from a single scheduler thread
+#
+# The MotionThread and MotionThread_IR objects are used as drivers (they are never started as threads). Only one
+# ultrasonic ping is in flight at a time: pings go out round robin, each at least ping_gap after the previous one
+# started, so a sensor never hears another sensor's echo. Within that budget (1/ping_gap pings per second in
+# total) each sensor is pinged as often as its cycle_period allows (idle_period while idle, if adaptive), so with
+# cycle_period=0 the sensors share the full budget. PIR edges arrive from GPIO callbacks and are handled between pings.
+#
+# The scheduler has the same deactivate/set_activation_time/delay_status interface as a single sensor, so
+# run_main_loop drives it unchanged.
+#
+# usage: python3 sensor_scheduler.py us:<echo pin>:<trig pin> ... pir:<pin> ...
+#   e.g. python3 sensor_scheduler.py us:35:36 us:37:38 pir:12
+
+
+
+##########################################################################################################
+#                           GENERAL SETUP                                                                #
+##########################################################################################################
+
+import os
+import sys
+import time
+import heapq
+import queue
+import logging
+import threading
+from datetime import datetime
+
+from motion_detector import setup, cleanup, ButtonThread, LED_Thread, AudioThread, MotionThread, run_main_loop
+from motion_detector_IR import MotionThread_IR
+from event_bus import EventBus, MOTION_DETECTED, BUTTON_GESTURE, MODE_CHANGE
+from latency import LatencyTracker
+from log_setup import setup_logging
+from control_socket import ControlServer
+from deadlines import DeadlineScheduler
+from thread_stats import ThreadStats, count_iteration
+from event_shipper import EventShipper
+from event_store import EventRecorder
+
+
+
+
+
+##########################################################################################################
+#                           SCHEDULER                                                                    #
+##########################################################################################################
+
+#edge sink of a PIR driver (set_edge_sink), forwarding its edges to the scheduler tagged with the sensor
+class _EdgeForwarder:
+
+    def __init__(self, wakeups, sensor):
+        self._wakeups = wakeups
+        self._sensor = sensor
+
+    def put(self, edge):
+        self._wakeups.put((self._sensor, edge))
+
+
+
+class SensorScheduler(threading.Thread):
+
+    #sensors: MotionThread and (edge-triggered) MotionThread_IR drivers, not started
+    #ping_gap: min time (sec) between consecutive ultrasonic pings on the board (HC-SR04 echoes die out in ~60 ms)
+    #shared_cooldown: an activation puts every sensor into its post-activation delay (they cover the same area)
+    #report_interval: seconds between logged per-sensor rate reports
+    def __init__(self, sensors, ping_gap=0.06, shared_cooldown=True, report_interval=300):
+        super().__init__(name="sensor-scheduler", daemon=True)
+
+        self.ultrasonic = [s for s in sensors if isinstance(s, MotionThread)]
+        self.pir = [s for s in sensors if isinstance(s, MotionThread_IR)]
+        if len(self.ultrasonic) + len(self.pir) != len(sensors):
+            raise ValueError("sensors must be MotionThread or MotionThread_IR drivers")
+        if not sensors:
+            raise ValueError("scheduler needs at least one sensor")
+
+        self.sensors = list(sensors)
+        self.ping_gap = ping_gap
+        self.shared_cooldown = shared_cooldown
+        self.report_interval = report_interval
+
+        self._wakeups = queue.Queue() #(sensor, edge) from PIR callbacks, edge None just wakes the loop
+        for sensor in self.pir:
+            if not sensor.edge_triggered:
+                raise ValueError(f"PIR sensor on pin {sensor.pin} must be edge-triggered to run under the scheduler")
+            sensor.set_edge_sink(_EdgeForwarder(self._wakeups, sensor))
+
+        self._lock = threading.Lock()
+        self._counts = {sensor: 0 for sensor in self.sensors} #samples (pings or edges) since the last rate reset
+        self._counts_since = time.monotonic()
+        self._stopping = threading.Event()
+
+        requested = sum(1/s.cycle_period if s.cycle_period > 0 else float("inf") for s in self.ultrasonic)
+        if self.ultrasonic and requested > 1/ping_gap:
+            logging.info(f"ultrasonic sensors request {requested:.1f} pings/s, budget is {1/ping_gap:.1f}; sharing it round robin")
+
+
+    @staticmethod
+    def sensor_name(sensor):
+        if isinstance(sensor, MotionThread):
+            return f"ultrasonic{sensor.echoPin}"
+        return f"pir{sensor.pin}"
+
+
+    #================================ single-sensor interface for run_main_loop ================================
+
+    def deactivate(self):
+        for sensor in self.sensors:
+            sensor.deactivate()
+
+    def set_activation_time(self, initial_delay):
+        for sensor in self.sensors:
+            sensor.set_activation_time(initial_delay)
+
+    #2 if any sensor can activate, else 1 if any is in its initial delay, else 3
+    @property
+    def delay_status(self):
+        statuses = {sensor.delay_status for sensor in self.sensors}
+        for status in (2, 1, 3):
+            if status in statuses:
+                return status
+        return 3
+
+    def get_status(self):
+        return any(sensor.get_status() for sensor in self.sensors)
+
+    def set_standby(self, standby):
+        for sensor in self.sensors:
+            sensor.set_standby(standby)
+            
+    @property
+    def standby(self):
+        return all(sensor.standby for sensor in self.sensors)
+        
+    #passes each sensor the parameters it has (distThresh and Nobs only go to the ultrasonic sensors)
+    def set_params(self, distThresh=None, Nobs=None, initial_delay=None, refresh_activation_limit=None):
+        if not self.ultrasonic and (distThresh is not None or Nobs is not None):
+            raise ValueError("distThresh and Nobs only apply to ultrasonic sensors")
+        for sensor in self.ultrasonic:
+            sensor.set_params(distThresh, Nobs, initial_delay, refresh_activation_limit)
+        for sensor in self.pir:
+            sensor.set_params(initial_delay, refresh_activation_limit)
+            
+    def get_state(self):
+        return {"sensor": "scheduler", "delay_status": self.delay_status, "activated": self.get_status(), "standby": self.standby,
+                "rates": self.rates(reset=False), "sensors": {self.sensor_name(sensor): sensor.get_state() for sensor in self.sensors}}
+
+
+    #================================ rates ================================
+
+    #{sensor name: samples per second} since the last call (pings for ultrasonic, edges for PIR sensors)
+    def rates(self, reset=True):
+        with self._lock:
+            now = time.monotonic()
+            elapsed = max(now - self._counts_since, 1e-9)
+            rates = {self.sensor_name(sensor): count/elapsed for sensor, count in self._counts.items()}
+            if reset:
+                self._counts = dict.fromkeys(self._counts, 0)
+                self._counts_since = now
+        return rates
+
+    def report(self):
+        rates = self.rates()
+        logging.info("sensor rates (Hz) " + " ".join(f"{name}={rate:.2f}" for name, rate in rates.items()) +
+                     f" total={sum(rates.values()):.2f}")
+
+    def _count(self, sensor):
+        with self._lock:
+            self._counts[sensor] += 1
+
+    def _on_activation(self, sensor):
+        if self.shared_cooldown:
+            for other in self.sensors:
+                if other is not sensor:
+                    other.hold_off()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeups.put((None, None))
+
+
+    #================================ loop ================================
+
+    def run(self):
+        logging.debug(f"starting sensor scheduler ({len(self.ultrasonic)} ultrasonic, {len(self.pir)} PIR)")
+        try:
+            now = time.monotonic()
+            due = [(now + i*self.ping_gap, i) for i in range(len(self.ultrasonic))] #staggered first pings
+            heapq.heapify(due)
+            last_ping = now - self.ping_gap
+            next_report = now + self.report_interval
+
+            while not self._stopping.is_set():
+                count_iteration()
+                for sensor in self.pir:
+                    sensor.check_edge() #updates delay_status
+
+                #sleeps until the next ping slot, handling PIR edges as they arrive
+                now = time.monotonic()
+                if due:
+                    timeout = max(0, max(due[0][0], last_ping + self.ping_gap) - now)
+                else:
+                    refresh = [t for t in (sensor.time_to_refresh() for sensor in self.pir) if t is not None]
+                    timeout = min(refresh + [max(0, next_report - now)])
+                try:
+                    sensor, edge = self._wakeups.get(timeout=timeout)
+                    if sensor is not None and edge is not None:
+                        self._count(sensor)
+                        if sensor.check_edge(edge):
+                            self._on_activation(sensor)
+                    continue
+                except queue.Empty:
+                    pass
+
+                now = time.monotonic()
+                if due and now >= max(due[0][0], last_ping + self.ping_gap):
+                    _, i = heapq.heappop(due)
+                    sensor = self.ultrasonic[i]
+                    last_ping = now
+                    if sensor.step():
+                        self._on_activation(sensor)
+                    self._count(sensor)
+                    heapq.heappush(due, (now + sensor.next_period(), i))
+
+                if now >= next_report:
+                    self.report()
+                    next_report = now + self.report_interval
+
+        except KeyboardInterrupt:
+            cleanup()
+
+
+
+
+
+##########################################################################################################
+#                           MAIN                                                                         #
+##########################################################################################################
+
+#sensor spec "us:<echo>:<trig>" or "pir:<pin>" -> driver
+def make_sensor(spec, event_bus, deadlines=None):
+    kind, *pins = spec.split(":")
+    if kind == "us" and len(pins) == 2:
+        return MotionThread(echoPin=int(pins[0]), trigPin=int(pins[1]), distThresh=10, Nobs=20, initial_delay=0.5,
+                            refresh_activation_limit=10, cycle_period=0, adaptive=True, detector=os.environ.get("MOTION_DETECTOR", "mean"),
+                            ranging_mode=os.environ.get("MOTION_RANGING", "edge"), event_bus=event_bus, deadlines=deadlines)
+    if kind == "pir" and len(pins) == 1:
+        return MotionThread_IR(pin=int(pins[0]), initial_delay=0.5, refresh_activation_limit=10, edge_triggered=True, event_bus=event_bus,
+                               deadlines=deadlines)
+    raise ValueError(f"bad sensor spec {spec!r} (expected us:<echo pin>:<trig pin> or pir:<pin>)")
+
+
+if __name__ == "__main__":
+
+    setup_logging(f'motion_detector_{datetime.utcnow():%Y%m%d_%H%M}.log', level=logging.DEBUG) #writes from a background thread
+    setup() #using BOARD pin numbers (not BCM)
+
+    eventBus = EventBus()
+    events = eventBus.subscribe([MOTION_DETECTED, BUTTON_GESTURE, MODE_CHANGE])
+
+    aggregator = os.environ.get("MOTION_AGGREGATOR") #ships events in batches to udp://host:port or tcp://host:port if set
+    if aggregator:
+        eventShipper = EventShipper(eventBus, aggregator)
+        eventShipper.start()
+
+    eventRecorder = EventRecorder(eventBus, os.environ.get("MOTION_EVENT_STORE", "events.db")) #local history for event_store.py queries
+    eventRecorder.start()
+
+    latencyTracker = LatencyTracker(report_file=f'latency_{datetime.utcnow():%Y%m%d_%H%M}.jsonl')
+    latencyTracker.start()
+
+    profileFile = os.environ.get("MOTION_PROFILE") #sampling profiler writing collapsed stacks (flame graphs) there if set
+    threadStats = ThreadStats(report_file=f'threads_{datetime.utcnow():%Y%m%d_%H%M}.jsonl', profile_file=profileFile)
+    threadStats.start() #per-thread CPU, loop iterations and wakeups every 5 minutes
+
+    deadlines = DeadlineScheduler() #fires delay ends and LED blinks on time.monotonic()
+    deadlines.start()
+
+    buttonPin = 10 #connect button gpio to 10 and button ground to 9
+    buttonMonitor = ButtonThread(button_num=buttonPin, event_bus=eventBus)
+    buttonMonitor.start()
+
+    ledPin = 16
+    ledMonitor = LED_Thread(ledPin=ledPin, deadlines=deadlines)
+    ledMonitor.set_on() #initally just on while device starting up
+    ledMonitor.start()
+
+    sensors = [make_sensor(spec, eventBus, deadlines) for spec in (sys.argv[1:] or ["us:35:36"])]
+    scheduler = SensorScheduler(sensors)
+    scheduler.start()
+
+    audioFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "soundsource.wav")
+    audioThread = AudioThread(audio_file = audioFile, event_bus=eventBus, latency_tracker=latencyTracker,
+                              engine=os.environ.get("MOTION_AUDIO_ENGINE", "auto")) #"mixer" lets triggers overlap
+    audioThread.start()
+
+    controlServer = ControlServer(scheduler, audioThread, eventBus, threads={"scheduler": scheduler, "audio": audioThread,
+                                  "button": buttonMonitor, "led": ledMonitor})
+    controlServer.start()
+
+    #writes out buffered events (before a power off, or on exit)
+    def closeRecorders():
+        eventRecorder.stop()
+        eventRecorder.join(10)
+
+    run_main_loop(scheduler, buttonMonitor, ledMonitor, audioThread, eventBus, events, before_poweroff=closeRecorders)
+    closeRecorders()
@@ -0,0 +1,200 @@
+#! /usr/bin/env python3
+#
+# Offline parameter sweep for the ultrasonic detection rule
+#
+# Scores every combination of distThresh, Nobs and refresh_activation_limit on recorded range traces (the CSV or
+# .trc files benchmark.py reads) by detection rate, false alarms per hour and detection latency. The
+# check_range_diff rule is evaluated for a whole trace at once in NumPy: the baseline of every sample (mean, or
+# median with --robust, of the previous Nobs samples) comes from cumulative sums or a sliding window view, every
+# distThresh is compared against the same deviations, and the refresh limit only has to step through the
+# detections. Each (trace, Nobs) pair is one task for a process pool.
+#
+# usage: python3 sweep.py TRACE ... [--dist-thresh 5:30:2.5] [--nobs 5,10,20,40] [--refresh 0,0.5,10] [--output FILE]
+
+import sys
+import csv
+import time
+import argparse
+import warnings
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from benchmark import load_trace, label_events, synthetic_range_trace
+
+
+_traces = {} #name -> (t, ranges, labels), loaded once per worker process
+
+
+
+##########################################################################################################
+#                           VECTORIZED DETECTION RULE                                                    #
+##########################################################################################################
+
+#baseline each sample is compared against: mean (or median) of the non-NaN values among the previous Nobs samples,
+#NaN while there are none (like RollingStats starting out empty)
+def baselines(ranges, Nobs, robust=False):
+    n = len(ranges)
+    if robust:
+        padded = np.concatenate((np.full(Nobs, np.nan), ranges[:-1]))
+        windows = sliding_window_view(padded, Nobs) #row i = the Nobs samples before sample i
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning) #all-NaN windows
+            return np.nanmedian(windows, axis=1)
+
+    valid = ~np.isnan(ranges)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(valid, ranges, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    end = np.arange(n) #window of sample i is [i - Nobs, i)
+    start = np.maximum(end - Nobs, 0)
+    window_count = counts[end] - counts[start]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(window_count > 0, (sums[end] - sums[start])/window_count, np.nan)
+
+
+#times of the samples that activate the sensor: detected samples at least refresh seconds after the previous
+#activation (acknowledged immediately, as the main loop does)
+def activations(t, detected, refresh):
+    candidates = t[detected]
+    if refresh <= 0 or len(candidates) == 0:
+        return candidates
+    chosen = []
+    i = 0
+    while i < len(candidates):
+        chosen.append(candidates[i])
+        i = np.searchsorted(candidates, candidates[i] + refresh, side="left")
+    return np.asarray(chosen)
+
+
+#matches activation times against labelled (start, end) events, same rules as benchmark.score
+def score(detections, events, tolerance):
+    result = {"events": len(events), "detections": len(detections)}
+    if len(events) == 0:
+        matched = np.zeros(len(detections), dtype=bool)
+        first_latencies = np.zeros(0)
+    else:
+        starts = np.array([e[0] for e in events])
+        ends = np.array([e[1] for e in events])
+        idx = np.searchsorted(starts, detections, side="right") - 1
+        matched = (idx >= 0) & (detections <= ends[np.maximum(idx, 0)] + tolerance)
+        hit, first = np.unique(idx[matched], return_index=True) #detections are sorted, so first = earliest per event
+        first_latencies = detections[matched][first] - starts[hit]
+    result["true_positives"] = len(first_latencies)
+    result["false_positives"] = int((~matched).sum())
+    result["false_negatives"] = len(events) - len(first_latencies)
+    result["latencies"] = first_latencies
+    return result
+
+
+
+##########################################################################################################
+#                           SWEEP                                                                        #
+##########################################################################################################
+
+def _init_worker(traces):
+    _traces.update(traces)
+
+
+#scores every (distThresh, refresh) combination for one trace and Nobs
+def _evaluate(task):
+    name, Nobs, dist_thresholds, refresh_limits, robust, tolerance = task
+    t, ranges, labels = _traces[name]
+    events = label_events(t, labels)
+    deviation = np.abs(ranges - baselines(ranges, Nobs, robust))
+    with np.errstate(invalid="ignore"):
+        results = []
+        for distThresh in dist_thresholds:
+            detected = deviation >= distThresh #NaN (no echo or no baseline yet) never detects
+            for refresh in refresh_limits:
+                result = score(activations(t, detected, refresh*60), events, tolerance)
+                result.update(trace=name, distThresh=distThresh, Nobs=Nobs, refresh=refresh, hours=(t[-1] - t[0])/3600)
+                results.append(result)
+    return results
+
+
+#"5:30:2.5" (start:stop:step, stop included) or "5,10,20"
+def parse_values(spec, kind=float):
+    if ":" in spec:
+        start, stop, step = (float(v) for v in spec.split(":"))
+        return [kind(v) for v in np.arange(start, stop + step/2, step)]
+    return [kind(v) for v in spec.split(",")]
+
+
+#totals over all traces per parameter set, best first (most events caught, then fewest false alarms, then fastest)
+def summarize(results):
+    groups = {}
+    for r in results:
+        groups.setdefault((r["distThresh"], r["Nobs"], r["refresh"]), []).append(r)
+    rows = []
+    for (distThresh, Nobs, refresh), rs in groups.items():
+        events = sum(r["events"] for r in rs)
+        tp = sum(r["true_positives"] for r in rs)
+        fp = sum(r["false_positives"] for r in rs)
+        hours = sum(r["hours"] for r in rs)
+        latencies = np.concatenate([r["latencies"] for r in rs])
+        rows.append({"distThresh": distThresh, "Nobs": Nobs, "refresh": refresh, "events": events,
+                     "detection_rate": tp/events if events else float("nan"), "true_positives": tp, "false_positives": fp,
+                     "false_negatives": events - tp, "false_alarms_per_hour": fp/hours if hours else float("nan"),
+                     "latency_mean_ms": 1000*latencies.mean() if len(latencies) else float("nan"),
+                     "latency_p50_ms": 1000*np.median(latencies) if len(latencies) else float("nan")})
+    rows.sort(key=lambda r: (-r["true_positives"], r["false_positives"], np.nan_to_num(r["latency_mean_ms"], nan=np.inf)))
+    return rows
+
+
+def sweep(traces, dist_thresholds, nobs_values, refresh_limits, robust=False, tolerance=1.0, workers=None):
+    tasks = [(name, Nobs, dist_thresholds, refresh_limits, robust, tolerance) for name in traces for Nobs in nobs_values]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(traces,)) as pool:
+        results = list(itertools.chain.from_iterable(pool.map(_evaluate, tasks)))
+    return summarize(results)
+
+
+
+
+
+##########################################################################################################
+#                           MAIN                                                                         #
+##########################################################################################################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Score detection parameter sets on recorded range traces")
+    parser.add_argument("traces", nargs="*", help="ultrasonic range traces (CSV or .trc)")
+    parser.add_argument("--synthetic", type=float, default=0, help="also use a synthetic trace of this many minutes")
+    parser.add_argument("--dist-thresh", default="4:30:2", help="distThresh values (cm), start:stop:step or a,b,c")
+    parser.add_argument("--nobs", default="5,10,20,40", help="Nobs values")
+    parser.add_argument("--refresh", default="0,0.25,1,10", help="refresh_activation_limit values (minutes)")
+    parser.add_argument("--robust", action="store_true", help="use the median baseline")
+    parser.add_argument("--tolerance", type=float, default=1.0, help="seconds after an event a detection still counts")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--top", type=int, default=10, help="parameter sets to print")
+    parser.add_argument("--output", help="write all results to this CSV file")
+    args = parser.parse_args()
+
+    traces = {f: load_trace(f) for f in args.traces}
+    if args.synthetic:
+        traces["synthetic"] = synthetic_range_trace(args.synthetic)
+    if not traces:
+        parser.error("no traces given")
+
+    dist_thresholds = parse_values(args.dist_thresh)
+    nobs_values = parse_values(args.nobs, int)
+    refresh_limits = parse_values(args.refresh)
+
+    start = time.perf_counter()
+    rows = sweep(traces, dist_thresholds, nobs_values, refresh_limits, args.robust, args.tolerance, args.workers)
+    elapsed = time.perf_counter() - start
+    samples = sum(len(t) for t, _, _ in traces.values())
+    print(f"{len(rows)} parameter sets x {samples} samples in {elapsed:.2f} s", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    print(f"{'distThresh':>10} {'Nobs':>5} {'refresh':>7} {'detected':>9} {'FP':>5} {'FP/h':>7} {'latency ms':>10}")
+    for r in rows[:args.top]:
+        print(f"{r['distThresh']:>10g} {r['Nobs']:>5d} {r['refresh']:>7g} {r['true_positives']:>4d}/{r['events']:<4d} "
+              f"{r['false_positives']:>5d} {r['false_alarms_per_hour']:>7.2f} {r['latency_mean_ms']:>10.0f}")
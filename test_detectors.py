@@ -0,0 +1,89 @@
+#
+# Unit tests for the streaming motion detectors (python3 -m pytest test_detectors.py)
+
+import math
+
+import pytest
+
+from detectors import make_detector, MeanThresholdDetector, EWMADetector, CUSUMDetector
+
+
+#detection results for a sequence of ranges
+def run(detector, values):
+    return [detector.update(value) for value in values]
+
+
+@pytest.mark.parametrize("name", ["mean", "ewma", "cusum"])
+def test_steady_range_never_triggers(name):
+    detector = make_detector(name, 10, 5)
+    assert not any(run(detector, [150.0, 151.0, 149.0, 150.5]*25))
+
+
+@pytest.mark.parametrize("name", ["mean", "ewma", "cusum"])
+def test_step_after_warmup_triggers(name):
+    detector = make_detector(name, 10, 5)
+    assert run(detector, [150.0]*10 + [100.0]) == [False]*10 + [True]
+
+
+@pytest.mark.parametrize("name", ["mean", "ewma", "cusum"])
+def test_nan_never_triggers(name):
+    detector = make_detector(name, 10, 5)
+    run(detector, [150.0]*10)
+    assert not any(run(detector, [math.nan]*3)) #fewer than Nobs, so the mean window keeps valid samples
+    assert detector.baseline == pytest.approx(150.0)
+
+
+def test_mean_detects_from_the_second_sample():
+    #the mean rule has no warmup: any baseline from one sample on is used
+    detector = MeanThresholdDetector(10, 5)
+    assert run(detector, [150.0, 100.0]) == [False, True]
+
+
+@pytest.mark.parametrize("cls", [EWMADetector, CUSUMDetector])
+def test_warmup_holds_back_detections(cls):
+    detector = cls(10, Nobs=5, warmup=5)
+    assert run(detector, [150.0, 150.0, 100.0, 100.0]) == [False]*4
+    detector = cls(10, Nobs=5, warmup=2)
+    assert run(detector, [150.0, 150.0, 100.0]) == [False, False, True]
+
+
+def test_ewma_threshold_follows_noise():
+    detector = EWMADetector(10, Nobs=10, k=4.0)
+    run(detector, [150.0 + (30.0 if i % 2 else -30.0) for i in range(50)]) #std ~30 cm
+    assert detector.update(170.0) is False #above distThresh but well within 4 std
+    assert detector.snapshot()["threshold"] > 10
+
+
+def test_cusum_accumulates_a_gradual_approach():
+    ramp = [150.0 - 0.5*i for i in range(1, 61)] #0.5 cm per sample: the mean window follows it
+    assert not any(run(make_detector("mean", 10, 20), [150.0]*20 + ramp))
+    assert any(run(make_detector("cusum", 10, 20), [150.0]*20 + ramp))
+
+
+def test_configure_keeps_given_params():
+    detector = CUSUMDetector(10, Nobs=20, drift=1.0)
+    detector.configure(20, 40)
+    assert detector.drift == 1.0
+    assert detector.threshold == 20
+    assert detector.alpha == pytest.approx(2/41)
+
+    detector = MeanThresholdDetector(10, 5)
+    run(detector, range(5))
+    detector.configure(20, 3)
+    assert detector.window.capacity == 3 and list(detector.window.ordered()) == [2, 3, 4]
+
+
+def test_make_detector_rejects_dropped_params():
+    with pytest.raises(ValueError):
+        make_detector("mean", 10, 20, alpha=0.1)
+    with pytest.raises(ValueError):
+        make_detector("ewma", 10, 20, robust=True)
+    with pytest.raises(ValueError):
+        make_detector("cusum", 10, 20, robust=True)
+    with pytest.raises(ValueError):
+        make_detector("median", 10, 20)
+    with pytest.raises(TypeError):
+        make_detector("ewma", 10, 20, drift=1.0) #not an EWMA parameter
+
+    assert make_detector("mean", 10, 20, robust=True).window.robust
+    assert make_detector("ewma", 10, 20, alpha=0.1).alpha == 0.1
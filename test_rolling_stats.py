@@ -0,0 +1,93 @@
+#
+# Unit tests for the RollingStats ring buffer (python3 -m pytest test_rolling_stats.py)
+#
+# NumPy is only used here as the reference for the running statistics, the buffer itself doesn't need it.
+
+import math
+import random
+
+import numpy as np
+import pytest
+
+from rolling_stats import RollingStats
+
+
+#pushes values and checks the statistics against NumPy over the last capacity samples after each one
+def check_against_numpy(stats, values):
+    for i, value in enumerate(values):
+        stats.push(value)
+        window = np.asarray(values[max(0, i + 1 - stats.capacity):i + 1], dtype=float)
+        valid = window[~np.isnan(window)]
+        assert len(stats) == len(window)
+        assert stats.count == len(valid)
+        assert list(stats.ordered()) == pytest.approx(list(window), nan_ok=True)
+        if len(valid):
+            assert stats.mean() == pytest.approx(valid.mean(), abs=1e-9)
+            #population variance, as np.var; compared rather than std since sqrt magnifies the rounding of a ~0 variance
+            assert stats.variance() == pytest.approx(valid.var(), rel=1e-9, abs=1e-6)
+            assert stats.median() == pytest.approx(np.median(valid))
+        else:
+            assert math.isnan(stats.mean()) and math.isnan(stats.std()) and math.isnan(stats.median())
+
+
+def test_wraparound_keeps_newest_samples():
+    stats = RollingStats(4)
+    for value in range(1, 11):
+        stats.push(value)
+    assert list(stats.ordered()) == [7, 8, 9, 10]
+    assert len(stats) == 4 and stats.count == 4
+    assert stats.mean() == 8.5
+    assert sorted(stats.view()) == [7, 8, 9, 10] #storage order differs after wrapping
+
+
+def test_statistics_match_numpy():
+    rng = random.Random(1)
+    check_against_numpy(RollingStats(20), [rng.gauss(150, 5) for _ in range(500)])
+
+
+def test_nan_samples_take_a_slot_but_not_statistics():
+    rng = random.Random(2)
+    values = [math.nan if rng.random() < 0.3 else rng.uniform(20, 400) for _ in range(300)]
+    values[50:60] = [math.nan]*10 #a window of only NaN
+    check_against_numpy(RollingStats(8), values)
+
+
+def test_resync_limits_drift():
+    stats = RollingStats(10)
+    for i in range(3*RollingStats.RESYNC_INTERVAL + 7):
+        stats.push(1e6 + (i % 10))
+    assert stats.mean() == pytest.approx(1e6 + 4.5, abs=1e-6)
+    assert stats.std() == pytest.approx(np.std(np.arange(10)), abs=1e-3)
+
+
+def test_robust_center_is_median():
+    stats = RollingStats(5, robust=True)
+    for value in (100, 101, 99, 100, 400):
+        stats.push(value)
+    assert stats.center() == 100
+    assert stats.mad() == 1
+    stats.robust = False
+    assert stats.center() == pytest.approx(160)
+
+
+def test_resize_keeps_newest_samples():
+    stats = RollingStats(6)
+    for value in range(10):
+        stats.push(value)
+    stats.resize(3)
+    assert list(stats.ordered()) == [7, 8, 9]
+    assert stats.mean() == 8
+    stats.resize(5)
+    stats.push(10)
+    assert list(stats.ordered()) == [7, 8, 9, 10]
+
+
+def test_clear_and_bad_capacity():
+    stats = RollingStats(3)
+    stats.push(1)
+    stats.clear()
+    assert len(stats) == 0 and stats.count == 0 and math.isnan(stats.mean())
+    with pytest.raises(ValueError):
+        RollingStats(0)
+    with pytest.raises(ValueError):
+        stats.resize(0)
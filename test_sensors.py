@@ -2,8 +2,7 @@
 # code to test the IR motion detector or ultrasonic range detector and supporting code
 
 import time
-import RPi.GPIO as GPIO
-import numpy as np
+from gpio_backend import GPIO
 import traceback
 
 def test_audio_range(echoPin, trigPin):
@@ -25,7 +24,9 @@ def test_audio_range(echoPin, trigPin):
         isActive = motionThread.get_status()
         motionThread.deactivate()
         
-        print(f"Range: {crange} cm, Motion: {isActive} (Mean: {np.round(np.nanmean(np.asarray(rangevals)),1)} cm)")
+        valid = [r for r in rangevals if r == r] #skip NaN (no echo)
+        mean = round(sum(valid)/len(valid), 1) if valid else float("nan")
+        print(f"Range: {crange} cm, Motion: {isActive} (Mean: {mean} cm)")
         time.sleep(0.5)
         
     
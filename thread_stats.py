@@ -0,0 +1,170 @@
+#
+# Per-thread CPU accounting and an optional sampling profiler
+#
+# ThreadStats periodically reads every thread's CPU time (user + system) and voluntary context switches (the times
+# it went to sleep and was woken again) from /proc/self/task/<native id>/, and counts loop iterations reported
+# with count_iteration(). Each report is one log line (plus a JSON line in report_file) with, per thread, the share
+# of a CPU it used, its loop iterations per second and its wakeups per second. Reading /proc costs well under a
+# millisecond per report, so it can stay on.
+#
+# With profile_file set, a sampler thread also records the Python stack of every thread each profile_interval
+# seconds (sys._current_frames) and writes the accumulated counts in the collapsed format flame graph tools read
+# ("thread;module:function;... count" lines), rewritten at each report. Idle threads show up as their blocking call.
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from collections import Counter
+
+
+_iterations = Counter() #thread ident -> loop iterations (each thread only updates its own entry)
+
+try:
+    _CLK_TCK = os.sysconf("SC_CLK_TCK")
+except (AttributeError, ValueError, OSError):
+    _CLK_TCK = 100
+
+
+#called once per loop iteration by the instrumented threads
+def count_iteration():
+    _iterations[threading.get_ident()] += 1
+
+
+#(cpu seconds, voluntary context switches) of a thread from /proc, None where that isn't available
+def read_task(native_id):
+    try:
+        with open(f"/proc/self/task/{native_id}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split() #the name in parentheses may contain spaces
+        cpu = (int(fields[11]) + int(fields[12]))/_CLK_TCK #utime, stime
+        with open(f"/proc/self/task/{native_id}/status") as f:
+            for line in f:
+                if line.startswith("voluntary_ctxt_switches"):
+                    return cpu, int(line.split()[1])
+        return cpu, None
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+
+class ThreadStats:
+
+    #report_interval: seconds between reports, report_file: JSON lines file the reports are appended to (only
+    #logged if None)
+    #profile_file: collapsed stack file of the sampling profiler (no profiler if None), profile_interval: seconds
+    #between stack samples
+    def __init__(self, report_interval=300, report_file=None, profile_file=None, profile_interval=0.02):
+        self.report_interval = report_interval
+        self.report_file = report_file
+        self.profile_file = profile_file
+        self.profile_interval = profile_interval
+        self._stacks = Counter() #collapsed stack -> samples
+        self._samples = 0
+        self._lock = threading.Lock()
+        self._last = {} #native id -> (cpu, wakeups, iterations) at the previous report
+        self._last_time = time.monotonic()
+        self._last_process_cpu = time.process_time()
+        self._stop = threading.Event()
+        self._reporter = None
+        self._profiler = None
+
+    #{thread name: {"cpu": % of one CPU, "it_s": loop iterations/s, "wk_s": wakeups/s}} since the last call
+    def snapshot(self):
+        now = time.monotonic()
+        process_cpu = time.process_time()
+        elapsed = max(now - self._last_time, 1e-9)
+        threads = {}
+        current = {}
+        for thread in threading.enumerate():
+            if thread.native_id is None:
+                continue
+            task = read_task(thread.native_id)
+            cpu, wakeups = task if task is not None else (None, None)
+            iterations = _iterations.get(thread.ident, 0)
+            current[thread.native_id] = (cpu, wakeups, iterations)
+            last_cpu, last_wakeups, last_iterations = self._last.get(thread.native_id, (None, None, 0))
+            name = thread.name if thread.name not in threads else f"{thread.name}-{thread.native_id}"
+            threads[name] = {
+                "cpu": None if cpu is None else 100*(cpu - (last_cpu or 0))/elapsed,
+                "it_s": (iterations - last_iterations)/elapsed,
+                "wk_s": None if wakeups is None else (wakeups - (last_wakeups or 0))/elapsed}
+        result = {"interval": elapsed, "process_cpu": 100*(process_cpu - self._last_process_cpu)/elapsed, "threads": threads}
+        self._last = current
+        self._last_time = now
+        self._last_process_cpu = process_cpu
+        return result
+
+    def report(self):
+        snapshot = self.snapshot()
+        logging.info(f"threads (cpu% it/s wk/s) process {snapshot['process_cpu']:.1f}% " +
+                     " ".join(f"{name} {_fmt(s['cpu'])}/{s['it_s']:.1f}/{_fmt(s['wk_s'])}" for name, s in snapshot["threads"].items()))
+        if self.report_file is not None:
+            with open(self.report_file, "a") as f:
+                f.write(json.dumps({"time": time.time(), **snapshot}) + "\n")
+        if self._profiler is not None:
+            self.write_profile()
+
+
+    #================================ sampling profiler ================================
+
+    def _sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            calls = []
+            while frame is not None:
+                code = frame.f_code
+                calls.append(f"{os.path.basename(code.co_filename).rsplit('.', 1)[0]}:{code.co_name}")
+                frame = frame.f_back
+            calls.append(names.get(ident, str(ident)))
+            stacks.append(";".join(reversed(calls)))
+        with self._lock:
+            self._stacks.update(stacks)
+            self._samples += 1
+
+    def _run_profiler(self):
+        while not self._stop.wait(self.profile_interval):
+            self._sample()
+
+    #rewrites profile_file with the stack counts collected so far
+    def write_profile(self):
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+            samples = self._samples
+        with open(self.profile_file + ".tmp", "w") as f:
+            for stack, count in stacks:
+                f.write(f"{stack} {count}\n")
+        os.replace(self.profile_file + ".tmp", self.profile_file)
+        logging.debug(f"profile: {samples} samples written to {self.profile_file}")
+
+
+    #================================ reporter ================================
+
+    #writes a report every report_interval seconds (and samples stacks, if profiling) from daemon threads
+    def start(self):
+        self.snapshot() #starts the first interval now
+        self._reporter = threading.Thread(target=self._run, name="thread-stats", daemon=True)
+        self._reporter.start()
+        if self.profile_file is not None:
+            self._profiler = threading.Thread(target=self._run_profiler, name="profiler", daemon=True)
+            self._profiler.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.report_interval):
+            try:
+                self.report()
+            except Exception:
+                logging.exception("failed to write thread report")
+
+
+
+def _fmt(value):
+    return "-" if value is None else f"{value:.1f}"
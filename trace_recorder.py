@@ -0,0 +1,168 @@
+#
+# Compact binary recording of every sensor sample
+#
+# Each sample is one fixed-width 24 byte record (RECORD, or RECORD_DTYPE in NumPy). Records are packed into a
+# preallocated block with struct, so recording doesn't import NumPy, and the block is written to disk at once (or
+# when the oldest unwritten record is flush_interval seconds old, on a deadline scheduler timer if one is given so
+# sparse PIR edges aren't held back until the next one), so the SD card sees a few large writes instead of a log
+# line per sample. Files rotate at max_file_bytes and only the
+# newest max_files are kept.
+#
+# A file is a 16 byte header (magic, format version, record size) followed by the raw records, so it can be opened
+# with read_trace() as a NumPy memmap without parsing anything:
+#
+#     samples = read_trace("traces/ultrasonic_20240101_120000_000000.trc")
+#     samples["range"][samples["detected"] == 1]
+
+import os
+import glob
+import time
+import struct
+import logging
+import threading
+from datetime import datetime
+
+
+#time: time.monotonic() of the sample, pulse: echo pulse length (sec), range/baseline: cm (NaN for PIR samples)
+#detected: the sample counted as motion (PIR: a rising edge, or the pin level when polling)
+#activated: activation waiting to be acknowledged, state: delay_status (1 initial delay, 2 ready, 3 after an activation)
+RECORD = struct.Struct("<dfffBBBx")
+FIELDS = [("time", "<f8"), ("pulse", "<f4"), ("range", "<f4"), ("baseline", "<f4"),
+          ("detected", "u1"), ("activated", "u1"), ("state", "u1"), ("reserved", "u1")]
+
+
+_dtype = None
+
+#NumPy dtype of a record, built on first use (also available as the module attribute RECORD_DTYPE)
+def record_dtype():
+    global _dtype
+    if _dtype is None:
+        import numpy as np
+        _dtype = np.dtype(FIELDS)
+    return _dtype
+
+def __getattr__(name):
+    if name == "RECORD_DTYPE":
+        return record_dtype()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+MAGIC = b"MTRC"
+VERSION = 1
+HEADER = struct.Struct("<4sHH8x") #magic, version, record size, padding to 16 bytes
+EXTENSION = ".trc"
+
+
+
+class TraceRecorder:
+
+    #directory: where trace files go, prefix: file name prefix (e.g. the sensor type)
+    #block_records: records buffered per write, flush_interval: max seconds a record waits in the buffer
+    #max_file_bytes: size at which a new file is started, max_files: older files beyond this are deleted (None keeps all)
+    #deadlines: DeadlineScheduler that flushes a block flush_interval seconds after its first record (otherwise the
+    #age is only checked when the next record arrives)
+    def __init__(self, directory, prefix="sensor", block_records=256, flush_interval=60, max_file_bytes=16*1024*1024, max_files=20,
+                 deadlines=None):
+        if max_files is not None and max_files < 1: #the file being written counts as one
+            raise ValueError(f"max_files must be at least 1 or None (got {max_files})")
+        self.directory = directory
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.deadlines = deadlines
+
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._block = bytearray(block_records*RECORD.size)
+        self._block_records = block_records
+        self._count = 0 #records in the block
+        self._block_started = None #time.monotonic() of the first record in the block
+        self._flush_timer = None
+        self._file = None
+        self._file_bytes = 0
+        self.filename = None
+        self.records = 0 #written since start
+
+
+    def record(self, t, pulse, range_cm, baseline, detected, activated, state):
+        with self._lock:
+            if self._count == 0:
+                self._block_started = time.monotonic()
+                if self.deadlines is not None:
+                    self._flush_timer = self.deadlines.call_later(self.flush_interval, self.flush)
+            RECORD.pack_into(self._block, self._count*RECORD.size, t, pulse, range_cm, baseline, detected, activated, state)
+            self._count += 1
+            if self._count == self._block_records or time.monotonic() - self._block_started >= self.flush_interval:
+                self._write_block()
+
+    #writes out whatever is buffered
+    def flush(self):
+        with self._lock:
+            if self._count:
+                self._write_block()
+
+    def close(self):
+        with self._lock:
+            if self._count:
+                self._write_block()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+    def _write_block(self):
+        data = memoryview(self._block)[:self._count*RECORD.size]
+        if self._file is None or self._file_bytes + len(data) > self.max_file_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        self._file_bytes += len(data)
+        self.records += self._count
+        self._count = 0
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        self.filename = os.path.join(self.directory, f"{self.prefix}_{datetime.utcnow():%Y%m%d_%H%M%S_%f}{EXTENSION}")
+        logging.debug(f"recording sensor trace to {self.filename}")
+        self._file = open(self.filename, "wb")
+        self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self._file_bytes = HEADER.size
+
+        if self.max_files is not None:
+            for old in trace_files(self.directory, self.prefix)[:-self.max_files]:
+                os.remove(old)
+
+
+
+#trace files for prefix in directory, oldest first
+def trace_files(directory, prefix="sensor"):
+    return sorted(glob.glob(os.path.join(directory, f"{prefix}_*{EXTENSION}"))) #names sort by creation time
+
+
+#read-only memmap of the records in a trace file (a partly written last record is ignored)
+def read_trace(filename):
+    import numpy as np
+    with open(filename, "rb") as f:
+        magic, version, record_size = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{filename} is not a sensor trace")
+    if version != VERSION or record_size != RECORD.size:
+        raise ValueError(f"{filename} has unsupported trace format {version} ({record_size} byte records)")
+    count = (os.path.getsize(filename) - HEADER.size)//RECORD.size
+    if count == 0:
+        return np.zeros(0, dtype=record_dtype())
+    return np.memmap(filename, dtype=record_dtype(), mode="r", offset=HEADER.size, shape=(count,))
+
+
+#all records for prefix in directory as one array, oldest first
+def read_traces(directory, prefix="sensor"):
+    import numpy as np
+    traces = [read_trace(f) for f in trace_files(directory, prefix)]
+    if not traces:
+        return np.zeros(0, dtype=record_dtype())
+    return np.concatenate(traces)